@@ -6,12 +6,19 @@ Created on Tue Apr 21 08:44:43 2020
 """
 
 import os
+import sys
 import time
 import getpass
-import arcpy
 import pandas as pd
 import numpy as np
 import datetime as dt
+import covid_metrics
+import jurisdictions
+import table_cache
+import feature_service
+import backfill
+import schemas
+import feature_store
 
 print(f'Current date and time: {dt.datetime.now()}')
 
@@ -22,25 +29,60 @@ readable_start = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
 print("The script start time is {}".format(readable_start))
 
 
-# Set variables, get AGOL username and password
-portal_url = arcpy.GetActivePortalURL()
-print(portal_url)
-
-user = getpass.getpass(prompt='    Enter arcgis.com username:\n')
-pw = getpass.getpass(prompt='    Enter arcgis.com password:\n')
-arcpy.SignInToPortal(portal_url, user, pw)
-del pw
-
 # Updated count numbers are copied from table at 'https://coronavirus.utah.gov/case-counts/'
 # CSV file with updates should be named 'COVID_Case_Counts_latest.csv'
 # Update this 'work_dir' variable with the folder you store the updated CSV in
 work_dir = r'C:\COVID19'
+
+# Run with '--local <file.sqlite>' to run the whole update against a local SQLite copy of the layers
+# instead of the live services (no arcpy or sign-in needed), the CSVs are read from the same folder
+if '--local' in sys.argv:
+    local_db = sys.argv[sys.argv.index('--local') + 1]
+    work_dir = os.path.dirname(os.path.abspath(local_db))
+    store = feature_store.SQLiteStore(local_db)
+else:
+    # Get AGOL username and password
+    user = getpass.getpass(prompt='    Enter arcgis.com username:\n')
+    pw = getpass.getpass(prompt='    Enter arcgis.com password:\n')
+    store = feature_store.ArcpyStore.sign_in(user, pw)
+    del pw
+
 updates = pd.read_csv(os.path.join(work_dir, 'COVID_Case_Counts_latest.csv'))
 updates.sort_values('Jurisdiction', inplace=True)
 
-
-if '+AC0' in updates['Jurisdiction'].iloc[-1]:
-    updates['Jurisdiction'].iloc[-1] = updates['Jurisdiction'].iloc[-1].replace('+AC0', '')
+# By default the layer is updated, appended, the full table recalculated and copied back (steps 1-5).
+# Run with '--incremental' to calculate today's numbers from the last 21 days stored in 'tail_file'
+# and only fall back to reloading the full counts by day table if the stored days don't match the service.
+incremental = '--incremental' in sys.argv
+tail_file = os.path.join(work_dir, 'counts_by_day_tail.csv')
+# Local copy of the full counts by day table, only rows newer than the latest cached Day are downloaded.
+# The last 'cache_revalidate_days' cached days are downloaded again on every run, so corrections made on
+# the service to recent days are picked up.  Corrections to older days aren't: run with '--refresh-cache'
+# after making one to download the whole table again and rebuild the snapshot.
+snapshot_file = os.path.join(work_dir, 'counts_by_day_snapshot.npz')
+cache_revalidate_days = covid_metrics.tail_days
+refresh_cache = '--refresh-cache' in sys.argv
+# Run with '--single-pass' to calculate today's numbers before touching the live layer, then write every
+# field of the latest case counts layer in one cursor pass (step 6) and append it to the by day table,
+# instead of updating the layer, appending, recalculating and copying back (steps 1, 2, 4a and 5).
+single_pass = '--single-pass' in sys.argv
+
+# Run with '--backfill' to recalculate the full table and rewrite every row of it (step 4b) instead of
+# only today's row.  A backfill doesn't update the latest case counts layer or append today's rows
+# (steps 1, 2, 5 and 6), it only recalculates and rewrites the history already in the table, read in full
+# from the service rather than from the snapshot.
+# Progress is saved to 'backfill_file' so a failed backfill picks up where it stopped.
+backfill_mode = '--backfill' in sys.argv
+backfill_file = os.path.join(work_dir, 'counts_by_day_backfill.json')
+if backfill_mode:
+    incremental = False
+    single_pass = False
+
+# Timestamp used for Date_Updated (and Day in the by day table) for this run
+update_time = dt.datetime.now().replace(microsecond=0)
+
+# Clean up jurisdiction names and index the updates on them for fast lookups
+updates_by_name = jurisdictions.index_by_name(updates, 'Jurisdiction')
 
 
 # TEST layer
@@ -60,28 +102,29 @@ count = 0
 fields = ['DISTNAME', 'COVID_Cases_Utah_Resident', 'COVID_Cases_Total', 'Hospitalizations',
           #     4               5              6                   7
           'Date_Updated', 'Population', 'Cases_per_100k', 'COVID_Total_Deaths']
-with arcpy.da.UpdateCursor(counts_service, fields) as ucursor:
+if not single_pass and not backfill_mode:
+    lhd_edits = {}
     print("Looping through rows to make updates ...")
-    for row in ucursor:
-        jurisdiction = row[0]
-        if 'San Juan' in jurisdiction.title():
-            jurisdiction = 'San Juan'
-        temp_df = updates.loc[updates['Jurisdiction'] == jurisdiction]
-        print(temp_df.head())
-        row[1] = temp_df.iloc[0]['Cases']
+    for row in store.search(counts_service, ['OID@'] + fields):
+        oid, row = row[0], list(row[1:])
+        jurisdiction = jurisdictions.normalize_name(row[0])
+        temp_row = updates_by_name.loc[jurisdiction]
+        row[1] = temp_row['Cases']
         row[2] = row[1]
-        row[3] = temp_df.iloc[0]['Hospitalizations']
-        row[4] = dt.datetime.now()
+        row[3] = temp_row['Hospitalizations']
+        row[4] = update_time
         row[6] = (row[2]/row[5])*100000.
-        row[7] = temp_df.iloc[0]['Deaths']
+        row[7] = temp_row['Deaths']
+        lhd_edits[oid] = dict(zip(fields[1:], row[1:]))
         count += 1
-        ucursor.updateRow(row)
-print(f'Total count of COVID Case Count updates is: {count}')
+    failed = store.update_rows(counts_service, lhd_edits)
+    if failed:
+        print(f'Failed to update case count rows with ObjectIDs: {failed}')
+    print(f'Total count of COVID Case Count updates is: {count - len(failed)}')
 
 
 # 2) APPEND MOST RECENT CASE COUNTS TO COUNTS BY DAY TABLE
 # Build Field Map for all fields from counts_service into counts_by_day
-fms = arcpy.FieldMappings()
 
 # Old Field Mapping
 # fm_dict = {'DISTNAME': 'DISTNAME',
@@ -113,21 +156,14 @@ fm_dict = {'DISTNAME': 'DISTNAME',
             'COVID_New_Daily_Hosp': 'COVID_New_Daily_Hosp'
             }
 
-for key in fm_dict:
-    fm = arcpy.FieldMap()
-    fm.addInputField(counts_service, key)
-    output = fm.outputField
-    output.name = fm_dict[key]
-    fm.outputField = output
-    fms.addFieldMap(fm)
-
 # Get list of field names to compare them
-counts_fields = [f.name for f in arcpy.ListFields(counts_service)]
-by_day_fields = [f.name for f in arcpy.ListFields(counts_by_day)]
+counts_fields = store.list_fields(counts_service)
+by_day_fields = store.list_fields(counts_by_day)
 
 # # Append the new data
-print('Appending recent case counts to counts by day table ...')
-arcpy.management.Append(counts_service, counts_by_day, "NO_TEST", field_mapping=fms)
+if not single_pass and not backfill_mode:
+    print('Appending recent case counts to counts by day table ...')
+    store.append(counts_service, counts_by_day, fm_dict)
 
 
 # 3) CALCULATE DAILY AND CUMULATIVE NUMBERS IN PANDAS DATAFRAME
@@ -138,138 +174,128 @@ keep_fields = ['DISTNAME', 'COVID_Cases_Utah_Resident', 'COVID_Cases_Non_Utah_Re
                'COVID_New_Daily_Recoveries', 'COVID_Total_Deaths', 'COVID_Deaths_Daily_Increase',
                'COVID_Cases_7_Day_Avg', 'COVID_Hosp_7_Day_Avg', 'COVID_Deaths_7_Day_Avg', 'COVID_New_Daily_Hosp']
 
-# Delete in-memory table that will be used (if it already exists)
-if arcpy.Exists('in_memory\\temp_table'):
-    print("Deleting 'in_memory\\temp_table' ...")
-    arcpy.Delete_management('in_memory\\temp_table')
-    time.sleep(3)
-
-# Convert counts_by_day into pandas dataframe (table --> numpy array --> dataframe)
-arcpy.conversion.TableToTable(counts_by_day, 'in_memory', 'temp_table')
-day_arr = arcpy.da.TableToNumPyArray('in_memory\\temp_table', keep_fields)
-day_df = pd.DataFrame(data=day_arr)
-
-# Clean up San Juan district name, if necessary
-for i in np.arange(day_df.shape[0]):
-    if 'San Juan' in day_df.iloc[i]['DISTNAME'].title():
-        day_df.at[i, 'DISTNAME'] = 'San Juan'
-
-# Convert string entries of 'None' to zeros ('0')
-mask = day_df.applymap(lambda x: x == 'None')
-cols = day_df.columns[(mask).any()]
-for col in day_df[cols]:
-    day_df.loc[mask[col], col] = '0'
-
-# Sort data ascending so most recent dates are at the bottom (highest index)
-day_df.head()
-day_df.sort_values('Day', inplace=True, ascending=True)
-day_df.head().to_string()
-
-# Load test data during the test process
-# Rename variables below back to day_df after done testing
-# test_df = pd.read_csv(os.path.join(work_dir, 'by_day_testing.csv'))
-
-# Split table into individual dataframes by health district
-# Create a dictionary to hold each dataframe, DISTNAME becomes the key
-hd_list = day_df.DISTNAME.unique()
-hd_dict = {}
-for item in hd_list:
-    temp = day_df[day_df.DISTNAME == item]
-    hd_dict[item] = temp.reset_index()
-
-# Calculate values for new fields by iterating through the dataframes
-for key in hd_dict:
-    for i in np.arange(1, hd_dict[key].shape[0]):
-        # Calculate daily case increase
-        hd_dict[key].at[i, 'COVID_Cases_Daily_Increase'] = hd_dict[key].iloc[i]['COVID_Cases_Utah_Resident'] - hd_dict[key].iloc[i-1]['COVID_Cases_Utah_Resident']
-        # Calculate daily death increase
-        hd_dict[key].at[i, 'COVID_Deaths_Daily_Increase'] = int(hd_dict[key].iloc[i]['COVID_Total_Deaths']) - int(hd_dict[key].iloc[i-1]['COVID_Total_Deaths'])
-        # Calculate daily total recoveries = total cases - total deaths - (total cases today - total cases 21 days ago)
-        if i > 20:
-            hd_dict[key].at[i, 'COVID_Total_Recoveries'] = int(hd_dict[key].iloc[i]['COVID_Cases_Utah_Resident']) - int(hd_dict[key].iloc[i]['COVID_Total_Deaths']) - ( int(hd_dict[key].iloc[i]['COVID_Cases_Utah_Resident']) - int(hd_dict[key].iloc[i-21]['COVID_Cases_Utah_Resident']) )
-        # Calculate daily recovery increase
-        hd_dict[key].at[i, 'COVID_New_Daily_Recoveries'] = int(hd_dict[key].iloc[i]['COVID_Total_Recoveries']) - int(hd_dict[key].iloc[i-1]['COVID_Total_Recoveries'])
-        # Calculate daily hospitalization increase
-        hd_dict[key].at[i, 'COVID_New_Daily_Hosp'] = int(hd_dict[key].iloc[i]['Hospitalizations']) - int(hd_dict[key].iloc[i-1]['Hospitalizations'])
-
-
-# Calculate rolling averages by iterating through the dataframes
-for key in hd_dict:
-    # Calculate 7 day average for new daily cases
-    hd_dict[key]['COVID_Cases_7_Day_Avg'] = hd_dict[key]['COVID_Cases_Daily_Increase'].rolling(window=7).mean()
-    # Calculate 7 day average for new daily hospitalization
-    hd_dict[key]['COVID_Hosp_7_Day_Avg'] = hd_dict[key]['COVID_New_Daily_Hosp'].rolling(window=7).mean()
-    # Calculate 7 day average for new daily deaths
-    hd_dict[key]['COVID_Deaths_7_Day_Avg'] = hd_dict[key]['COVID_Deaths_Daily_Increase'].rolling(window=7).mean()
+latest_metrics = None
+tail_df = covid_metrics.load_tail(tail_file) if incremental else None
+if tail_df is not None:
+    # Pull only the stored days from the service to make sure the tail is still in sync
+    section_time = time.time()
+    tail_start = tail_df['Day'].min().normalize()
+    today_start = pd.Timestamp(dt.datetime.now().date())
+    where = f"Day >= timestamp '{tail_start - pd.Timedelta(days=1):%Y-%m-%d %H:%M:%S}'"
+    recent_df = store.read_table(counts_by_day, keep_fields, where)
+    recent_df['DISTNAME'] = jurisdictions.normalize_names(recent_df['DISTNAME'])
+    recent_days = pd.to_datetime(recent_df['Day']).dt.normalize()
+    recent_df = recent_df[(recent_days >= tail_start) & (recent_days < today_start)]
+    
+    if covid_metrics.tail_matches(tail_df, recent_df) and set(tail_df['DISTNAME']) == set(updates_by_name.index):
+        print('Stored tail matches the service, calculating only today\'s numbers ...')
+        today_df = covid_metrics.counts_to_day_rows(updates_by_name, tail_df, update_time)
+        latest_metrics, new_tail = covid_metrics.calc_incremental_metrics(tail_df, today_df)
+        new_tail.to_csv(tail_file, index=False)
+        print(f'Time to calculate counts by day metrics incrementally: {time.time() - section_time}')
+    else:
+        print('Stored tail does not match the service, recalculating the full counts by day table ...')
+
+if latest_metrics is None:
+    # Load the local snapshot of counts_by_day and download only the rows added since it was saved,
+    # plus the last few cached days to pick up corrections to them.  A backfill recalculates from the
+    # whole table as it is on the service (and rebuilds the snapshot from it)
+    cached_df = None if refresh_cache or backfill_mode else table_cache.load_snapshot(snapshot_file)
+    since = table_cache.revalidate_start(cached_df, 'Day', cache_revalidate_days)
+    where = table_cache.watermark_where(cached_df, 'Day', cache_revalidate_days)
+    print(f"Downloading counts by day rows where: '{where}' ...")
+    new_df = store.read_table(counts_by_day, keep_fields, where)
+
+    # Clean up district names, if necessary
+    new_df['DISTNAME'] = jurisdictions.normalize_names(new_df['DISTNAME'])
+
+    # Replace the cached rows from 'since' on with the downloaded ones
+    day_df = table_cache.merge_delta(cached_df, new_df, ['DISTNAME', 'Day'], 'Day', since=since)
+
+    # In single pass mode today's rows haven't been appended yet, so build them from the CSV
+    if single_pass:
+        today_df = covid_metrics.counts_to_day_rows(updates_by_name, day_df, update_time)
+        day_df = pd.concat([day_df, today_df], ignore_index=True)
+
+    # Cast columns to compact types, string entries of 'None' are converted to zeros
+    schemas.apply_schema(day_df, schemas.by_day_schema)
+
+    # A day the update ran more than once on has several rows per district, a backfill recalculates
+    # the one written last and writes its numbers to all of them (step 4b)
+    if backfill_mode:
+        day_df = covid_metrics.one_row_per_district_day(day_df)
+
+    # Sort data ascending so most recent dates are at the bottom (highest index)
+    day_df.head()
+    day_df.sort_values('Day', inplace=True, ascending=True)
+    day_df.head().to_string()
+
+    # Load test data during the test process
+    # Rename variables below back to day_df after done testing
+    # test_df = pd.read_csv(os.path.join(work_dir, 'by_day_testing.csv'))
+
+    # Calculate daily increases, recoveries and 7 day averages for all health districts in one grouped pass
+    section_time = time.time()
+    day_df = covid_metrics.calc_district_metrics(day_df)
+    print(f'Time to calculate counts by day metrics: {time.time() - section_time}')
+
+    # Select the most recent row of each district for the cursor lookups below
+    latest_metrics = covid_metrics.latest_by_district(day_df)
+    covid_metrics.save_tail(day_df, tail_file)
+    table_cache.save_snapshot(day_df[keep_fields], snapshot_file)
 
 
 # 4a) UPDATE ***ONLY TODAY'S ROW*** IN COUNTS BY DAY TABLE WITH NEW NUMBERS
+# Only rows around today's date are read from the service, then all of today's rows are sent in one batched edit
 # start_time = time.time()
 table_count = 0
-#                   0         1                2                           3   
-table_fields = ['DISTNAME', 'Day', 'COVID_Cases_Daily_Increase', 'COVID_Total_Recoveries',
-          #            4                         5                          6
-          'COVID_New_Daily_Recoveries', 'COVID_Total_Deaths', 'COVID_Deaths_Daily_Increase',
-          #             7                       8                       9                       10
-          'COVID_Cases_7_Day_Avg', 'COVID_Hosp_7_Day_Avg', 'COVID_Deaths_7_Day_Avg', 'COVID_New_Daily_Hosp']
-with arcpy.da.UpdateCursor(counts_by_day, table_fields) as ucursor:
-    print("Looping through rows to make updates ...")
-    for row in ucursor:
-        if dt.datetime.now().date() == row[1].date():
-            print(row[0] + '   ' + str(row[1]))
-            jurisdiction = row[0]
-            if 'San Juan' in jurisdiction.title():
-                jurisdiction = 'San Juan'
-            # select row of jurisdiction's dataframe where date == date in hosted 'by day' table
-            temp_df = hd_dict[jurisdiction].loc[hd_dict[jurisdiction]['Day'] == row[1]]
-            # print(temp_df.head())
-            row[2] = temp_df.iloc[0]['COVID_Cases_Daily_Increase']
-            row[3] = temp_df.iloc[0]['COVID_Total_Recoveries']
-            row[4] = temp_df.iloc[0]['COVID_New_Daily_Recoveries']
-            row[5] = temp_df.iloc[0]['COVID_Total_Deaths']
-            row[6] = temp_df.iloc[0]['COVID_Deaths_Daily_Increase']
-            row[7] = temp_df.iloc[0]['COVID_Cases_7_Day_Avg']
-            row[8] = temp_df.iloc[0]['COVID_Hosp_7_Day_Avg']
-            row[9] = temp_df.iloc[0]['COVID_Deaths_7_Day_Avg']
-            row[10] = temp_df.iloc[0]['COVID_New_Daily_Hosp']
+table_fields = ['COVID_Cases_Daily_Increase', 'COVID_Total_Recoveries', 'COVID_New_Daily_Recoveries',
+                'COVID_Total_Deaths', 'COVID_Deaths_Daily_Increase', 'COVID_Cases_7_Day_Avg',
+                'COVID_Hosp_7_Day_Avg', 'COVID_Deaths_7_Day_Avg', 'COVID_New_Daily_Hosp']
+if not single_pass and not backfill_mode:
+    table_edits = {}
+    where = feature_service.day_where('Day', dt.datetime.now().date())
+    print("Looping through today's rows to build updates ...")
+    for row in store.search(counts_by_day, ['OID@', 'DISTNAME', 'Day'], where):
+        if dt.datetime.now().date() == row[2].date():
+            print(row[1] + '   ' + str(row[2]))
+            jurisdiction = jurisdictions.normalize_name(row[1])
+            # select jurisdiction's most recent (today's) row of results
+            temp_row = latest_metrics.loc[jurisdiction]
+            table_edits[row[0]] = temp_row[table_fields].to_dict()
             table_count += 1
-            ucursor.updateRow(row)
-print(f'Total count of COVID Counts By Day Table updates is: {table_count}') 
-
-
-# # 4b) UPDATE ***ALL ROWS*** IN COUNTS BY DAY TABLE WITH NEW NUMBERS
-# # Should only need to run this once to make the calculations for all previous rows
-# # start_time = time.time()
-# table_count = 0
-# #                   0         1                2                           3   
-# table_fields = ['DISTNAME', 'Day', 'COVID_Cases_Daily_Increase', 'COVID_Total_Recoveries',
-#           #            4                         5                          6
-#           'COVID_New_Daily_Recoveries', 'COVID_Total_Deaths', 'COVID_Deaths_Daily_Increase',
-#           #           7                       8                       9                       10
-#          'COVID_Cases_7_Day_Avg', 'COVID_Hosp_7_Day_Avg', 'COVID_Deaths_7_Day_Avg', 'COVID_New_Daily_Hosp']
-# with arcpy.da.UpdateCursor(counts_by_day, table_fields) as ucursor:
-#     print("Looping through rows to make updates ...")
-#     for row in ucursor:
-#         print(row[0] + '   ' + str(row[1]))
-#         jurisdiction = row[0]
-#         if 'San Juan' in jurisdiction.title():
-#             jurisdiction = 'San Juan'
-#         # select row of jurisdiction's dataframe where date == date in hosted 'by day' table
-#         temp_df = hd_dict[jurisdiction].loc[hd_dict[jurisdiction]['Day'] == row[1]]
-#         # print(temp_df.head())
-#         row[2] = temp_df.iloc[0]['COVID_Cases_Daily_Increase']
-#         row[3] = temp_df.iloc[0]['COVID_Total_Recoveries']
-#         row[4] = temp_df.iloc[0]['COVID_New_Daily_Recoveries']
-#         row[5] = temp_df.iloc[0]['COVID_Total_Deaths']
-#         row[6] = temp_df.iloc[0]['COVID_Deaths_Daily_Increase']
-#         row[7] = temp_df.iloc[0]['COVID_Cases_7_Day_Avg']
-#         row[8] = temp_df.iloc[0]['COVID_Hosp_7_Day_Avg']
-#         row[9] = temp_df.iloc[0]['COVID_Deaths_7_Day_Avg']
-#         row[10] = temp_df.iloc[0]['COVID_New_Daily_Hosp']
-#         table_count += 1
-#         ucursor.updateRow(row)
-# print(f'Total count of COVID Counts By Day Table updates is: {table_count}')      
+    failed = store.update_rows(counts_by_day, table_edits)
+    if failed:
+        print(f'Failed to update counts by day rows with ObjectIDs: {failed}')
+    print(f'Total count of COVID Counts By Day Table updates is: {table_count - len(failed)}')
+
+
+# 4b) UPDATE ***ALL ROWS*** IN COUNTS BY DAY TABLE WITH NEW NUMBERS
+# Only runs in backfill mode, rows are written in chunks by district and date range, several chunks at a time
+if backfill_mode:
+    oid_df = store.read_table(counts_by_day, ['OID@', 'DISTNAME', 'Day'])
+    oid_df.rename(columns={'OID@': 'OID'}, inplace=True)
+    oid_df['DISTNAME'] = jurisdictions.normalize_names(oid_df['DISTNAME'])
+    oid_df['Day'] = pd.to_datetime(oid_df['Day'])
+    
+    # Match hosted rows to the recalculated rows by district and day (day_df has one row per district per day)
+    oid_df['Day_Key'] = oid_df['Day'].dt.normalize()
+    day_keys = day_df[['DISTNAME'] + table_fields].assign(Day_Key=pd.to_datetime(day_df['Day']).dt.normalize())
+    edits_df = oid_df.merge(day_keys, on=['DISTNAME', 'Day_Key'], how='inner', validate='many_to_one')
+    if edits_df.shape[0] < oid_df.shape[0]:
+        print(f'{oid_df.shape[0] - edits_df.shape[0]} hosted rows have no recalculated numbers, skipping them')
     
+    def write_chunk(chunk):
+        edits = chunk.set_index('OID')[table_fields].to_dict('index')
+        return store.update_rows(counts_by_day, edits)
+    
+    chunks = backfill.plan_chunks(edits_df, 'Day', 'DISTNAME')
+    table_count, failed_chunks, error_chunks = backfill.run_backfill(chunks, write_chunk, backfill.Checkpoint(backfill_file))
+    if failed_chunks:
+        print(f'Chunks with rows that failed to write: {failed_chunks}    rerun with --backfill to retry them')
+    if error_chunks:
+        print(f'Chunks that raised an error: {error_chunks}    fix the error above, then rerun with --backfill')
+    print(f'Total count of COVID Counts By Day Table updates is: {table_count}')
 
 
 # 5) COPY DAILY AND CUMULATIVE NUMBERS BACK TO MOST RECENT CASE COUNTS LAYER
@@ -281,27 +307,57 @@ lhd_fields = ['DISTNAME', 'Date_Updated', 'COVID_Cases_Daily_Increase', 'COVID_T
           'COVID_New_Daily_Recoveries', 'COVID_Total_Deaths', 'COVID_Deaths_Daily_Increase',
           #             7                       8                       9                       10
           'COVID_Cases_7_Day_Avg', 'COVID_Hosp_7_Day_Avg', 'COVID_Deaths_7_Day_Avg', 'COVID_New_Daily_Hosp']
-with arcpy.da.UpdateCursor(counts_service, lhd_fields) as ucursor:
+if not single_pass and not backfill_mode:
+    lhd_edits = {}
+    print("Looping through rows to make updates ...")
+    for row in store.search(counts_service, ['OID@'] + lhd_fields):
+        oid, row = row[0], list(row[1:])
+        jurisdiction = jurisdictions.normalize_name(row[0])
+        # select last row (most recent) of jurisdiction's results and copy into counts_service layer
+        temp_row = latest_metrics.loc[jurisdiction]
+        lhd_edits[oid] = temp_row[lhd_fields[2:]].to_dict()
+        lhd_count += 1
+    failed = store.update_rows(counts_service, lhd_edits)
+    if failed:
+        print(f'Failed to update case count rows with ObjectIDs: {failed}')
+    print(f'Total count of COVID updates by local health district: {lhd_count - len(failed)}')
+
+
+# 6) SINGLE PASS MODE: WRITE CSV NUMBERS AND DAILY/CUMULATIVE NUMBERS TO LATEST CASE COUNTS LAYER
+# Every field is written in one pass (one batched edit), then the layer is appended to the by day table
+# with the calculated numbers already in place, so steps 1, 4a and 5 aren't needed
+if single_pass:
+    lhd_count = 0
+    lhd_fields = fields + [f for f in table_fields if f not in fields]
+    lhd_edits = {}
     print("Looping through rows to make updates ...")
-    for row in ucursor:
-        jurisdiction = row[0]
-        if 'San Juan' in jurisdiction.title():
-            jurisdiction = 'San Juan'
-        # select last row (most recent) of jurisdiction's dataframe and copy into counts_service layer
-        temp_row = hd_dict[jurisdiction].iloc[-1]
-        row[2] = temp_row.loc['COVID_Cases_Daily_Increase']
-        row[3] = temp_row.loc['COVID_Total_Recoveries']
-        row[4] = temp_row.loc['COVID_New_Daily_Recoveries']
-        row[5] = temp_row.loc['COVID_Total_Deaths']
-        row[6] = temp_row.loc['COVID_Deaths_Daily_Increase']
-        row[7] = temp_row.loc['COVID_Cases_7_Day_Avg']
-        row[8] = temp_row.loc['COVID_Hosp_7_Day_Avg']
-        row[9] = temp_row.loc['COVID_Deaths_7_Day_Avg']
-        row[10] = temp_row.loc['COVID_New_Daily_Hosp']
+    for row in store.search(counts_service, ['OID@'] + lhd_fields):
+        oid, row = row[0], list(row[1:])
+        jurisdiction = jurisdictions.normalize_name(row[0])
+        temp_row = updates_by_name.loc[jurisdiction]
+        row[1] = temp_row['Cases']
+        row[2] = row[1]
+        row[3] = temp_row['Hospitalizations']
+        row[4] = update_time
+        row[6] = (row[2]/row[5])*100000.
+        row[7] = temp_row['Deaths']
+        # copy jurisdiction's calculated numbers for today into the rest of the fields
+        metrics_row = latest_metrics.loc[jurisdiction]
+        row[len(fields):] = [metrics_row[f] for f in lhd_fields[len(fields):]]
+        lhd_edits[oid] = dict(zip(lhd_fields[1:], row[1:]))
         lhd_count += 1
-        ucursor.updateRow(row)
-print(f'Total count of COVID updates by local health district: {lhd_count}')      
+    failed = store.update_rows(counts_service, lhd_edits)
+    if failed:
+        print(f'Failed to update case count rows with ObjectIDs: {failed}')
+    print(f'Total count of COVID updates by local health district: {lhd_count - len(failed)}')
     
+    print('Appending recent case counts to counts by day table ...')
+    store.append(counts_service, counts_by_day, fm_dict)
+
+
+# Concurrency and latency of the edits sent to hosted services this run
+if store.edit_metrics() is not None:
+    print(f'Edit concurrency and latency: {store.edit_metrics()}')
 
 print("Script shutting down ...")
 # Stop timer and print end time in UTC
@@ -8,12 +8,16 @@ Created on Thu Jun 25 15:31:43 2020
 import os, sys
 import time
 import getpass
-import requests
-import random
-import arcpy
 import pandas as pd
 import numpy as np
 import datetime as dt
+import feature_service
+import backfill
+import schemas
+import feature_store
+import ltcf_metrics
+import geocoding
+import throttle
 
 print(f'Current date and time: {dt.datetime.now()}')
 
@@ -23,67 +27,25 @@ readable_start = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
 print("The script start time is {}".format(readable_start))
 
 
-# Set variables, get AGOL username and password
-portal_url = arcpy.GetActivePortalURL()
-print(portal_url)
-
-user = getpass.getpass(prompt='    Enter arcgis.com username:\n')
-pw = getpass.getpass(prompt='    Enter arcgis.com password:\n')
-arcpy.SignInToPortal(portal_url, user, pw)
-del pw
-
 ###################
 # Geocoding Tools #
 ###################
 
-# Create Geocoder class and function -- from AGRC GitHub
-class Geocoder(object):
-
-    _api_key = None
-    _url_template = "http://api.mapserv.utah.gov/api/v1/geocode/{}/{}"
-
-    def __init__(self, api_key):
-        """
-        Create your api key at
-        https://developer.mapserv.utah.gov/secure/KeyManagement
-        """
-        self._api_key = api_key
-
-    def locate(self, street, zone, **kwargs):
-        kwargs["apiKey"] = self._api_key
-        # r = requests.get(self._url_template.format(street, zone), params=kwargs)
-        r = requests.get(self._url_template.format(street, zone), params=kwargs, headers={'referer': 'http://ltcf-covid-updates.com'})
-
-        response = r.json()
-
-        if r.status_code is not 200 or response["status"] is not 200:
-            print("{} {} was not found. {}".format(street, zone, response["message"]))
-            return None
-
-        result = response["result"]
-
-        print("match: {} score [{}]".format(result["score"], result["matchAddress"]))
-        return result["location"]
-
-
-# Function to send fields to geocoder, get x/y values back
+# Function to send fields to geocoder, get x/y values back (uses the geocode_chain created below)
 def geocode(row):
-    self = 'AGRC-XXXXXXXXXXXXX'     # insert correct API token here (home)
-    # result = Geocoder(self).locate(row['Address'], row['ZIP_Code'],
-    result = Geocoder(self).locate(row['Address'], row['City'],
-                                        **{"acceptScore": 70, "spatialReference": 3857})
+    result = geocode_chain.lookup(row)
     print(result)
 #    if result['status'] == '404':
     if result is None:
         row['x'] = '0'
         row['y'] = '0'
         row['status'] = 'failed'
+        row['geocoder'] = ''
     else:
-        row['x'] = result['x']
-        row['y'] = result['y']
+        row['x'] = result['location']['x']
+        row['y'] = result['location']['y']
         row['status'] = 'succeeded'
-        
-    time.sleep(random.random()*.3)
+        row['geocoder'] = result['provider']
     return row
 
 
@@ -97,6 +59,54 @@ def geocode(row):
 # Update this 'work_dir' variable with the folder you store the updated CSV in
 work_dir = r'C:\COVID19'
 
+# Run with '--local <file.sqlite>' to run the whole update against a local SQLite copy of the layers
+# instead of the live services (no arcpy or sign-in needed), the CSVs are read from the same folder
+if '--local' in sys.argv:
+    local_db = sys.argv[sys.argv.index('--local') + 1]
+    work_dir = os.path.dirname(os.path.abspath(local_db))
+    store = feature_store.SQLiteStore(local_db)
+else:
+    # Get AGOL username and password
+    user = getpass.getpass(prompt='    Enter arcgis.com username:\n')
+    pw = getpass.getpass(prompt='    Enter arcgis.com password:\n')
+    store = feature_store.ArcpyStore.sign_in(user, pw)
+    del pw
+
+# New facilities are geocoded up to 'geocode_workers' at a time, limited to 'geocode_rate' requests per second
+# The number at a time starts low and adjusts to how the API responds (backs off when it throttles or errors)
+geocode_workers = 8
+geocode_rate = 10
+# Geocoding results are saved here and reused by later runs (and by the other LTCF script)
+geocode_cache = geocoding.GeocodeCache(os.path.join(work_dir, 'geocode_cache.json'))
+# One geocoder (and one pool of open connections) is shared by all geocoding in this run
+agrc_api_key = 'AGRC-XXXXXXXXXXXXX'     # insert correct API token here (home)
+geocode_limiter = throttle.AdaptiveLimiter(initial=2, maximum=geocode_workers)
+geocoder = geocoding.Geocoder(agrc_api_key, cache=geocode_cache, pool_size=geocode_workers, limiter=geocode_limiter)
+# Each facility is tried by Address + City, then by Address + ZIP_Code, then against local address points,
+# until one scores at least 70.  A request slower than 90% of that provider's recent requests is hedged by
+# starting the next provider.
+geocode_options = {"acceptScore": 70, "spatialReference": 3857}
+geocode_providers = [('agrc_city', geocoding.agrc_provider(geocoder, 'City', **geocode_options)),
+                     ('agrc_zip', geocoding.agrc_provider(geocoder, 'ZIP_Code', **geocode_options))]
+# Address points (CSV or Parquet of address, city, zip, x, y in Web Mercator) for geocoding offline.
+# Run with '--offline-geocoding' to geocode only against them, without the AGRC API.
+address_points_file = os.path.join(work_dir, 'address_points.csv')
+if '--offline-geocoding' in sys.argv and not os.path.exists(address_points_file):
+    sys.exit(f'--offline-geocoding needs the address points file, {address_points_file} does not exist')
+# The address points are only indexed (and the provider chain created) when there are new facilities to geocode
+
+# Set to a number of rows to read a very large sheet export a chunk at a time (None reads it all at once)
+sheet_chunk_size = None
+
+# New facilities are sent to hosted services this many rows per applyEdits request
+insert_chunk_size = 500
+
+# Run with '--backfill' to rewrite the 7 day averages in every row of the LTCF events by day table (step 7b)
+# instead of only today's row.  A backfill doesn't read the sheet, update facilities or add today's row (steps 1-5).
+# Progress is saved to 'backfill_file' so a failed backfill picks up where it stopped.
+backfill_mode = '--backfill' in sys.argv
+backfill_file = os.path.join(work_dir, 'ltcf_events_by_day_backfill.json')
+
 # TEST layer
 # ltcf_service = r'https://services1.arcgis.com/99lidPhWCzftIe9K/arcgis/rest/services/EMN_LTCF_Data_TEST/FeatureServer/0'
 
@@ -105,407 +115,213 @@ ltcf_service = r'https://services6.arcgis.com/KaHXE9OkiB9e63uE/arcgis/rest/servi
 # LTCF Events by Day
 ltcf_events_by_day = r'https://services6.arcgis.com/KaHXE9OkiB9e63uE/arcgis/rest/services/LTCF_Events_by_Day/FeatureServer/0'
 
-# 1) Load CSV data with updates, prep, and clean up the data
-# Read in updates from CSV that was exported from Google Sheet (LTCF_Data)
-updates = pd.read_csv(os.path.join(work_dir, 'COVID_LTCF_Data_latest.csv'))
-updates.sort_values('ID', inplace=True)
-
-# Drop updates columns that aren't needed
-# Facility_Type will be dropped, then recreated from 'Dashboard Facility Type')
-updates.drop(columns=['Facility_Type', 'Notes'],  inplace=True)
-
-# Reaname updates columns to match service
-col_renames = {'ID': 'OID',
-               'Dashboard Facility Type': 'Facility_Type',
-               'Positive Patients': 'Positive_Patients',
-               'Deceased Patients': 'Deceased_Patients',
-               'Positive HCWs': 'Positive_HCWs',
-               'Positive Patient Description': 'Positive_Patients_Desc',
-               'Last Positive Resident': 'LastPos_Resident'}# *** JULIA ADD 1/24 ***
-
-updates.rename(col_renames, axis='columns', inplace=True)
-
-# Strip whitespace from string fields
-# updates = updates.apply(lambda x: x.str.strip() if x.dtype == "object" else x)
-updates = updates.applymap(lambda x: x.strip() if type(x) == str else x)
-
-# Convert empty spaces to NaNs
-updates = updates.applymap(lambda x: np.nan if isinstance(x, str) and not x else x)
-
-
-# Convert columns to appropriate type for comparisons
-int_fields = ['OID', 'UniqueID', 'Positive_Patients', 'Deceased_Patients',
-              'Positive_HCWs']
-str_fields = ['Positive_Patients_Desc']
-dt_fields = ['Notification_Date', 'LastPos_Resident']# *** JULIA EDIT 1/24 ***
-
-
-# Intermediate step: convert NaNs to 9999 for integers, to 'N' for Resolved_Y_N
-updates[int_fields] = updates[int_fields].fillna(9999)
-updates['Resolved_Y_N'] = updates['Resolved_Y_N'].fillna('N')
-
-# Cast columns as proper data types
-updates[int_fields] = updates[int_fields].astype(int)
-updates[str_fields] = updates[str_fields].astype(str)
-updates[dt_fields] = updates[dt_fields].astype('datetime64[ns]')
-
-
-
-# 2) Load LTCF_Data from feature layer, prep, and clean up the data
-keep_fields = ['OID', 'UniqueID', 'Facility_Name', 'Address',
-                'City', 'ZIP_Code', 'Facility_Type', 'LHD',
-                'Resolved_Y_N', 'Date_Resolved', 'Longitude',
-                'Latitude', 'Notification_Date', 'Positive_Patients',
-                'Deceased_Patients', 'Positive_HCWs', 'Positive_Patients_Desc', 'LastPos_Resident'] # *** JULIA ADD 1/24 ***
-
-# Reoder columns to updates to match ltcf data
-cols_reorder = keep_fields.copy()
-updates = updates[cols_reorder]
-
-# Delete in-memory table that will be used (if it already exists)
-if arcpy.Exists('in_memory\\temp_table'):
-    print("Deleting 'in_memory\\temp_table' ...")
-    arcpy.Delete_management('in_memory\\temp_table')
-    time.sleep(3)
-
-# Convert LTCF_Data feature layer into pandas dataframe (table --> numpy array --> dataframe)
-arcpy.conversion.TableToTable(ltcf_service, 'in_memory', 'temp_table')
-table_fields = [f.name for f in arcpy.ListFields('in_memory\\temp_table')]
-
-# Replace Nones in UniqueID field with 0s 
-count = 0
-fields = ['UniqueID']
-with arcpy.da.UpdateCursor('in_memory\\temp_table', fields) as ucursor:
-    print("Looping through rows in temp_table to make updates ...")
-    for row in ucursor:
-        if row[0] == None:
-            row[0] = 0
-            count += 1
-        ucursor.updateRow(row)
-# print(f'Total count of "None" updates is: {count}')
-
-# Correct spelling typo in LTCF_Data feature layer
-arcpy.AlterField_management('in_memory\\temp_table', 'Postive_Patients_Desc', 'Positive_Patients_Desc')
-
-# Convert in-memory table to numpy array and then pandas dataframe
-ltcf_arr = arcpy.da.TableToNumPyArray('in_memory\\temp_table', keep_fields)
-ltcf_df = pd.DataFrame(data=ltcf_arr)
-
-# Strip whitespace from string fields
-# ltcf_df = ltcf_df.apply(lambda x: x.str.strip() if x.dtype == "object" else x)
-ltcf_df = ltcf_df.applymap(lambda x: x.strip() if type(x) == str else x)
-
-# 3) Add new spreadsheet rows to LTCF_Data feature layer
-# Subset new rows into separate dataframe and replace 9999s with 0s
-current_ids = list(ltcf_df['UniqueID'])
-# Finds UniqueIDs not in list of current_ids and greater than the max value in current_ids
-updates_geo = updates.loc[(~updates['UniqueID'].isin(current_ids)) & (updates['UniqueID'] > max(current_ids))]
-updates_geo = updates_geo.replace(9999, 0)
-
-
-# Check for need to geocode new rows, either geocode or proceed with change detection
-if updates_geo.shape[0] > 0:
-    # Send new rows to geocoder
-    section_time = time.time()
-    updates_geo = updates_geo.apply(geocode, axis=1)
-    print(f'Time to geocode new rows: {time.time() - section_time}')
+# Steps 1-5 read the sheet, update the facilities and add today's events by day row,
+# a backfill skips them and only recalculates and rewrites the rows already in the table
+if not backfill_mode:
+    # 1) Load LTCF_Data from feature layer, prep, and clean up the data
+    keep_fields = ['OID', 'UniqueID', 'Facility_Name', 'Address',
+                    'City', 'ZIP_Code', 'Facility_Type', 'LHD',
+                    'Resolved_Y_N', 'Date_Resolved', 'Longitude',
+                    'Latitude', 'Notification_Date', 'Positive_Patients',
+                    'Deceased_Patients', 'Positive_HCWs', 'Positive_Patients_Desc', 'LastPos_Resident'] # *** JULIA ADD 1/24 ***
+
+    # Convert LTCF_Data feature layer into pandas dataframe (table --> numpy array --> dataframe)
+    # Nones in the UniqueID field are read as 0s, the field with the spelling typo is read and renamed
+    service_fields = ['Postive_Patients_Desc' if f == 'Positive_Patients_Desc' else f for f in keep_fields]
+    ltcf_df = store.read_table(ltcf_service, service_fields, null_value={'UniqueID': 0})
+    ltcf_df.rename(columns={'Postive_Patients_Desc': 'Positive_Patients_Desc'}, inplace=True)
+
+    # Cast columns to compact types, whitespace is stripped from string fields
+    schemas.apply_schema(ltcf_df, schemas.ltcf_schema)
+    current_ids = list(ltcf_df['UniqueID'])
+
+
+
+    # 2) Load CSV data with updates, prep, and clean up the data
+    # Read in updates from CSV that was exported from Google Sheet (LTCF_Data)
+    # Unneeded columns are dropped, columns are renamed to match the service, whitespace is stripped,
+    # empty cells are made null and columns are cast for comparisons (see ltcf_metrics.read_sheet)
+    # Each chunk (or the whole sheet) is cut down to the new rows and, for every facility, the fields
+    # change detection reads (see ltcf_metrics.scan_sheet)
+    sheet_file = os.path.join(work_dir, 'COVID_LTCF_Data_latest.csv')
+    if sheet_chunk_size:
+        sheet_chunks = ltcf_metrics.iter_sheet(sheet_file, sheet_chunk_size, keep_fields)
+    else:
+        sheet_chunks = [ltcf_metrics.read_sheet(sheet_file)[keep_fields]]
+    no_unique_id, new_rows, sheet_facilities = ltcf_metrics.scan_sheet(sheet_chunks, current_ids)
+
+    # 3) Add new spreadsheet rows to LTCF_Data feature layer
+    # Subset new rows into separate dataframe, missing counts are filled as they're written to the layer
+    # Rows without a UniqueID can't be matched to the layer (they would be added again every run)
+    if no_unique_id:
+        print(f'Sheet rows without a UniqueID are not added: {no_unique_id}')
+    # Finds UniqueIDs not in list of current_ids and greater than the max value in current_ids
+    updates_geo = ltcf_metrics.to_service(new_rows.loc[new_rows['UniqueID'] > max(current_ids)])
+
+
+    # Check for need to geocode new rows, either geocode or proceed with change detection
+    if updates_geo.shape[0] > 0:
+        # Send new rows to geocoder
+        section_time = time.time()
+        if os.path.exists(address_points_file):
+            address_index = geocoding.AddressIndex(address_points_file)
+            geocode_providers.append(('address_points', geocoding.index_provider(address_index)))
+            if '--offline-geocoding' in sys.argv:
+                geocode_providers = geocode_providers[-1:]
+                geocode_rate = None
+        geocode_chain = geocoding.ProviderChain(geocode_providers, min_score=70, hedge_percentile=90,
+                                                max_workers=2 * geocode_workers)
+        # Rows with the same address are only sent once
+        address = lambda row: geocoding.address_key(row['Address'], row['City'], ZIP_Code=row['ZIP_Code'])
+        updates_geo, geocode_stats = geocoding.geocode_rows(updates_geo, geocode, geocode_workers, geocode_rate, key=address)
+        geocode_cache.save()
+        print(f'Geocoding concurrency and latency: {geocode_limiter.metrics()}')
+        print(f'Geocoding providers: {geocode_chain.metrics()}')
+        geocode_chain.close()
+        geocoder.close()
+        print(f'Time to geocode new rows: {time.time() - section_time}')
     
-    # Filter down to successful and failed results
-    good_geo = updates_geo.loc[updates_geo['status'] == 'succeeded']
-    bad_geo = updates_geo.loc[updates_geo['status'] == 'failed']
+        # Filter down to successful and failed results
+        good_geo = updates_geo.loc[updates_geo['status'] == 'succeeded']
+        bad_geo = updates_geo.loc[updates_geo['status'] == 'failed']
     
-    # Print out facilities that failed to geocode
-    if not bad_geo.empty:
-        print(f'Number of facilities that failed to geocode:  {bad_geo.shape[0]}')
-        print('Failed facilities:')
-        output = [print(f'    {row[0]}:  {row[1]}, {row[2]}, {row[3]}, {row[4]}') for row in bad_geo[['UniqueID', 'Facility_Name', 'Address', 'City', 'ZIP_Code']].to_numpy()]
-    else:
-        print(f'\n All facilities ({good_geo.shape[0]}) were successfully geocoded! \n')
+        # Print out facilities that failed to geocode
+        if not bad_geo.empty:
+            print(f'Number of facilities that failed to geocode:  {bad_geo.shape[0]}')
+            print('Failed facilities:')
+            output = [print(f'    {row[0]}:  {row[1]}, {row[2]}, {row[3]}, {row[4]}') for row in bad_geo[['UniqueID', 'Facility_Name', 'Address', 'City', 'ZIP_Code']].to_numpy()]
+        else:
+            print(f'\n All facilities ({good_geo.shape[0]}) were successfully geocoded! \n')
     
-    # Prompt user to continue or abort
-    resp = input("Would you like to continue?    (y/n) \n")
-    if resp.lower() == 'n':
-        sys.exit(0)
+        # Prompt user to continue or abort
+        resp = input("Would you like to continue?    (y/n) \n")
+        if resp.lower() == 'n':
+            sys.exit(0)
     
-    # Append successfully geocoded facilities to LTCF_Data feature layer
-    # Get AGOL username
-    desc = arcpy.GetPortalDescription()
-    username = desc['user']['username']
+        # Append successfully geocoded facilities to LTCF_Data feature layer
+        # Get AGOL username
+        username = store.username()
     
-    insert_fields = ['UniqueID', 'Facility_Name', 'Address',
-                    'City', 'ZIP_Code', 'Facility_Type', 'LHD',
-                    'Resolved_Y_N', 'Date_Resolved', 'Notification_Date', 'Positive_Patients',
-                    'Deceased_Patients', 'Positive_HCWs', 'CreationDate', 'Creator',
-                    'EditDate', 'Editor', 'SHAPE@XY']
-        
-    def insert_row(row):
-        xy = (row['x'], row['y'])
-        values = [row['UniqueID'],
-                  row['Facility_Name'],
-                  row['Address'],
-                  row['City'],
-                  row['ZIP_Code'],
-                  row['Facility_Type'],
-                  row['LHD'],
-                  row['Resolved_Y_N'],
-                  row['Date_Resolved'],
-                  row['Notification_Date'],
-                  row['Positive_Patients'],
-                  row['Deceased_Patients'],
-                  row['Positive_HCWs'],
-                  dt.datetime.now(),
-                  f'Python Script by {username}',
-                  dt.datetime.now(),
-                  f'Python Script by {username}',
-                  xy,
-                  ]
+        insert_fields = ['UniqueID', 'Facility_Name', 'Address',
+                        'City', 'ZIP_Code', 'Facility_Type', 'LHD',
+                        'Resolved_Y_N', 'Date_Resolved', 'Notification_Date', 'Positive_Patients',
+                        'Deceased_Patients', 'Positive_HCWs', 'CreationDate', 'Creator',
+                        'EditDate', 'Editor', 'SHAPE@XY']
         
-        print(f"Adding {row['UniqueID']}:  {row['Facility_Name']} ...")
-        with arcpy.da.InsertCursor(ltcf_service, insert_fields) as insert_cursor:
-            insert_cursor.insertRow(values)
+        # Build every new row at once (one timestamp for the batch), then insert them in chunks of
+        # 'insert_chunk_size' rows per applyEdits request for hosted services (one insert cursor otherwise)
+        now = dt.datetime.now()
+        new_rows = good_geo[insert_fields[:13]].copy()
+        new_rows['CreationDate'] = now
+        new_rows['Creator'] = f'Python Script by {username}'
+        new_rows['EditDate'] = now
+        new_rows['Editor'] = f'Python Script by {username}'
+        new_rows['SHAPE@XY'] = list(zip(good_geo['x'].astype(float), good_geo['y'].astype(float)))
     
-    # Run insert cursor on each row of good_geo dataframe
-    good_geo.apply(insert_row, axis=1)
+        print(f"Adding {new_rows.shape[0]} facilities in chunks of {insert_chunk_size} ...")
+        section_time = time.time()
+        failed = store.insert_rows(ltcf_service, insert_fields, list(new_rows.itertuples(index=False, name=None)),
+                                   chunk_size=insert_chunk_size)
+        for i, e in failed:
+            print(f"    Failed to add {new_rows['UniqueID'].iloc[i]}:  {new_rows['Facility_Name'].iloc[i]}: {e}")
+        print(f'Added {new_rows.shape[0] - len(failed)} of {new_rows.shape[0]} facilities '
+              f'in {time.time() - section_time:.2f}s')
 
-else:
-    # Prompt user to continue to change detection
-    resp2 = input("\n    No new rows to geocode. Continue to change detection?    (y/n) \n")
-    if resp2.lower() == 'n':
-        sys.exit(0)
-
-
-# 4) Check for differences in key field and update their attributes accordingly
-# Set up a counter variable and lists for UniqueIDs that were changed
-ltcf_count = 0
-unique_updates = []
-res_updates = []
-resdate_updates = []
-pospat_updates = []
-decpat_updates = []
-poshcw_updates = []
-lastpos_updates = [] # *** JULIA ADD 1/24 ***
-
-#                   0             1                2                3               4
-ltcf_fields = ['UniqueID', 'Facility_Name', 'Facility_Type', 'Resolved_Y_N', 'Date_Resolved',
-          #        5                    6                  7                     8
-          'Positive_Patients', 'Deceased_Patients', 'Positive_HCWs', 'Postive_Patients_Desc', 
-          #         9                    10                      11
-          'Dashboard_Display', 'Dashboard_Display_Cat', 'LastPos_Resident']
-cursor_time = time.time()
-with arcpy.da.UpdateCursor(ltcf_service, ltcf_fields) as ucursor:
-    print("Looping through ltcf rows to make updates ...")
-    for row in ucursor:
-        if row[0] is None:
-            print(f'Found row without UniqueID: {row[1]}, skipping...')
-            continue
-        used = False
-        # select row of updates dataframe where UniqueID == UniqueID in hosted feature layer
-        temp_df = updates.loc[updates['UniqueID'] == row[0]]
-        
-        # Check if resolved status has changed
-        resolved_status = temp_df.iloc[0]['Resolved_Y_N']
-        status_check = resolved_status.upper()
-        if row[3] != status_check:
-            print(f"    {row[0]}:    'Resolved_Y_N' field does not match    {row[3]}   {temp_df.iloc[0]['Resolved_Y_N']}")
-            row[3] = status_check
-            ltcf_count += 1; used = True
-            res_updates.append(row[0])
-        
-        # Check if resolved date has changed
-        if row[4] != str(temp_df.iloc[0]['Date_Resolved']):
-            if row[4] is None and str(temp_df.iloc[0]['Date_Resolved']) == 'nan':
-                pass
-            else:
-                print(f"    {row[0]}:    'Date_Resolved' field does not match   {row[4]}   {temp_df.iloc[0]['Date_Resolved']}")
-                row[4] = temp_df.iloc[0]['Date_Resolved']
-                ltcf_count += 1; used = True
-                resdate_updates.append(row[0])
-        
-        # Check if positive patients have changed
-        if row[5] != temp_df.iloc[0]['Positive_Patients']:
-            if row[5] == 0 and temp_df.iloc[0]['Positive_Patients'] == 9999:
-                pass
-            elif row[5] != 0 and temp_df.iloc[0]['Positive_Patients'] == 9999:
-                print(f"    {row[0]}:    'Positive_Patients' field does not match   {row[5]}   {temp_df.iloc[0]['Positive_Patients']}   setting value to 0")
-                row[5] = 0
-                ltcf_count += 1; used = True
-                pospat_updates.append(row[0])
-            else:
-                print(f"    {row[0]}:    'Positive_Patients' field does not match   {row[5]}   {temp_df.iloc[0]['Positive_Patients']}")
-                row[5] = temp_df.iloc[0]['Positive_Patients']
-                ltcf_count += 1; used = True
-                pospat_updates.append(row[0])
-                
-        # Check if deceased patients have changed
-        if row[6] != temp_df.iloc[0]['Deceased_Patients']:
-            if row[6] == 0 and temp_df.iloc[0]['Deceased_Patients'] == 9999:
-                pass
-            elif row[6] != 0 and temp_df.iloc[0]['Deceased_Patients'] == 9999:
-                print(f"    {row[0]}:    'Deceased_Patients' field does not match   {row[6]}   {temp_df.iloc[0]['Deceased_Patients']}   setting value to 0")
-                row[6] = 0
-                ltcf_count += 1; used = True
-                pospat_updates.append(row[0])
-            else:
-                print(f"    {row[0]}:    'Deceased_Patients' field does not match   {row[6]}   {temp_df.iloc[0]['Deceased_Patients']}")
-                row[6] = temp_df.iloc[0]['Deceased_Patients']
-                ltcf_count += 1; used = True
-                decpat_updates.append(row[0])
-        
-        # Check if positive HCWs have changed
-        if row[7] != temp_df.iloc[0]['Positive_HCWs']:
-            if row[7] == 0 and temp_df.iloc[0]['Positive_HCWs'] == 9999:
-                pass
-            elif row[7] != 0 and temp_df.iloc[0]['Positive_HCWs'] == 9999:
-                print(f"    {row[0]}:    'Positive_HCWs' field does not match   {row[7]}   {temp_df.iloc[0]['Positive_HCWs']}   setting value to 0")
-                row[7] = 0
-                ltcf_count += 1; used = True
-                pospat_updates.append(row[0])
-            else:
-                print(f"    {row[0]}:    'Positive_HCWs' field does not match   {row[7]},   {temp_df.iloc[0]['Positive_HCWs']}")
-                row[7] = temp_df.iloc[0]['Positive_HCWs']
-                ltcf_count += 1; used = True
-                poshcw_updates.append(row[0])
-                
-        # *** JULIA ADD 1/24 ***     
-        # Check if last positive resident has changed
-        if row[11] != temp_df.iloc[0]['LastPos_Resident']:
-            if row[11] is None and str(temp_df.iloc[0]['LastPos_Resident']) == 'NaT':
-                pass
-            #elif  row[11] < datetime.datetime(2020,1,1,23,59,59,99):
-                #row[11] = None 
-            else:
-                print(f"    {row[0]}:    'LastPos_Resident' field does not match   {row[11]}   {temp_df.iloc[0]['LastPos_Resident']}")
-                row[11] = temp_df.iloc[0]['LastPos_Resident']
-                ltcf_count += 1; used = True
-                lastpos_updates.append(row[0])
-        
-        # Check if positive patient description needs updated
-        # This updated function removes the 'COVID-only' and 'COVID-unit' facility types and bases category on cumulative resident cases and not just those housed on site
-        if (temp_df.iloc[0]['Positive_Patients'] in (0, 9999) and temp_df.iloc[0]['Positive_HCWs'] in (0, 9999)):
-            row[8] = 'Zero cases'
-        elif temp_df.iloc[0]['Positive_Patients'] >= 21 and temp_df.iloc[0]['Positive_Patients'] < 9999:
-            row[8] = 'More than 20'
-        elif temp_df.iloc[0]['Positive_Patients'] >= 11 and temp_df.iloc[0]['Positive_Patients'] <= 20:
-            row[8] = '11 to 20'
-        elif temp_df.iloc[0]['Positive_Patients'] >= 5 and temp_df.iloc[0]['Positive_Patients'] <= 10:
-            row[8] = '5 to 10'
-        elif temp_df.iloc[0]['Positive_Patients'] >= 1 and temp_df.iloc[0]['Positive_Patients'] < 5:
-            row[8] = '1 to 4'
-        elif temp_df.iloc[0]['Positive_Patients'] in (0, 9999) and temp_df.iloc[0]['Positive_HCWs'] not in (0, 9999):
-            row[8] = 'No Resident Cases'
-        else:
-            print(f"    {row[0]}:    Unable to determine 'Postive_Patients_Desc', current value: {row[8]}")
-
-        # Check if the facility needs to be displayed on the dashboard
-        if temp_df.iloc[0]['Facility_Type'] in ('Assisted Living', 'Nursing Home', 'Intermed Care/Intel Disabled', 'COVID-unit', 'COVID-only'):
-            if (temp_df.iloc[0]['Positive_Patients'] not in (0, 9999) or temp_df.iloc[0]['Positive_HCWs'] not in (0, 9999)) and temp_df.iloc[0]['Resolved_Y_N'] == 'N':
-                row[9] = 'Y'
-                print(f"    {row[0]}: has positive patients or HCWs, adding to dashboard display")
-            else:
-                row[9] = 'N'
-        else:
-            row[9] = 'N'
-
-        # Check if dashboard display category needs to be updated, used for sorting the list of facilities with active outbreaks
-        if (temp_df.iloc[0]['Positive_Patients'] in (0, 9999) and temp_df.iloc[0]['Positive_HCWs'] in (0, 9999)):
-            row[10] = 9999
-        elif temp_df.iloc[0]['Positive_Patients'] >= 21 and temp_df.iloc[0]['Positive_Patients'] < 9999:
-            row[10] = 1
-        elif temp_df.iloc[0]['Positive_Patients'] >= 11 and temp_df.iloc[0]['Positive_Patients'] <= 20:
-            row[10] = 2
-        elif temp_df.iloc[0]['Positive_Patients'] >= 5 and temp_df.iloc[0]['Positive_Patients'] <= 10:
-            row[10] = 3
-        elif temp_df.iloc[0]['Positive_Patients'] >= 1 and temp_df.iloc[0]['Positive_Patients'] < 5:
-            row[10] = 4
-        elif temp_df.iloc[0]['Positive_Patients'] in (0, 9999) and temp_df.iloc[0]['Positive_HCWs'] not in (0, 9999):
-            row[10] = 5
+    else:
+        # Prompt user to continue to change detection
+        resp2 = input("\n    No new rows to geocode. Continue to change detection?    (y/n) \n")
+        if resp2.lower() == 'n':
+            sys.exit(0)
+
+
+    # 4) Check for differences in key field and update their attributes accordingly
+    #                   0             1                2                3               4
+    ltcf_fields = ['UniqueID', 'Facility_Name', 'Facility_Type', 'Resolved_Y_N', 'Date_Resolved',
+              #        5                    6                  7                     8
+              'Positive_Patients', 'Deceased_Patients', 'Positive_HCWs', 'Postive_Patients_Desc', 
+              #         9                    10                      11
+              'Dashboard_Display', 'Dashboard_Display_Cat', 'LastPos_Resident']
+    cursor_time = time.time()
+    print("Comparing ltcf rows to the sheet ...")
+    ltcf_rows = pd.DataFrame.from_records(store.search(ltcf_service, ['OID@'] + ltcf_fields), columns=['OID@'] + ltcf_fields)
+    no_id = ltcf_rows['UniqueID'].isna()
+    for name in ltcf_rows.loc[no_id, 'Facility_Name']:
+        print(f'Found row without UniqueID: {name}, skipping...')
+
+    # Join the layer to the sheet on UniqueID once, 'changed' flags the fields that differ for each facility
+    before, after, changed = ltcf_metrics.detect_changes(ltcf_rows[~no_id], sheet_facilities)
+    for oid, field in changed.stack()[changed.stack()].index:
+        print(f"    {after.at[oid, 'UniqueID']}:    '{field}' field does not match    {before.at[oid, field]}   {after.at[oid, field]}")
+    ltcf_count = int(changed.values.sum())
+    sheet_changes = ltcf_metrics.changed_ids(after, changed)
+
+    # The description and dashboard fields are calculated from the sheet for every facility at once
+    # The bands and facility types they use are in ltcf_metrics.dashboard_bands and dashboard_facility_types
+    sheet_rows = sheet_facilities.set_index('UniqueID').reindex(after['UniqueID']).set_axis(after.index)
+    derived = ltcf_metrics.classify_facilities(sheet_rows, current=after)
+    for uid in after.loc[ltcf_metrics.dashboard_band(sheet_rows) < 0, 'UniqueID']:
+        print(f"    {uid}:    Unable to determine 'Postive_Patients_Desc' and 'Dashboard_Display_Cat'")
+    for uid in after.loc[derived['Dashboard_Display'] == 'Y', 'UniqueID']:
+        print(f"    {uid}: has positive patients or HCWs, adding to dashboard display")
+
+    # Only facilities with a field (from the sheet or calculated) that differs from the layer are written,
+    # and only the fields that differ, so unchanged rows don't get a new EditDate
+    after, changed = ltcf_metrics.merge_derived(before, after, changed, derived)
+    ltcf_edits = ltcf_metrics.edit_set(after, changed)
+    failed = store.update_rows(ltcf_service, ltcf_edits)
+    if failed:
+        print(f'Failed to update LTCF rows with ObjectIDs: {failed}')
+
+    # Print out information about updates
+    print("Time elapsed in change detection and update: {:.2f}s".format(time.time() - cursor_time))
+    print(f'Total count of LTCF Data updates is: {ltcf_count}')
+    for field, ids in sheet_changes.items():
+        print(f'{field} updates: {len(ids)}    {ids}')
+    print(f'LTCF rows scanned: {ltcf_rows.shape[0]}    rows written: {len(ltcf_edits) - len(failed)}    '
+          f'({(len(ltcf_edits) - len(failed)) / max(ltcf_rows.shape[0], 1):.1%} of rows)')
+
+
+    # Print out dashboard totals based on this update
+    # Totals are counted from the facility rows read in step 4 with this run's edits applied, rather than
+    # searching the layer again.  Run with '--verify-totals' to also count them from the layer and compare.
+    verify_totals = '--verify-totals' in sys.argv
+    totals = ltcf_metrics.daily_totals(ltcf_metrics.written_layer(ltcf_rows, after, failed))
+    print('Total investigations:      ' + str(totals['investigations']))
+    print('Total outbreaks:        ' + str(totals['outbreaks']))
+    print('Total resolved:        ' + str(totals['resolved']))
+    print('Total positive patients:      ' + str(totals['positive_patients']))
+    print('Total deceased patients:      ' + str(totals['deceased_patients']))
+    print('Total positive HCWs:    ' + str(totals['positive_hcws']))
+    print('Total facilities with active cases:     ' + str(totals['active']))
+    print('Total more than 20:    ' + str(totals['more_than_20']))
+    print('Total 11 to 20:     ' + str(totals['eleven_to_20']))
+    print('Total 5 to 10:    ' + str(totals['five_to_ten']))
+    print('Total 1 to 4:    ' + str(totals['one_to_four']))
+    print('Total No Resident Cases:     ' + str(totals['no_resident_cases']) + '\n')
+    if verify_totals:
+        layer_totals = ltcf_metrics.daily_totals_loop(store.search(ltcf_service, ltcf_metrics.totals_fields,
+                                                                   ltcf_metrics.totals_query))
+        mismatched = {name: (int(total), int(layer_totals[name])) for name, total in totals.items()
+                      if total != layer_totals[name]}
+        if mismatched:
+            print(f'Totals (counted, from layer) that do not match the layer: {mismatched}')
         else:
-            print(f"    {row[0]}:    Unable to determine 'Dashboard_Display_Cat'")
-
-        ucursor.updateRow(row)
-        if used:
-            unique_updates.append(row[0])
-
-# Print out information about updates
-print("Time elapsed in update cursor: {:.2f}s".format(time.time() - cursor_time))
-print(f'Total count of LTCF Data updates is: {ltcf_count}')
-print(f'Resolved_Y_N updates: {len(res_updates)}    {res_updates}')
-print(f'Date_Resolved updates: {len(resdate_updates)}    {resdate_updates}')
-print(f'Positive_Patients updates: {len(pospat_updates)}    {pospat_updates}')
-print(f'Deceased_Patients updates: {len(decpat_updates)}    {decpat_updates}')
-print(f'Positive_HCWs updates: {len(poshcw_updates)}    {poshcw_updates}')
-
-
-# Print out dashboard totals based on this update
-#               0               1                   2                   3                   4                   5                           6
-fields = ['Facility_Type', 'Resolved_Y_N', 'Positive_Patients', 'Deceased_Patients', 'Positive_HCWs', 'Postive_Patients_Desc', 'Dashboard_Display_Cat']
-query = '"Facility_Type" IN (\'Nursing Home\', \'Assisted Living\', \'Intermed Care/Intel Disabled\')'
-def find_daily_values(ltcf_fc):
-    with arcpy.da.SearchCursor(ltcf_fc, fields, query) as cursor:
-        facility_types = ['Nursing Home', 'Assisted Living', 'Intermed Care/Intel Disabled']
-        investigations = 0
-        outbreaks = 0
-        positive_patients = 0
-        deceased_patients = 0
-        positive_hcws = 0
-        more_than_20 = 0
-        eleven_to_20 = 0
-        five_to_ten = 0
-        one_to_four = 0
-        no_resident_cases = 0
-        resolved = 0
-        for row in cursor:
-            if row[0] in facility_types:
-                investigations += 1
-            if row[6] != 9999:
-                outbreaks += 1
-            if row[1] == 'Y' and row[6] != 9999:
-                resolved += 1
-            positive_patients += row[2]
-            deceased_patients += row[3]
-            positive_hcws += row[4]
-            if row[1] == 'N' and row[5] == 'More than 20':
-                more_than_20 += 1
-            elif row[1] == 'N' and row[5] == '11 to 20':
-                eleven_to_20 += 1
-            elif row[1] == 'N' and row[5] == '5 to 10':
-                five_to_ten += 1
-            elif row[1] == 'N' and row[5] == '1 to 4':
-                one_to_four += 1
-            elif row[1] == 'N' and row[5] == 'No Resident Cases':
-                no_resident_cases += 1
-        print('Total investigations:      ' + str(investigations))
-        print('Total outbreaks:        ' + str(outbreaks))
-        print('Total resolved:        ' + str(resolved))
-        print('Total positive patients:      ' + str(positive_patients))
-        print('Total deceased patients:      ' + str(deceased_patients))
-        print('Total positive HCWs:    ' + str(positive_hcws))
-        facilities_with_active_cases = more_than_20 + eleven_to_20 + five_to_ten + one_to_four + no_resident_cases
-        print('Total facilities with active cases:     ' + str(facilities_with_active_cases))
-        print('Total more than 20:    ' + str(more_than_20))
-        print('Total 11 to 20:     ' + str(eleven_to_20))
-        print('Total 5 to 10:    ' + str(five_to_ten))
-        print('Total 1 to 4:    ' + str(one_to_four))
-        print('Total No Resident Cases:     ' + str(no_resident_cases) + '\n')
-        arcpy.management.SelectLayerByAttribute(ltcf_fc, 'CLEAR_SELECTION')
-        return investigations, outbreaks, resolved, positive_patients, deceased_patients, positive_hcws, facilities_with_active_cases, more_than_20, eleven_to_20, five_to_ten, one_to_four, no_resident_cases
-
-total_investigations, total_outbreaks, total_outbreaks_resolved, total_positive_residents, total_deceased_residents, total_positive_HCWs, total_facilities_with_active_cases, count_more_than_20, count_11_to_20, count_5_to_10, count_1_to_4, count_no_resident_cases = find_daily_values(ltcf_service)
-
-# 5) APPEND MOST RECENT VALUES TO THE LTCF EVENTS BY DAY TABLE
-insert_fields = ['Date', 'Total_Investigations', 'Total_Outbreaks', 'Total_Outbreaks_Resolved',
-                'Total_Positive_Residents', 'Total_Deceased_Residents', 'Total_Positive_HCWs',
-                'Today_Facilities_Active_Cases', 'Today_Count_More_than_20', 'Today_Count_11_to_20',
-                'Today_Count_5_to_10', 'Today_Count_1_to_4', 'Today_Count_No_Res_Cases', 'SHAPE@XY']
-events_by_day_xy = (40, -111)
-insert_values = [(dt.datetime.now(), total_investigations, total_outbreaks, total_outbreaks_resolved,
-                total_positive_residents, total_deceased_residents, total_positive_HCWs,
-                total_facilities_with_active_cases, count_more_than_20, count_11_to_20,
-                count_5_to_10, count_1_to_4, count_no_resident_cases, events_by_day_xy)]
-with arcpy.da.InsertCursor(ltcf_events_by_day, insert_fields) as cursor:
-  for row in insert_values:
-      cursor.insertRow(row)
-print('Inserted values into LTCF events by day table...')
+            print('Totals match the layer')
+
+    # 5) APPEND MOST RECENT VALUES TO THE LTCF EVENTS BY DAY TABLE
+    insert_fields = ['Date', 'Total_Investigations', 'Total_Outbreaks', 'Total_Outbreaks_Resolved',
+                    'Total_Positive_Residents', 'Total_Deceased_Residents', 'Total_Positive_HCWs',
+                    'Today_Facilities_Active_Cases', 'Today_Count_More_than_20', 'Today_Count_11_to_20',
+                    'Today_Count_5_to_10', 'Today_Count_1_to_4', 'Today_Count_No_Res_Cases', 'SHAPE@XY']
+    events_by_day_xy = (40, -111)
+    insert_values = [(dt.datetime.now(), *[int(totals[name]) for name in ltcf_metrics.total_names], events_by_day_xy)]
+    failed = store.insert_rows(ltcf_events_by_day, insert_fields, insert_values)
+    if failed:
+        print(f'Failed to insert {len(failed)} of {len(insert_values)} rows into LTCF events by day table:')
+        for i, error in failed:
+            print(f'    {dict(zip(insert_fields, insert_values[i]))}: {error}')
+    else:
+        print('Inserted values into LTCF events by day table...')
 
 
 # 6) CALCULATE DAILY AND CUMULATIVE NUBMERS IN PANDAS DATAFRAME
@@ -518,160 +334,76 @@ ltcf_events_by_day_keep_fields = ['Date', 'Total_Investigations',
                     'Today_Positive_Residents', 'Today_Deceased_Residents', 'Today_Positive_HCWs', 'Today_Outbreaks',
                     'Today_Outbreaks_Resolved']
 
-# Delete in-memory table that will be used (if it already exists)
-if arcpy.Exists('in_memory\\temp_table'):
-    print("Deleting 'in_memory\\temp_table' ...")
-    arcpy.Delete_management('in_memory\\temp_table')
-    time.sleep(3)
-
 # Convert counts_by_day into pandas dataframe (table --> numpy array --> dataframe)
-arcpy.conversion.TableToTable(ltcf_events_by_day, 'in_memory', 'temp_table')
-day_arr = arcpy.da.TableToNumPyArray('in_memory\\temp_table', ltcf_events_by_day_keep_fields, null_value=0)
-day_df = pd.DataFrame(data=day_arr)
-
-# Convert string entries of 'None' to zeros ('0')
-mask = day_df.applymap(lambda x: x == 'None')
-cols = day_df.columns[(mask).any()]
-for col in day_df[cols]:
-    day_df.loc[mask[col], col] = '0'
-
-# Sort data ascending so most recent dates are at the bottom (highest index)
-day_df.head()
-day_df.sort_values('Date', inplace=True, ascending=True)
-day_df.head().to_string()
-day_df['Date'] = pd.to_datetime(day_df['Date']).dt.normalize()
+day_df = store.read_table(ltcf_events_by_day, ltcf_events_by_day_keep_fields, null_value=0)
+
+# Cast columns to compact types, string entries of 'None' are converted to zeros
+schemas.apply_schema(day_df, schemas.ltcf_events_by_day_schema)
+
+# Sort data ascending so most recent dates are at the bottom (highest index), with one row per day
+# A day the script ran more than once on has several rows, the last one written is used
+day_df = ltcf_metrics.one_row_per_day(day_df)
 
 # Load test data during the test process
 # Rename variables below back to day_df after done testing
 # test_df = pd.read_csv(os.path.join(work_dir, 'by_day_testing.csv'))
 
-# Calculate daily increases using the pandas diff function
-# If any daily increases are negative (due to false positives or double-counting),
-# set increase to 0
-day_df['Today_Positive_Residents'] = day_df['Total_Positive_Residents'].diff().apply(lambda x: 0 if x < 0 else x)
-day_df['Today_Deceased_Residents'] = day_df['Total_Deceased_Residents'].diff().apply(lambda x: 0 if x < 0 else x)
-day_df['Today_Positive_HCWs'] = day_df['Total_Positive_HCWs'].diff().apply(lambda x: 0 if x < 0 else x)
-day_df['Today_Outbreaks'] = day_df['Total_Outbreaks'].diff().apply(lambda x: 0 if x < 0 else x)
-day_df['Today_Outbreaks_Resolved'] = day_df['Total_Outbreaks_Resolved'].diff().apply(lambda x: 0 if x < 0 else x)
-day_df['Today_Investigations'] = day_df['Total_Investigations'].diff().apply(lambda x: 0 if x < 0 else x)
-day_df['Today_Fac_Active_Cases_7_Day_Av'] = day_df['Today_Facilities_Active_Cases'].rolling(window=7).mean()
-day_df['Today_Outbreaks_7_Day_Avg'] = day_df['Today_Outbreaks'].rolling(window=7).mean()
-day_df['Today_Outbreaks_Res_7_Day_Avg'] = day_df['Today_Outbreaks_Resolved'].rolling(window=7).mean()
-day_df['Total_Positive_Res_7_Day_Avg'] = day_df['Total_Positive_Residents'].rolling(window=7).mean()
-day_df['Total_Deceased_Res_7_Day_Avg'] = day_df['Total_Deceased_Residents'].rolling(window=7).mean()
-day_df['Total_Positive_HCWs_7_Day_Avg'] = day_df['Total_Positive_HCWs'].rolling(window=7).mean()
-day_df['Today_Positive_Res_7_Day_Avg'] = day_df['Today_Positive_Residents'].rolling(window=7).mean()
-day_df['Today_Deceased_Res_7_Day_Avg'] = day_df['Today_Deceased_Residents'].rolling(window=7).mean()
-day_df['Today_Positive_HCWs_7_Day_Avg'] = day_df['Today_Positive_HCWs'].rolling(window=7).mean()
-day_df['Fac_More_than_20_7_Day_Avg'] = day_df['Today_Count_More_than_20'].rolling(window=7).mean()
-day_df['Fac_11_to_20_7_Day_Avg'] = day_df['Today_Count_11_to_20'].rolling(window=7).mean()
-day_df['Fac_5_to_10_7_Day_Avg'] = day_df['Today_Count_5_to_10'].rolling(window=7).mean()
-day_df['Fac_1_to_4_7_Day_Avg'] = day_df['Today_Count_1_to_4'].rolling(window=7).mean()
-day_df['Fac_No_Res_Cases_7_Day_Avg'] = day_df['Today_Count_No_Res_Cases'].rolling(window=7).mean()
+# Calculate daily increases (negative increases are set to 0) and 7 day averages
+# The fields and how each is calculated are in ltcf_metrics.events_metrics
+day_df = ltcf_metrics.calc_events_metrics(day_df)
 
 print(day_df)
 
 
 # 7a) UPDATE ***ONLY TODAY'S ROW*** IN COUNTS BY DAY TABLE WITH NEW NUMBERS
+# Only rows around today's date are read from the service, then today's row is sent in one batched edit
 start_time = time.time()
 table_count = 0
-#                   0           1                           2
-table_fields = ['Date', 'Today_Positive_Residents', 'Today_Deceased_Residents', 
-                #       3                   4                   5                               6
-                'Today_Positive_HCWs', 'Today_Outbreaks', 'Today_Outbreaks_Resolved', 'Today_Investigations',
-                #             7                               8                              9
-                'Today_Fac_Active_Cases_7_Day_Av','Today_Outbreaks_7_Day_Avg','Today_Outbreaks_Res_7_Day_Avg',
-                #               10                                  11                                   12
-                'Total_Positive_Res_7_Day_Avg','Total_Deceased_Res_7_Day_Avg','Total_Positive_HCWs_7_Day_Avg',
-                #            13                               14                            15
-                'Today_Positive_Res_7_Day_Avg','Today_Deceased_Res_7_Day_Avg','Today_Positive_HCWs_7_Day_Avg',
-                #               16                      17                          18
-                'Fac_More_than_20_7_Day_Avg', 'Fac_11_to_20_7_Day_Avg', 'Fac_5_to_10_7_Day_Avg',
-                #           19                      20
-                'Fac_1_to_4_7_Day_Avg', 'Fac_No_Res_Cases_7_Day_Avg']
-
-with arcpy.da.UpdateCursor(ltcf_events_by_day, table_fields) as ucursor:
-    print("Looping through rows to make updates ...")
-    for row in ucursor:
-        if dt.datetime.now().date() == row[0].date():
-            print(row[0])
+table_fields = ltcf_metrics.events_metric_fields
+
+# Index the dataframe by date for the lookups below (one row per date, so each lookup is a single row)
+events_by_date = day_df.set_index('Date')
+if not backfill_mode:
+    table_edits = {}
+    where = feature_service.day_where('Date', dt.datetime.now().date())
+    print("Looping through today's rows to build updates ...")
+    for row in store.search(ltcf_events_by_day, ['OID@', 'Date'], where):
+        if dt.datetime.now().date() == row[1].date():
+            print(row[1])
             # select row of dataframe where date == date in hosted 'ltcf events by day' table
-            d = row[0].strftime('%Y-%m-%d')
-            temp_df = day_df.loc[day_df['Date'] == d].reset_index()
-            row[1] = temp_df.iloc[0]['Today_Positive_Residents']
-            row[2] = temp_df.iloc[0]['Today_Deceased_Residents']
-            row[3] = temp_df.iloc[0]['Today_Positive_HCWs']
-            row[4] = temp_df.iloc[0]['Today_Outbreaks']
-            row[5] = temp_df.iloc[0]['Today_Outbreaks_Resolved']
-            row[6] = temp_df.iloc[0]['Today_Investigations']
-            row[7] = temp_df.iloc[0]['Today_Fac_Active_Cases_7_Day_Av']
-            row[8] = temp_df.iloc[0]['Today_Outbreaks_7_Day_Avg']
-            row[9] = temp_df.iloc[0]['Today_Outbreaks_Res_7_Day_Avg']
-            row[10] = temp_df.iloc[0]['Total_Positive_Res_7_Day_Avg']
-            row[11] = temp_df.iloc[0]['Total_Deceased_Res_7_Day_Avg']
-            row[12] = temp_df.iloc[0]['Total_Positive_HCWs_7_Day_Avg']
-            row[13] = temp_df.iloc[0]['Today_Positive_Res_7_Day_Avg']
-            row[14] = temp_df.iloc[0]['Today_Deceased_Res_7_Day_Avg']
-            row[15] = temp_df.iloc[0]['Today_Positive_HCWs_7_Day_Avg']
-            row[16] = temp_df.iloc[0]['Fac_More_than_20_7_Day_Avg']
-            row[17] = temp_df.iloc[0]['Fac_11_to_20_7_Day_Avg']
-            row[18] = temp_df.iloc[0]['Fac_5_to_10_7_Day_Avg']
-            row[19] = temp_df.iloc[0]['Fac_1_to_4_7_Day_Avg']
-            row[20] = temp_df.iloc[0]['Fac_No_Res_Cases_7_Day_Avg']
+            temp_row = events_by_date.loc[pd.Timestamp(row[1].date())]
+            table_edits[row[0]] = temp_row[table_fields].to_dict()
             table_count += 1
-            ucursor.updateRow(row)
-print(f'Total count of LTCF Events By Day Table updates is: {table_count}')
-
-# # 7b) UPDATE ***ALL ROWS*** IN COUNTS BY DAY TABLE WITH NEW NUMBERS
-# # Should only need to run this once to make the calculations for all previous rows
-# start_time = time.time()
-# table_count = 0
-# #                   0           1                           2
-# table_fields = ['Date', 'Today_Positive_Residents', 'Today_Deceased_Residents', 
-#                 #       3                   4                   5                               6
-#                 'Today_Positive_HCWs', 'Today_Outbreaks', 'Today_Outbreaks_Resolved', 'Today_Investigations',
-#                 #               7                               8                              9
-#                 'Today_Fac_Active_Cases_7_Day_Av','Today_Outbreaks_7_Day_Avg','Today_Outbreaks_Res_7_Day_Avg',
-#                 #               10                                  11                                   12
-#                 'Total_Positive_Res_7_Day_Avg','Total_Deceased_Res_7_Day_Avg','Total_Positive_HCWs_7_Day_Avg',
-#                 #            13                               14                            15
-#                 'Today_Positive_Res_7_Day_Avg','Today_Deceased_Res_7_Day_Avg','Today_Positive_HCWs_7_Day_Avg',
-#                 #               16                      17                          18
-#                 'Fac_More_than_20_7_Day_Avg', 'Fac_11_to_20_7_Day_Avg', 'Fac_5_to_10_7_Day_Avg',
-#                 #           19                      20
-#                 'Fac_1_to_4_7_Day_Avg', 'Fac_No_Res_Cases_7_Day_Avg']
-
-# with arcpy.da.UpdateCursor(ltcf_events_by_day, table_fields) as ucursor:
-#     print("Looping through rows to make updates ...")
+    failed = store.update_rows(ltcf_events_by_day, table_edits)
+    if failed:
+        print(f'Failed to update LTCF events by day rows with ObjectIDs: {failed}')
+    print(f'Total count of LTCF Events By Day Table updates is: {table_count - len(failed)}')
+
+# 7b) UPDATE ***ALL ROWS*** IN COUNTS BY DAY TABLE WITH NEW NUMBERS
+# Only runs in backfill mode, rows are written in chunks by date range, several chunks at a time
+if backfill_mode:
+    oid_df = store.read_table(ltcf_events_by_day, ['OID@', 'Date'])
+    oid_df.rename(columns={'OID@': 'OID'}, inplace=True)
+    oid_df['Date'] = pd.to_datetime(oid_df['Date']).dt.normalize()
     
-#     for row in ucursor:
-#         print(row[0])
-#         # select row of dataframe where date == date in hosted 'ltcf events by day' table
-#         d = row[0].strftime('%Y-%m-%d')
-#         temp_df = day_df.loc[day_df['Date'] == d].reset_index()
-#         # row[1] = temp_df.iloc[0]['Today_Positive_Residents']
-#         # row[2] = temp_df.iloc[0]['Today_Deceased_Residents']
-#         # row[3] = temp_df.iloc[0]['Today_Positive_HCWs']
-#         # row[4] = temp_df.iloc[0]['Today_Outbreaks']
-#         # row[5] = temp_df.iloc[0]['Today_Outbreaks_Resolved']
-#         # row[6] = temp_df.iloc[0]['Today_Investigations']
-#         row[7] = temp_df.iloc[0]['Today_Fac_Active_Cases_7_Day_Av']
-#         row[8] = temp_df.iloc[0]['Today_Outbreaks_7_Day_Avg']
-#         row[9] = temp_df.iloc[0]['Today_Outbreaks_Res_7_Day_Avg']
-#         row[10] = temp_df.iloc[0]['Total_Positive_Res_7_Day_Avg']
-#         row[11] = temp_df.iloc[0]['Total_Deceased_Res_7_Day_Avg']
-#         row[12] = temp_df.iloc[0]['Total_Positive_HCWs_7_Day_Avg']
-#         row[13] = temp_df.iloc[0]['Today_Positive_Res_7_Day_Avg']
-#         row[14] = temp_df.iloc[0]['Today_Deceased_Res_7_Day_Avg']
-#         row[15] = temp_df.iloc[0]['Today_Positive_HCWs_7_Day_Avg']
-#         row[16] = temp_df.iloc[0]['Fac_More_than_20_7_Day_Avg']
-#         row[17] = temp_df.iloc[0]['Fac_11_to_20_7_Day_Avg']
-#         row[18] = temp_df.iloc[0]['Fac_5_to_10_7_Day_Avg']
-#         row[19] = temp_df.iloc[0]['Fac_1_to_4_7_Day_Avg']
-#         row[20] = temp_df.iloc[0]['Fac_No_Res_Cases_7_Day_Avg']
-#         table_count += 1
-#         ucursor.updateRow(row)
-# print(f'Total count of LTCF Events By Day Table updates is: {table_count}')
+    # Match hosted rows to the recalculated rows by date (day_df has one row per date, see step 6)
+    # Only the 7 day averages are rewritten, the hosted daily increases are kept (see ltcf_metrics.events_backfill_fields)
+    table_fields = ltcf_metrics.events_backfill_fields
+    edits_df = oid_df.merge(day_df[['Date'] + table_fields], on='Date', how='inner', validate='many_to_one')
+    if edits_df.shape[0] < oid_df.shape[0]:
+        print(f'{oid_df.shape[0] - edits_df.shape[0]} hosted rows have no recalculated numbers, skipping them')
+    
+    def write_chunk(chunk):
+        edits = chunk.set_index('OID')[table_fields].to_dict('index')
+        return store.update_rows(ltcf_events_by_day, edits)
+    
+    chunks = backfill.plan_chunks(edits_df, 'Date')
+    table_count, failed_chunks, error_chunks = backfill.run_backfill(chunks, write_chunk, backfill.Checkpoint(backfill_file))
+    if failed_chunks:
+        print(f'Chunks with rows that failed to write: {failed_chunks}    rerun with --backfill to retry them')
+    if error_chunks:
+        print(f'Chunks that raised an error: {error_chunks}    fix the error above, then rerun with --backfill')
+    print(f'Total count of LTCF Events By Day Table updates is: {table_count}')
 
 # 8) Update the Case Fatality Ratio for LTCFs compared with statewide cases and deaths
 # Download the HAI Case Fatality Rates spreadsheet as a Microsoft Excel (.xlsx)
@@ -681,67 +413,33 @@ print("Begin case fatality rate data update...")
 utah_cases = pd.read_excel('Case_Fatality_Rates_latest.xlsx', sheet_name='Utah')
 ltcf_cases = pd.read_excel('Case_Fatality_Rates_latest.xlsx', sheet_name='Resident')
 
-# Change the column headers for the resident cases to remove underscores
-ltcf_cases.columns = ['date', 'LTCF_Daily_Deaths', 'LTCF_Cumulative_Deaths']
-# Remove the first row from the ltcf_cases data frame with a blank data
-ltcf_cases.dropna(subset=['date'], inplace=True)
-# Remove the 'Grand Total' entry at the end of the ltcf_cases data frame
-ltcf_cases = ltcf_cases[ltcf_cases.date != 'Grand Total']
-# the existing 'date' column for the ltcf_cases comes in as a string because of the Grand Total
-# calculate a new column to join dates in the statewide case data with the ltcf case data
-ltcf_cases['join_date'] = ltcf_cases['date'].astype('datetime64')
-
-# The statewide case data has data for every day since the first confirmed case, while the 
-# ltcf data only records dates where ltcf residents died.  Join the two data frames so that
-# the dates line up.
-combined = pd.merge(utah_cases, ltcf_cases, left_on='date', right_on='join_date', how='left')
-
-# Forward fill the ltcf cumulative deaths to account for all of the days not included in the
-# ltcf data (days where an ltcf resident didn't die).  Forward fill carries the previous cumulative
-# total to the next entry if the next entry is null.
-combined['LTCF_Cumulative_Deaths'].fillna(method='ffill', inplace=True)
-
-# Fill in all of the null values for ltcf daily deaths with 0 (days a resident did not die)
-combined['LTCF_Daily_Deaths'].fillna(0, inplace=True)
-
-# Get a list of dates from the combined date frame to use for comparison against dates in ArcGIS
-dates = combined['date_x']
-
-# Use the datetime isoformat() method to convert date timestamps into a date format like 'yyyy-mm-dd'
-iso_dates = []
-for d in dates:
-    iso_dates.append(d.date().isoformat())
-
-# Loop through all of the dates in the data set to update cases and deaths.  Calculate these for
-# all rows because some cases and death data are back filled over time.
-cfr_table_count = 0
-#                   0           1                           2
-cfr_table_fields = ['Date', 'Total_Positive_Residents', 'UT_Cumulative_Cases', 
-                #       3                          4                                5               6
-                'UT_Cumulative_Deaths', 'Corrected_Res_Cumulative_Deaths', 'LTCF_DeathRatio', 'UT_DeathRatio']
-                
-
-with arcpy.da.UpdateCursor(ltcf_events_by_day, cfr_table_fields) as ucursor:
-    print("Looping through rows to make updates ...")
-    
-    for row in ucursor:
-        # Run the loop for every day except today because the statewide cases usually aren't updated for
-        # the current day
-        # if dt.datetime.now().date() != row[0].date():
-        if row[0].date().isoformat() in iso_dates:
-            print(row[0])
-            # select row of dataframe where date == date in hosted 'ltcf events by day' table
-            d = row[0].strftime('%Y-%m-%d')
-            temp_df = combined.loc[combined['date_x'] == d].reset_index()
-            row[2] = temp_df.iloc[0]['Cumulative_cases']
-            row[3] = temp_df.iloc[0]['Cumulative_deaths']
-            row[4] = temp_df.iloc[0]['LTCF_Cumulative_Deaths']
-            row[5] = temp_df.iloc[0]['LTCF_Cumulative_Deaths'] / row[1] * 100
-            row[6] = temp_df.iloc[0]['Cumulative_deaths'] / temp_df.iloc[0]['Cumulative_cases'] * 100
-            
-            cfr_table_count += 1
-            ucursor.updateRow(row)
-print(f'Total count of LTCF Events By Day Table updates is: {cfr_table_count}')
+# Join the two tabs on the day (ltcf_metrics.combine_cfr), the result is indexed by day.  The statewide
+# case data has data for every day since the first confirmed case, while the ltcf data only records
+# dates where ltcf residents died.  The ltcf cumulative deaths are carried forward to the days not
+# included in the ltcf data (days where an ltcf resident didn't die) and daily deaths are 0 on them.
+combined = ltcf_metrics.combine_cfr(utah_cases, ltcf_cases)
+
+# Match every row of the events by day table to its day in one join, and calculate the fields for
+# every matched row at once.  Calculate these for all rows because some cases and death data are
+# back filled over time.
+print("Matching rows to make updates ...")
+cfr_df = store.read_table(ltcf_events_by_day, ['OID@', 'Date', 'Total_Positive_Residents'])
+cfr_df = ltcf_metrics.match_cfr_days(cfr_df, combined)
+cfr_values = pd.DataFrame({'UT_Cumulative_Cases': cfr_df['Cumulative_cases'],
+                           'UT_Cumulative_Deaths': cfr_df['Cumulative_deaths'],
+                           'Corrected_Res_Cumulative_Deaths': cfr_df['LTCF_Cumulative_Deaths'],
+                           'LTCF_DeathRatio': ltcf_metrics.cfr_ratio(cfr_df['LTCF_Cumulative_Deaths'], cfr_df['Total_Positive_Residents']),
+                           'UT_DeathRatio': ltcf_metrics.cfr_ratio(cfr_df['Cumulative_deaths'], cfr_df['Cumulative_cases'])})
+cfr_edits = cfr_values.set_axis(cfr_df['OID@']).to_dict('index')
+failed = store.update_rows(ltcf_events_by_day, cfr_edits)
+if failed:
+    print(f'Failed to update LTCF events by day rows with ObjectIDs: {failed}')
+cfr_table_count = len(cfr_edits) - len(failed)
+print(f'Total count of LTCF Events By Day Table updates is: {cfr_table_count}    rows failed: {len(failed)}')
+
+# Concurrency and latency of the edits sent to hosted services this run
+if store.edit_metrics() is not None:
+    print(f'Edit concurrency and latency: {store.edit_metrics()}')
 
 print("Script shutting down ...")
 # Stop timer and print end time in UTC
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable backfill for rewriting by day history: rows are split into chunks
+by date range (and district), written several chunks at a time, and finished
+chunks are checkpointed so a failed backfill picks up where it stopped.
+"""
+
+import os
+import json
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def plan_chunks(df, date_field, group_field=None, chunk_days=90):
+    """
+    Split the rows to rewrite into chunks of up to chunk_days per group (district).
+    Returns a list of (chunk_id, dataframe) in date order.  The chunk ids only
+    depend on the data, so a rerun plans the same chunks and can skip finished ones.
+    """
+    days = (df[date_field] - df[date_field].min()).dt.days // chunk_days
+    keys = [df[group_field], days] if group_field else [days]
+    chunks = []
+    for key, chunk in df.groupby(keys, sort=True):
+        start = chunk[date_field].min()
+        group = f'{key[0]}|' if group_field else ''
+        chunks.append((f'{group}{start:%Y-%m-%d}', chunk))
+    return chunks
+
+
+class Checkpoint(object):
+    """Keeps track of finished chunk ids in a JSON file so a failed backfill can resume."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._done = set(json.load(f))
+            print(f'Resuming backfill, {len(self._done)} chunks already finished in {path}')
+
+    def done(self, chunk_id):
+        return chunk_id in self._done
+
+    def mark(self, chunk_id):
+        with self._lock:
+            self._done.add(chunk_id)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(sorted(self._done), f)
+            os.replace(temp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_backfill(chunks, write_chunk, checkpoint, max_workers=4):
+    """
+    Write chunks in parallel with write_chunk(dataframe), which should return a
+    list of anything that failed to write.  Finished chunks are checkpointed, and
+    the checkpoint is removed once every chunk has been written.
+    Returns the number of rows written, the ids of chunks with rows that failed to
+    write and the ids of chunks where write_chunk raised (printed with its traceback).
+    """
+    todo = [(chunk_id, chunk) for chunk_id, chunk in chunks if not checkpoint.done(chunk_id)]
+    print(f'Backfilling {len(todo)} of {len(chunks)} chunks with {max_workers} workers ...')
+    start = time.time()
+    rows = 0
+    failed_chunks = []
+    error_chunks = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(write_chunk, chunk): (chunk_id, chunk.shape[0]) for chunk_id, chunk in todo}
+        for future in as_completed(futures):
+            chunk_id, n_rows = futures[future]
+            try:
+                failed = future.result()
+            except Exception as e:
+                print(f'    {chunk_id}: error writing {n_rows} rows, the chunk was not written')
+                traceback.print_exception(type(e), e, e.__traceback__)
+                error_chunks.append(chunk_id)
+                continue
+            if failed:
+                print(f'    {chunk_id}: failed to write {len(failed)} rows, will retry on the next run')
+                failed_chunks.append(chunk_id)
+                continue
+            checkpoint.mark(chunk_id)
+            rows += n_rows
+            print(f'    {chunk_id}: {n_rows} rows    ({rows / (time.time() - start):.1f} rows/s)')
+
+    elapsed = time.time() - start
+    print(f'Backfilled {rows} rows in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.1f} rows/s)')
+    if not failed_chunks and not error_chunks:
+        checkpoint.clear()
+    return rows, failed_chunks, error_chunks
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the case count and LTCF pipelines on synthetic data at several
+times today's size.
+
+Usage:  python benchmark_pipeline.py [1x 10x 100x 1000x] [--out results.jsonl] [--work-dir folder] [--no-memory]
+
+Each stage of each pipeline is timed separately and its peak memory (from
+tracemalloc) is recorded.  One JSON record per stage is appended to the output
+file so results can be tracked over time.  Tracing memory slows down the
+row-by-row stages, pass --no-memory for timings only.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import datetime as dt
+import covid_metrics
+import jurisdictions
+import table_cache
+import schemas
+import feature_store
+import ltcf_metrics
+import synthetic_data
+
+
+# Data sizes to benchmark, '1x' is about today's data
+# Districts grow to ~3,000 counties, facilities to tens of thousands, with years of daily history
+scales = {'1x': {'districts': 13, 'facilities': 600, 'days': 365},
+          '10x': {'districts': 130, 'facilities': 3000, 'days': 730},
+          '100x': {'districts': 1300, 'facilities': 10000, 'days': 1095},
+          '1000x': {'districts': 3000, 'facilities': 30000, 'days': 1095}}
+default_scales = ['10x', '100x', '1000x']
+
+# Table names used in the local SQLite store, the same names the service URLs map to
+counts_service = 'Utah_COVID19_Cases_by_Local_Health_Department'
+counts_by_day = 'Utah_COVID19_Case_Counts_by_LHD_by_Day'
+ltcf_service = 'LTCF_Data'
+ltcf_events_by_day = 'LTCF_Events_by_Day'
+
+
+#########################
+# Synthetic data        #
+#########################
+
+def write_inputs(scale, work_dir):
+    """Write the synthetic files and tables for a scale, returns their paths."""
+    size = scales[scale]
+    names = synthetic_data.district_names(size['districts'])
+    history = synthetic_data.make_history(size['days'], names=names)
+    history = covid_metrics.calc_district_metrics(history)
+    counts_csv = os.path.join(work_dir, f'COVID_Case_Counts_{scale}.csv')
+    synthetic_data.make_case_counts(history).to_csv(counts_csv, index=False)
+    snapshot_file = os.path.join(work_dir, f'counts_by_day_snapshot_{scale}.npz')
+    table_cache.save_snapshot(history, snapshot_file)
+    tail_file = os.path.join(work_dir, f'counts_by_day_tail_{scale}.csv')
+    covid_metrics.save_tail(history, tail_file)
+
+    service_df = synthetic_data.make_ltcf_service(size['facilities'])
+    sheet_csv = os.path.join(work_dir, f'COVID_LTCF_Data_{scale}.csv')
+    synthetic_data.make_ltcf_sheet(service_df).to_csv(sheet_csv, index=False)
+
+    # Hosted layers are stood in for by a local SQLite file
+    db_path = os.path.join(work_dir, f'benchmark_{scale}.sqlite')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    store = feature_store.SQLiteStore(db_path)
+    latest = covid_metrics.latest_by_district(history).reset_index()
+    latest = latest.rename(columns={'Day': 'Date_Updated'})
+    store.load_table(counts_service, latest)
+    # The incremental check only reads the stored tail's days back from the by day table, so only the
+    # last few weeks are loaded (inserting years of rows into SQLite would take longer than the benchmark)
+    recent_start = history['Day'].max().normalize() - pd.Timedelta(days=2 * covid_metrics.tail_days)
+    store.load_table(counts_by_day, history[history['Day'] >= recent_start])
+    store.load_table(ltcf_service, service_df)
+    store.load_table(ltcf_events_by_day, synthetic_data.make_events_by_day(size['days']))
+    return {'counts_csv': counts_csv, 'snapshot_file': snapshot_file, 'tail_file': tail_file, 'sheet_csv': sheet_csv,
+            'store': store, 'history_rows': history.shape[0]}
+
+
+#########################
+# Pipeline stages       #
+#########################
+
+def case_counts_stages(inputs):
+    """Stages of AGOL_updater.py (single pass, full recalculation path) as (name, function) pairs."""
+    store = inputs['store']
+    state = {}
+    update_time = dt.datetime.now().replace(microsecond=0)
+
+    def ingest():
+        updates = pd.read_csv(inputs['counts_csv'])
+        state['updates_by_name'] = jurisdictions.index_by_name(updates, 'Jurisdiction')
+        day_df = table_cache.load_snapshot(inputs['snapshot_file'])
+        day_df['DISTNAME'] = jurisdictions.normalize_names(day_df['DISTNAME'])
+        today_df = covid_metrics.counts_to_day_rows(state['updates_by_name'], day_df, update_time)
+        day_df = pd.concat([day_df, today_df], ignore_index=True)
+        schemas.apply_schema(day_df, schemas.by_day_schema)
+        state['day_df'] = day_df
+        return day_df.shape[0]
+
+    def derive():
+        state['metrics_df'] = covid_metrics.calc_district_metrics(state['day_df'])
+        return state['metrics_df'].shape[0]
+
+    def change_detect():
+        # Incremental runs check the stored tail against the same days pulled from the by day table
+        tail_df = covid_metrics.load_tail(inputs['tail_file'])
+        tail_start = tail_df['Day'].min().normalize()
+        today_start = pd.Timestamp(update_time.date())
+        where = f"Day >= timestamp '{tail_start - pd.Timedelta(days=1):%Y-%m-%d %H:%M:%S}'"
+        recent_df = store.read_table(counts_by_day, list(tail_df.columns), where)
+        recent_df['DISTNAME'] = jurisdictions.normalize_names(recent_df['DISTNAME'])
+        recent_days = pd.to_datetime(recent_df['Day']).dt.normalize()
+        recent_df = recent_df[(recent_days >= tail_start) & (recent_days < today_start)]
+        state['tail_matches'] = (covid_metrics.tail_matches(tail_df, recent_df) and
+                                 set(tail_df['DISTNAME']) == set(state['updates_by_name'].index))
+        if not state['tail_matches']:
+            raise RuntimeError('Stored tail does not match the by day table')
+        return recent_df.shape[0]
+
+    def aggregate():
+        state['latest_metrics'] = covid_metrics.latest_by_district(state['metrics_df'])
+        return state['latest_metrics'].shape[0]
+
+    def write():
+        # Step 6: one edit per district on the latest layer, then append today's rows to the by day table
+        latest_metrics = state['latest_metrics']
+        fields = [f for f in latest_metrics.columns if f not in ('Day',)]
+        oids = store.read_table(counts_service, ['OID@', 'DISTNAME'])
+        edits = {}
+        for oid, name in oids.itertuples(index=False, name=None):
+            values = latest_metrics.loc[jurisdictions.normalize_name(name), fields].to_dict()
+            values['Date_Updated'] = update_time
+            edits[oid] = values
+        failed = store.update_rows(counts_service, edits)
+        today_rows = latest_metrics.reset_index()
+        store.insert_rows(counts_by_day, list(today_rows.columns), today_rows.itertuples(index=False, name=None))
+        return len(edits) - len(failed)
+
+    return [('ingest', ingest), ('derive', derive), ('change_detect', change_detect),
+            ('aggregate', aggregate), ('write', write)]
+
+
+def ltcf_stages(inputs):
+    """Stages of the LTCF scripts (steps 1-7a) as (name, function) pairs."""
+    store = inputs['store']
+    state = {}
+    service_fields = ['OID@', 'UniqueID', 'Facility_Name', 'Facility_Type', 'Resolved_Y_N', 'Date_Resolved',
+                      'Positive_Patients', 'Deceased_Patients', 'Positive_HCWs', 'Postive_Patients_Desc',
+                      'Dashboard_Display', 'Dashboard_Display_Cat', 'LastPos_Resident']
+
+    def ingest():
+        # Steps 1 and 2: clean up the sheet export (ltcf_metrics) and read the hosted layer
+        updates = ltcf_metrics.read_sheet(inputs['sheet_csv'])
+        state['updates'] = updates
+        service_df = store.read_table(ltcf_service, service_fields, null_value={'UniqueID': 0})
+        state['service_df'] = service_df
+        return updates.shape[0] + service_df.shape[0]
+
+    def derive():
+        # Dashboard fields for every facility at once from the band table (ltcf_metrics)
+        sheet = state['updates'].drop_duplicates('UniqueID').set_index('UniqueID')
+        derived = ltcf_metrics.classify_facilities(sheet.reindex(state['service_df']['UniqueID']))
+        state['derived'] = derived
+        return len(derived)
+
+    def change_detect():
+        # Join the layer to the sheet once and compare every field at once (ltcf_metrics)
+        before, after, changed = ltcf_metrics.detect_changes(state['service_df'], state['updates'])
+        derived = state['derived'].loc[after['UniqueID']].set_axis(after.index)
+        after, changed = ltcf_metrics.merge_derived(before, after, changed, derived)
+        state['after'] = after
+        state['edits'] = ltcf_metrics.edit_set(after, changed)
+        return len(after)
+
+    def aggregate():
+        # Dashboard totals from the facility rows in memory with step 4's edits applied (ltcf_metrics)
+        layer = ltcf_metrics.written_layer(state['service_df'], state['after'])
+        state['totals'] = ltcf_metrics.daily_totals(layer)
+        return layer.shape[0]
+
+    def write():
+        # Step 4 writes the facilities that changed, step 5 appends today's totals
+        failed = store.update_rows(ltcf_service, state['edits'])
+        store.insert_rows(ltcf_events_by_day, ['Date', 'Total_Investigations', 'Total_Outbreaks', 'Total_Positive_Residents'],
+                          [(dt.datetime.now(), state['totals']['investigations'], state['totals']['outbreaks'],
+                            state['totals']['positive_patients'])])
+        return len(state['edits']) - len(failed)
+
+    return [('ingest', ingest), ('derive', derive), ('change_detect', change_detect),
+            ('aggregate', aggregate), ('write', write)]
+
+
+def events_by_day_stages(inputs):
+    """Steps 6 and 7b of the LTCF scripts (recalculate and rewrite the events by day table)."""
+    store = inputs['store']
+    state = {}
+
+    def ingest():
+        day_df = store.read_table(ltcf_events_by_day, ['OID@'] + list(schemas.ltcf_events_by_day_schema), null_value=0)
+        schemas.apply_schema(day_df, schemas.ltcf_events_by_day_schema)
+        day_df.sort_values('Date', inplace=True)
+        state['day_df'] = day_df
+        return day_df.shape[0]
+
+    def derive():
+        # Every derived field from the metric spec, one pass per operation (ltcf_metrics)
+        day_df = ltcf_metrics.calc_events_metrics(state['day_df'])
+        state['day_df'] = day_df
+        return day_df.shape[0]
+
+    def write():
+        edits = state['day_df'].set_index('OID@')[ltcf_metrics.events_metric_fields].to_dict('index')
+        failed = store.update_rows(ltcf_events_by_day, edits)
+        return len(edits) - len(failed)
+
+    return [('ingest', ingest), ('derive', derive), ('write', write)]
+
+
+#########################
+# Runner                #
+#########################
+
+def run_stage(func, trace_memory=True):
+    """Run one stage, returns (rows, seconds, peak MB or None)."""
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        rows = func()
+    finally:
+        seconds = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return rows, seconds, peak
+
+
+def run_scale(scale, work_dir, trace_memory=True):
+    """Generate the data for a scale and benchmark every pipeline on it, returns a list of result records."""
+    print(f'Generating {scale} data {scales[scale]} ...')
+    setup_time = time.perf_counter()
+    inputs = write_inputs(scale, work_dir)
+    print(f'    done in {time.perf_counter() - setup_time:.1f}s')
+
+    run_id = dt.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    results = []
+    pipelines = [('case_counts', case_counts_stages(inputs)),
+                 ('ltcf', ltcf_stages(inputs)),
+                 ('ltcf_events_by_day', events_by_day_stages(inputs))]
+    for pipeline, stages in pipelines:
+        for stage, func in stages:
+            rows, seconds, peak = run_stage(func, trace_memory)
+            record = {'run_id': run_id, 'scale': scale, 'pipeline': pipeline, 'stage': stage,
+                      'rows': int(rows), 'seconds': round(seconds, 6),
+                      'rows_per_s': round(rows / seconds, 1) if seconds > 0 else None,
+                      'peak_mb': round(peak, 2) if peak is not None else None,
+                      **{key: value for key, value in scales[scale].items()},
+                      'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__}
+            results.append(record)
+            peak_text = f'{peak:9.1f} MB' if peak is not None else ''
+            print(f'    {pipeline:<20} {stage:<14} {rows:>9} rows  {seconds:9.3f}s {peak_text}')
+    inputs['store'].conn.close()
+    return results
+
+
+def parse_args(argv):
+    args = {'scales': [], 'out': 'benchmark_results.jsonl', 'work_dir': None, 'trace_memory': True}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--out':
+            args['out'] = argv[i + 1]
+            i += 1
+        elif arg == '--work-dir':
+            args['work_dir'] = argv[i + 1]
+            i += 1
+        elif arg == '--no-memory':
+            args['trace_memory'] = False
+        elif arg in scales:
+            args['scales'].append(arg)
+        else:
+            raise SystemExit(f'Unknown argument: {arg}\n{__doc__}')
+        i += 1
+    args['scales'] = args['scales'] or default_scales
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args['work_dir'] or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        for scale in args['scales']:
+            results = run_scale(scale, work_dir, args['trace_memory'])
+            # Append as JSON lines so runs can be compared over time
+            with open(args['out'], 'a') as f:
+                for record in results:
+                    f.write(json.dumps(record) + '\n')
+    print(f"Results appended to {args['out']}")
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Check the grouped counts by day calculations against the original loop and
+compare run times.
+"""
+
+import sys
+import time
+import pandas as pd
+import covid_metrics
+import synthetic_data
+
+
+def compare(n_days):
+    history = synthetic_data.make_history(n_days)
+
+    loop_time = time.time()
+    hd_dict = covid_metrics.calc_district_metrics_loop(history)
+    loop_time = time.time() - loop_time
+
+    grouped_time = time.time()
+    metrics_df = covid_metrics.calc_district_metrics(history)
+    grouped_time = time.time() - grouped_time
+
+    # Stack the loop results in the same order as the grouped results
+    expected = pd.concat([hd_dict[key] for key in sorted(hd_dict)], ignore_index=True)
+    expected = expected.drop(columns='index')
+    actual = metrics_df.sort_values(['DISTNAME', 'Day'], kind='mergesort').reset_index(drop=True)
+    pd.testing.assert_frame_equal(actual[expected.columns], expected, check_dtype=False)
+
+    print(f'{n_days:>6} days  {history.shape[0]:>7} rows    loop: {loop_time:8.3f}s    grouped: {grouped_time:6.3f}s    speedup: {loop_time / grouped_time:7.1f}x')
+
+
+if __name__ == '__main__':
+    # Pass the number of days of history to check, defaults to about three years
+    day_counts = [int(arg) for arg in sys.argv[1:]] or [30, 365, 1095]
+    for n_days in day_counts:
+        compare(n_days)
+    print('Grouped results match the original loop')
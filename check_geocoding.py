@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Check the Geocoder against a local stand-in for the AGRC geocoding API,
+without an api key or network access: concurrent geocoding, the adaptive
+concurrency limit against a stand-in that throttles, the provider chain's
+fallback and hedging, and the offline address point index.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+from urllib.parse import urlparse, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import geocoding
+import throttle
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET api/v1/geocode/{street}/{zone} like the AGRC API, streets containing
+    'Nowhere' (or in the city 'Unknown') aren't found and streets containing
+    'Garbled' get an answer without a status.  Requests over the server's
+    capacity get HTTP 429.  Every server.slow_every'th street number is slow to
+    answer by city.
+    """
+
+    # HTTP/1.1 keeps connections open between requests, each reply is sent in one write
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.connections.add(self.client_address)
+            server.active += 1
+            over_capacity = server.capacity is not None and server.active > server.capacity
+        try:
+            if over_capacity:
+                with server.lock:
+                    server.throttled += 1
+                self._reply(429, {'status': 429, 'message': 'Too many requests'})
+            else:
+                self._geocode()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _geocode(self):
+        server = self.server
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if len(parts) != 5 or parts[:3] != ['api', 'v1', 'geocode']:
+            self._reply(400, {'status': 400, 'message': 'Bad path'})
+            return
+        street, zone = unquote(parts[3]), unquote(parts[4])
+        number = int(street.split()[0]) if street.split()[0].isdigit() else 0
+        slow = server.slow_every and number % server.slow_every == 0 and not zone.isdigit()
+        time.sleep(server.slow_delay if slow else server.delay)
+        if 'Nowhere' in street or zone.upper() == 'UNKNOWN':
+            self._reply(200, {'status': 404, 'message': 'No address candidates found with a score of 70 or better.'})
+            return
+        if 'Garbled' in street:
+            self._reply(200, {'message': 'Something went wrong'})
+            return
+        self._reply(200, {'status': 200,
+                          'result': {'location': {'x': 420000. + number, 'y': 4500000. + number},
+                                     'score': 100, 'matchAddress': f'{street.upper()}, {zone.upper()}'}})
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(delay=0.01, capacity=None, slow_every=0, slow_delay=1.):
+    """Start the stand-in server on a free local port, returns the server and its url template."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.capacity = capacity
+    server.slow_every = slow_every
+    server.slow_delay = slow_delay
+    server.active = 0
+    server.throttled = 0
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_template = f'http://127.0.0.1:{server.server_address[1]}/api/v1/geocode/{{}}/{{}}'
+    return server, url_template
+
+
+def check(n_rows, workers=8):
+    server, url_template = start_stand_in()
+    df = pd.DataFrame({'Address': [f'{i} N Main St' if i % 10 else f'{i} Nowhere Ln' for i in range(1, n_rows + 1)],
+                       'City': 'Salt Lake City'})
+
+    def run(make_geocoder):
+        def geocode(row):
+            result = make_geocoder().locate(row['Address'], row['City'], acceptScore=70, spatialReference=3857)
+            row['x'] = result['x'] if result else '0'
+            row['status'] = 'succeeded' if result else 'failed'
+            return row
+        server.requests, server.connections = 0, set()
+        start = time.perf_counter()
+        geocoded, stats = geocoding.geocode_rows(df, geocode, workers, rate=10000)
+        return geocoded, time.perf_counter() - start, server.requests, len(server.connections)
+
+    # A new client for every row, like the old geocode(), versus one shared client
+    fresh, fresh_time, fresh_requests, fresh_connections = run(lambda: geocoding.Geocoder('test', url_template=url_template))
+    geocoder = geocoding.Geocoder('test', url_template=url_template, pool_size=workers)
+    shared, shared_time, shared_requests, shared_connections = run(lambda: geocoder)
+    geocoder.close()
+    server.shutdown()
+
+    pd.testing.assert_frame_equal(shared, fresh)
+    assert list(shared['status'] == 'failed') == [i % 10 == 0 for i in range(1, n_rows + 1)]
+    assert shared_requests == fresh_requests == n_rows
+    assert shared_connections <= workers, f'{shared_connections} connections for {workers} workers'
+    print(f'{n_rows:>6} rows    new client per row: {fresh_time:6.2f}s {fresh_connections:>5} connections    '
+          f'shared client: {shared_time:6.2f}s {shared_connections:>3} connections')
+
+
+def check_no_status():
+    """Answers without a status are failures, cached for the cache's failure TTL like addresses that weren't found."""
+    server, url_template = start_stand_in()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = geocoding.GeocodeCache(os.path.join(temp_dir, 'geocode_cache.json'), failure_ttl_hours=1)
+        geocoder = geocoding.Geocoder('test', url_template=url_template, cache=cache)
+        for street in ['1 Garbled Way', '2 Nowhere Ln', '1 Garbled Way', '2 Nowhere Ln']:
+            assert geocoder.lookup(street, 'Provo') is None
+        assert server.requests == 2, server.requests
+        # Past the failure TTL they're asked for again
+        cache.failure_ttl = 0
+        time.sleep(0.01)
+        assert geocoder.lookup('1 Garbled Way', 'Provo') is None
+        assert server.requests == 3, server.requests
+        geocoder.close()
+    server.shutdown()
+
+
+def check_adaptive(n_rows, capacity=4, workers=16):
+    """Geocode against a stand-in that throttles past 'capacity' requests at once, retrying throttled rows."""
+    server, url_template = start_stand_in(delay=0.02, capacity=capacity)
+    df = pd.DataFrame({'Address': [f'{i} N Main St' for i in range(1, n_rows + 1)], 'City': 'Provo'})
+    limiter = throttle.AdaptiveLimiter(initial=2, maximum=workers)
+    geocoder = geocoding.Geocoder('test', url_template=url_template, pool_size=workers, limiter=limiter)
+
+    def geocode(row):
+        for attempt in range(5):
+            result = geocoder.locate(row['Address'], row['City'])
+            if result:
+                break
+        row['status'] = 'succeeded' if result else 'failed'
+        return row
+
+    geocoded, stats = geocoding.geocode_rows(df, geocode, workers, rate=10000)
+    geocoder.close()
+    server.shutdown()
+    metrics = limiter.metrics()
+    assert (geocoded['status'] == 'succeeded').all()
+    assert metrics['backoffs'] > 0 and metrics['limit'] <= 2 * capacity, metrics
+    print(f'{n_rows:>6} rows    server capacity: {capacity}    throttled responses: {server.throttled}    '
+          f'backoffs: {metrics["backoffs"]}    final limit: {metrics["limit"]}    '
+          f'throughput: {stats["rows_per_s"]:.1f} rows/s')
+
+
+def check_chain(n_rows, workers=8):
+    """Geocode with City only versus the City --> ZIP_Code chain, where some cities are unknown or slow."""
+    server, url_template = start_stand_in(delay=0.01, slow_every=20, slow_delay=1.)
+    df = pd.DataFrame({'Address': [f'{i} N Main St' for i in range(1, n_rows + 1)],
+                       'City': ['Unknown' if i % 15 == 0 else 'Orem' for i in range(1, n_rows + 1)],
+                       'ZIP_Code': 84057.})
+
+    def run(providers):
+        geocoder = geocoding.Geocoder('test', url_template=url_template, pool_size=2 * workers)
+        chain = geocoding.ProviderChain([(name, geocoding.agrc_provider(geocoder, zone)) for name, zone in providers],
+                                        hedge_after=0.1, min_samples=10, max_workers=2 * workers)
+
+        def geocode(row):
+            result = chain.lookup(row)
+            row['status'] = 'succeeded' if result else 'failed'
+            row['geocoder'] = result['provider'] if result else ''
+            return row
+
+        geocoded, stats = geocoding.geocode_rows(df, geocode, workers, rate=10000)
+        chain.close()
+        geocoder.close()
+        return geocoded, stats, chain.metrics()
+
+    city, city_stats, _ = run([('agrc_city', 'City')])
+    chain, chain_stats, metrics = run([('agrc_city', 'City'), ('agrc_zip', 'ZIP_Code')])
+    server.shutdown()
+
+    city_failed = (city['status'] == 'failed').sum()
+    chain_failed = (chain['status'] == 'failed').sum()
+    assert city_failed == n_rows // 15 and chain_failed == 0, (city_failed, chain_failed)
+    assert metrics['hedges'] > 0 and metrics['wins']['agrc_zip'] > 0, metrics
+    assert chain_stats['p99'] < city_stats['p99'], (chain_stats['p99'], city_stats['p99'])
+    print(f'{n_rows:>6} rows    City only: {city_failed} failed, p99 {city_stats["p99"]:.3f}s    '
+          f'chain: {chain_failed} failed, p99 {chain_stats["p99"]:.3f}s, {metrics["hedges"]} hedged, '
+          f'wins {metrics["wins"]}')
+
+
+def check_offline(n_rows, n_points=200000, workers=8):
+    """Geocode facilities with typos, wrong house numbers and spelled out street words against an AddressIndex, without any requests."""
+    rng = np.random.default_rng(0)
+    streets = ['N MAIN ST', 'S STATE ST', 'W CENTER ST', 'E 900 S', 'S REDWOOD RD', 'S HIGHLAND DR']
+    zones = {'SALT LAKE CITY': '84101', 'OREM': '84057', 'PROVO': '84601', 'OGDEN': '84401'}
+    cities = rng.choice(list(zones), n_points)
+    points = pd.DataFrame({'address': [f'{number} {street}' for number, street in
+                                       zip(rng.permutation(n_points) + 1, rng.choice(streets, n_points))],
+                           'city': cities, 'zip': [zones[city] for city in cities],
+                           'x': rng.uniform(-1.25e7, -1.23e7, n_points), 'y': rng.uniform(4.9e6, 5.1e6, n_points)})
+    index = geocoding.AddressIndex(points)
+
+    sample = points.sample(n_rows, random_state=1).reset_index(drop=True)
+    typos = sample['address'].str.replace('MAIN', 'MIAN').str.replace(' ST', ' Street').str.replace(r'^(\d+) N ', r'\1 North ', regex=True)
+    # Every 7th facility off Main Street has a typo in the last digit of its house number, so only its street can match
+    wrong_number = (np.arange(n_rows) % 7 == 3) & ~sample['address'].str.contains('MAIN').to_numpy(bool)
+    typos[wrong_number] = typos[wrong_number].str.replace(r'^(\d*)(\d) ', lambda m: f'{m.group(1)}{(int(m.group(2)) + 1) % 10} ', regex=True)
+    df = pd.DataFrame({'Address': typos.str.title(), 'City': sample['city'].str.title(),
+                       'ZIP_Code': sample['zip'].astype(float)})
+    # Every 10th facility only has a ZIP code, like the sheet sometimes does
+    df.loc[::10, 'City'] = ''
+    chain = geocoding.ProviderChain([('address_points', geocoding.index_provider(index))], max_workers=workers)
+
+    def geocode(row):
+        result = chain.lookup(row)
+        row['x'] = result['location']['x'] if result else 0
+        row['score'] = result['score'] if result else 0
+        return row
+
+    geocoded, stats = geocoding.geocode_rows(df, geocode, workers, rate=None)
+    chain.close()
+    right = geocoded[~wrong_number]
+    assert (right['x'] == sample.loc[~wrong_number, 'x']).all(), right[right['x'] != sample.loc[~wrong_number, 'x']].head()
+    # The wrong house numbers match a point on the same street in the same city or ZIP code
+    matched = points.set_index('x').loc[geocoded.loc[wrong_number, 'x']]
+    street = sample.loc[wrong_number, 'address'].str.split(' ', n=1).str[1].to_numpy()
+    assert (matched['address'].str.split(' ', n=1).str[1].to_numpy() == street).all()
+    assert (matched['zip'].to_numpy() == sample.loc[wrong_number, 'zip'].to_numpy()).all()
+    assert (geocoded['score'] >= 70).all(), geocoded['score'].min()
+    print(f'{n_rows:>6} rows    {n_points} address points    {stats["rows_per_s"]:.0f} rows/s    '
+          f'exact: {(geocoded["score"] == 100).sum()}    lowest score: {geocoded["score"].min()}')
+
+
+if __name__ == '__main__':
+    # Pass the number of rows to geocode, defaults to a few hundred new facilities
+    row_counts = [int(arg) for arg in sys.argv[1:]] or [50, 500]
+    for n_rows in row_counts:
+        check(n_rows)
+    print('Geocoder results match and connections are reused')
+    check_no_status()
+    print('Answers without a status are cached as failures')
+    for n_rows in row_counts:
+        check_adaptive(n_rows)
+    print('Concurrency backs off when the API throttles')
+    for n_rows in row_counts:
+        check_chain(n_rows)
+    print('Provider chain falls back on misses and hedges slow requests')
+    for n_rows in row_counts:
+        check_offline(10 * n_rows)
+    print('Offline address index matches every facility')
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Check the LTCF calculations against the original loops and compare run
+times: change detection, the dashboard band table, dirty facility edits, daily
+totals, the events by day metric spec, repeated days, the case fatality rate
+update and reading the sheet export.  The original loops get missing counts as
+9999, the vectorized code keeps them nullable.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import ltcf_metrics
+import schemas
+import synthetic_data
+
+
+def make_facilities(n_facilities, seed=0):
+    """
+    Build the LTCF layer rows (as read in step 4, with 'OID@' and some nulls)
+    and the cleaned up sheet (as step 1 leaves it, missing counts are <NA>).
+    """
+    rng = np.random.default_rng(seed)
+    service_df = synthetic_data.make_ltcf_service(n_facilities, seed)
+    sheet = synthetic_data.make_ltcf_sheet(service_df, seed)
+    service_df.insert(0, 'OID@', np.arange(1, n_facilities + 1) * 3)
+    nulls = rng.random(n_facilities) < 0.05
+    for field in ['Resolved_Y_N', 'Positive_Patients', 'Deceased_Patients', 'LastPos_Resident']:
+        service_df[field] = service_df[field].where(~nulls)
+
+    updates = sheet.rename(columns={'Dashboard Facility Type': 'Facility_Type_', 'Positive Patients': 'Positive_Patients',
+                                    'Deceased Patients': 'Deceased_Patients', 'Positive HCWs': 'Positive_HCWs',
+                                    'Last Positive Resident': 'LastPos_Resident'})
+    updates = updates.drop(columns='Facility_Type').rename(columns={'Facility_Type_': 'Facility_Type'})
+    updates = updates.replace('', np.nan)
+    updates[ltcf_metrics.count_fields] = updates[ltcf_metrics.count_fields].apply(pd.to_numeric).astype('Int32')
+    updates['Resolved_Y_N'] = updates['Resolved_Y_N'].fillna('N')
+    updates['LastPos_Resident'] = pd.to_datetime(updates['LastPos_Resident'])
+    # Some facilities were cleared in the sheet
+    cleared = rng.random(n_facilities) < 0.05
+    updates.loc[cleared, 'LastPos_Resident'] = pd.NaT
+    updates.loc[cleared, 'Date_Resolved'] = np.nan
+    # Shuffle the sheet, the join shouldn't depend on row order
+    return service_df, updates.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def with_sentinel(updates):
+    """The sheet with missing ids and counts as 9999, how the original loops read it."""
+    fields = [field for field in ltcf_metrics.sheet_int_fields if field in updates.columns]
+    return updates.astype({field: object for field in fields}).fillna({field: 9999 for field in fields})
+
+
+def compare(n_facilities):
+    service_df, updates = make_facilities(n_facilities)
+
+    loop_time = time.time()
+    expected = ltcf_metrics.detect_changes_loop(service_df, with_sentinel(updates))
+    loop_time = time.time() - loop_time
+
+    joined_time = time.time()
+    before, after, changed = ltcf_metrics.detect_changes(service_df, updates)
+    edits = ltcf_metrics.edit_set(after, changed)
+    joined_time = time.time() - joined_time
+
+    actual = {oid: [field for field in ltcf_metrics.change_fields if row[field]] for oid, row in changed.iterrows()}
+    assert actual == expected
+    assert {oid: list(values) for oid, values in edits.items()} == {oid: fields for oid, fields in expected.items() if fields}
+    n_edits = sum(len(values) for values in edits.values())
+
+    print(f'{n_facilities:>6} facilities  {len(edits):>6} changed  {n_edits:>6} field edits    '
+          f'loop: {loop_time:8.3f}s    joined: {joined_time:6.3f}s    speedup: {loop_time / joined_time:7.1f}x')
+
+
+def compare_classify(n_facilities):
+    service_df, updates = make_facilities(n_facilities)
+    # The original ladders only display upper case 'N', classify_facilities() also takes 'n'
+    updates['Resolved_Y_N'] = updates['Resolved_Y_N'].str.upper()
+
+    loop_time = time.time()
+    expected = ltcf_metrics.classify_facilities_loop(with_sentinel(updates))
+    loop_time = time.time() - loop_time
+
+    table_time = time.time()
+    actual = ltcf_metrics.classify_facilities(updates)
+    table_time = time.time() - table_time
+
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    bands = actual['Postive_Patients_Desc'].value_counts()
+    print(f'{n_facilities:>6} facilities  {(actual["Dashboard_Display"] == "Y").sum():>6} displayed    '
+          f'loop: {loop_time:8.3f}s    band table: {table_time:6.3f}s    speedup: {loop_time / table_time:7.1f}x    '
+          f'{bands.to_dict()}')
+
+
+def step4_edits(service_df, updates):
+    """Edits step 4 sends for the layer rows in service_df."""
+    before, after, changed = ltcf_metrics.detect_changes(service_df, updates)
+    sheet_rows = updates.drop_duplicates('UniqueID').set_index('UniqueID').reindex(after['UniqueID']).set_axis(after.index)
+    derived = ltcf_metrics.classify_facilities(sheet_rows, current=after)
+    after, changed = ltcf_metrics.merge_derived(before, after, changed, derived)
+    return after, ltcf_metrics.edit_set(after, changed)
+
+
+def check_dirty(n_facilities, changed_frac=0.05):
+    """Write step 4's edits and run it again with a sheet where only changed_frac of the facilities changed."""
+    service_df, updates = make_facilities(n_facilities)
+    after, edits = step4_edits(service_df, updates)
+    written = after.reset_index()
+
+    # Nothing changed since the layer was updated, nothing should be written
+    _, edits = step4_edits(written, updates)
+    assert not edits, f'{len(edits)} unchanged facilities written'
+
+    # A typical day: a few facilities report new cases
+    rng = np.random.default_rng(1)
+    bumped = rng.random(updates.shape[0]) < changed_frac
+    updates.loc[bumped, 'Positive_Patients'] = updates.loc[bumped, 'Positive_Patients'].fillna(0) + 1
+    _, edits = step4_edits(written, updates)
+    assert set(edits) <= set(written.loc[written['UniqueID'].isin(updates.loc[bumped, 'UniqueID']), 'OID@'])
+    print(f'{n_facilities:>6} facilities    rows scanned: {n_facilities:>6}    rows written: {len(edits):>5}    '
+          f'({len(edits) / n_facilities:.1%}, every row was written before)')
+
+
+def compare_totals(n_facilities):
+    """Count the daily totals from step 4's rows in memory and by scanning the layer once the edits are written."""
+    service_df, updates = make_facilities(n_facilities)
+    after, edits = step4_edits(service_df, updates)
+    # A few edits fail, those facilities keep the layer's values
+    failed = list(edits)[::50]
+    layer = ltcf_metrics.written_layer(service_df, after, failed)
+    pd.testing.assert_frame_equal(layer.loc[failed], service_df.set_index('OID@').loc[failed], check_dtype=False)
+
+    loop_time = time.time()
+    scanned = layer[layer['Facility_Type'].isin(ltcf_metrics.totals_facility_types)]
+    expected = ltcf_metrics.daily_totals_loop(scanned[ltcf_metrics.totals_fields].fillna(0).itertuples(index=False))
+    loop_time = time.time() - loop_time
+
+    frame_time = time.time()
+    actual = ltcf_metrics.daily_totals(ltcf_metrics.written_layer(service_df, after, failed))
+    frame_time = time.time() - frame_time
+
+    assert actual == expected, (actual, expected)
+    print(f'{n_facilities:>6} facilities  {actual["outbreaks"]:>6} outbreaks  {actual["active"]:>6} active    '
+          f'loop: {loop_time:8.3f}s    in memory: {frame_time:6.3f}s')
+
+
+def compare_events(n_days):
+    """Calculate the events by day fields from the metric spec and with the original statements."""
+    day_df = synthetic_data.make_events_by_day(n_days)
+    schemas.apply_schema(day_df, schemas.ltcf_events_by_day_schema)
+    # Totals sometimes drop (false positives), those daily increases are clipped at 0
+    rng = np.random.default_rng(0)
+    drops = rng.random(n_days) < 0.05
+    day_df.loc[drops, 'Total_Positive_Residents'] -= 5
+    day_df.loc[drops, 'Total_Outbreaks'] -= 2
+
+    loop_time = time.time()
+    expected = ltcf_metrics.calc_events_metrics_loop(day_df)
+    loop_time = time.time() - loop_time
+
+    spec_time = time.time()
+    actual = ltcf_metrics.calc_events_metrics(day_df)
+    spec_time = time.time() - spec_time
+
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    assert (actual['Today_Positive_Residents'].dropna() >= 0).all()
+    print(f'{n_days:>6} days  {len(ltcf_metrics.events_metrics)} metrics    '
+          f'statements: {loop_time:6.3f}s    spec: {spec_time:6.3f}s    speedup: {loop_time / spec_time:5.1f}x')
+
+
+def check_repeated_day(n_days):
+    """
+    Run step 6 and 7a's lookup on an events by day table where the script ran
+    twice today (two rows for today), which must match the table without the
+    first of them.
+    """
+    day_df = synthetic_data.make_events_by_day(n_days)
+    schemas.apply_schema(day_df, schemas.ltcf_events_by_day_schema)
+    rerun = day_df.iloc[[-1]].assign(Date=day_df['Date'].iloc[-1] + pd.Timedelta(hours=2))
+    rerun[['Total_Positive_Residents', 'Total_Outbreaks']] += 3
+    repeated = pd.concat([day_df, rerun], ignore_index=True).sample(frac=1, random_state=0)
+
+    expected = ltcf_metrics.calc_events_metrics(ltcf_metrics.one_row_per_day(pd.concat([day_df.iloc[:-1], rerun])))
+    actual = ltcf_metrics.calc_events_metrics(ltcf_metrics.one_row_per_day(repeated))
+    assert actual['Date'].is_unique and actual.shape[0] == n_days
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected.reset_index(drop=True))
+
+    # Both of today's hosted rows get the values of the row written last
+    today = actual['Date'].iloc[-1]
+    temp_row = actual.set_index('Date').loc[today]
+    assert isinstance(temp_row, pd.Series)
+    edit = temp_row[ltcf_metrics.events_metric_fields].to_dict()
+    assert not any(isinstance(value, dict) for value in edit.values())
+    assert edit['Today_Positive_Residents'] == expected['Today_Positive_Residents'].iloc[-1]
+    print(f'{n_days:>6} days    today written twice, {actual.shape[0]} rows after one_row_per_day()')
+
+
+def make_cfr(n_days, seed=0):
+    """
+    Build the case fatality rate sheet's tabs (as read from the Excel file) and
+    the events by day rows they update, which have a time of day and some gaps.
+    """
+    rng = np.random.default_rng(seed)
+    days = pd.date_range('2020-03-06', periods=n_days, freq='D')
+    cases = rng.poisson(300, n_days)
+    utah_cases = pd.DataFrame({'date': days, 'cases': cases, 'Cumulative_cases': np.cumsum(cases),
+                               'Cumulative_deaths': np.cumsum(rng.poisson(3, n_days))})
+    # Residents only died on some days, the tab has a blank first row and a 'Grand Total' row
+    died = np.sort(rng.choice(n_days, n_days // 4, replace=False))
+    daily = rng.integers(1, 4, died.size)
+    ltcf_cases = pd.DataFrame({'Date': [np.nan] + [day.strftime('%Y-%m-%d') for day in days[died]] + ['Grand Total'],
+                               'LTCF_Daily_Deaths': [np.nan] + list(daily) + [daily.sum()],
+                               'LTCF_Cumulative_Deaths': [np.nan] + list(np.cumsum(daily)) + [np.nan]})
+    event_days = days[rng.random(n_days) < 0.9].append(pd.DatetimeIndex(['2019-12-31']))
+    day_df = pd.DataFrame({'OID@': np.arange(1, event_days.size + 1), 'Date': event_days + pd.Timedelta(hours=13),
+                           'Total_Positive_Residents': rng.integers(0, 3000, event_days.size)})
+    return utah_cases, ltcf_cases, day_df
+
+
+def cfr_edits_loop(utah_cases, ltcf_cases, day_df):
+    """Original step 8 of AGOL_updater_LTCF_Data.py, a list of dates and a scan of the sheets for every row."""
+    combined = ltcf_metrics.combine_cfr_loop(utah_cases, ltcf_cases)
+    iso_dates = []
+    for d in combined['date_x']:
+        iso_dates.append(d.date().isoformat())
+    fields = ['UT_Cumulative_Cases', 'UT_Cumulative_Deaths', 'Corrected_Res_Cumulative_Deaths', 'LTCF_DeathRatio',
+              'UT_DeathRatio']
+    cfr_edits = {}
+    for oid, date, positive in day_df.itertuples(index=False, name=None):
+        if date.date().isoformat() in iso_dates:
+            # The original wrote inf for days without positive residents, cfr_ratio() leaves them empty
+            temp_df = combined.loc[combined['date_x'] == date.strftime('%Y-%m-%d')].reset_index()
+            row = [temp_df.iloc[0]['Cumulative_cases'], temp_df.iloc[0]['Cumulative_deaths'],
+                   temp_df.iloc[0]['LTCF_Cumulative_Deaths'],
+                   temp_df.iloc[0]['LTCF_Cumulative_Deaths'] / positive * 100 if positive else np.nan,
+                   temp_df.iloc[0]['Cumulative_deaths'] / temp_df.iloc[0]['Cumulative_cases'] * 100]
+            cfr_edits[oid] = dict(zip(fields, row))
+    return cfr_edits
+
+
+def compare_cfr(n_days):
+    """Match the events by day rows to the case fatality rate sheets by day key and with the original scans."""
+    utah_cases, ltcf_cases, day_df = make_cfr(n_days)
+
+    loop_time = time.time()
+    expected = cfr_edits_loop(utah_cases, ltcf_cases, day_df)
+    loop_time = time.time() - loop_time
+
+    keyed_time = time.time()
+    cfr_df = ltcf_metrics.match_cfr_days(day_df, ltcf_metrics.combine_cfr(utah_cases, ltcf_cases))
+    cfr_values = pd.DataFrame({'UT_Cumulative_Cases': cfr_df['Cumulative_cases'],
+                               'UT_Cumulative_Deaths': cfr_df['Cumulative_deaths'],
+                               'Corrected_Res_Cumulative_Deaths': cfr_df['LTCF_Cumulative_Deaths'],
+                               'LTCF_DeathRatio': ltcf_metrics.cfr_ratio(cfr_df['LTCF_Cumulative_Deaths'],
+                                                                         cfr_df['Total_Positive_Residents']),
+                               'UT_DeathRatio': ltcf_metrics.cfr_ratio(cfr_df['Cumulative_deaths'],
+                                                                       cfr_df['Cumulative_cases'])})
+    actual = cfr_values.set_axis(cfr_df['OID@']).to_dict('index')
+    keyed_time = time.time() - keyed_time
+
+    pd.testing.assert_frame_equal(pd.DataFrame.from_dict(actual, orient='index'),
+                                  pd.DataFrame.from_dict(expected, orient='index'), check_dtype=False)
+    print(f'{n_days:>6} days  {len(actual):>6} rows updated    '
+          f'scans: {loop_time:8.3f}s    day key: {keyed_time:6.3f}s    speedup: {loop_time / keyed_time:7.1f}x')
+
+
+def compare_ingest(n_facilities, repeat=3):
+    """Read a sheet export with the original per-cell clean up and read_sheet(), best of repeat runs each."""
+    service_df = synthetic_data.make_ltcf_service(n_facilities)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'COVID_LTCF_Data_latest.csv')
+        synthetic_data.make_ltcf_sheet(service_df).to_csv(path, index=False)
+
+        # Time both without tracemalloc (it slows down every allocation), then trace one read for the peak
+        timings = {}
+        for name, read in [('loop', ltcf_metrics.read_sheet_loop), ('vectorized', ltcf_metrics.read_sheet)]:
+            timings[name] = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = read(path)
+                timings[name].append(time.perf_counter() - start)
+            if name == 'loop':
+                expected = result
+        tracemalloc.start()
+        updates = ltcf_metrics.read_sheet(path)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    # ZIP codes are kept as text now, the original read them as numbers
+    actual = with_sentinel(updates).reset_index(drop=True)
+    actual['ZIP_Code'] = pd.to_numeric(actual['ZIP_Code'])
+    pd.testing.assert_frame_equal(actual, expected.reset_index(drop=True), check_dtype=False)
+    loop_time, whole_time = min(timings['loop']), min(timings['vectorized'])
+    print(f'{n_facilities:>6} rows    per cell: {loop_time:7.3f}s    vectorized: {whole_time:6.3f}s '
+          f'({n_facilities / whole_time:8.0f} rows/s, {loop_time / whole_time:4.1f}x, peak {peak_mb:6.1f} MB)')
+
+
+def compare_scan(n_facilities, chunksize=2000):
+    """
+    Scan a sheet export with dates in other shapes whole and a chunk at a time
+    (scan_sheet()), against read_sheet() of the same sheet with every date as
+    month/day/year.  The chunked scan has to hold less at its peak.
+    """
+    service_df = synthetic_data.make_ltcf_service(n_facilities)
+    sheet = synthetic_data.make_ltcf_sheet(service_df)
+    # Shuffled, so rows of one facility and the lowest OIDs land in different chunks
+    sheet = sheet.sample(frac=1, random_state=0)
+    layer_ids = service_df['UniqueID'].iloc[:int(n_facilities * 0.95)]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'COVID_LTCF_Data_latest.csv')
+        sheet.to_csv(path, index=False)
+        expected = ltcf_metrics.read_sheet(path)
+        # Other shapes Google Sheets has exported dates in
+        dates = pd.to_datetime(sheet['Notification_Date'], format=ltcf_metrics.sheet_date_format)
+        shapes = np.arange(len(sheet)) % 4
+        sheet['Notification_Date'] = np.select([shapes == 1, shapes == 2, shapes == 3],
+                                               [dates.dt.strftime('%Y-%m-%d'), dates.dt.strftime('%m/%d/%y'),
+                                                dates.dt.strftime('%m/%d/%Y 00:00:00')], sheet['Notification_Date'])
+        sheet.to_csv(path, index=False)
+
+        results = {}
+        for name, chunks in [('whole', lambda: [ltcf_metrics.read_sheet(path)]),
+                             ('chunked', lambda: ltcf_metrics.iter_sheet(path, chunksize))]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            scanned = ltcf_metrics.scan_sheet(chunks(), layer_ids)
+            results[name] = scanned, time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+    expected_no_id = expected.loc[expected['UniqueID'].isna(), 'OID'].tolist()
+    expected_new = expected[expected['UniqueID'].notna() & ~expected['UniqueID'].isin(layer_ids)]
+    expected_facilities = expected.loc[expected['UniqueID'].notna(), ltcf_metrics.sheet_match_fields]
+    expected_facilities = expected_facilities.drop_duplicates('UniqueID')
+    for (no_id, new, facilities), _, _ in results.values():
+        assert no_id == expected_no_id
+        pd.testing.assert_frame_equal(new.reset_index(drop=True), expected_new.reset_index(drop=True))
+        pd.testing.assert_frame_equal(facilities.reset_index(drop=True), expected_facilities.reset_index(drop=True))
+    (_, whole_time, whole_mb), (_, chunked_time, chunked_mb) = results['whole'], results['chunked']
+    assert chunked_mb < whole_mb, (chunked_mb, whole_mb)
+    print(f'{n_facilities:>6} rows    whole: {whole_time:6.3f}s (peak {whole_mb:6.1f} MB)    '
+          f'{chunksize} row chunks: {chunked_time:6.3f}s (peak {chunked_mb:6.1f} MB)')
+
+
+if __name__ == '__main__':
+    # Pass the number of facilities to check, defaults to today's count and up
+    facility_counts = [int(arg) for arg in sys.argv[1:]] or [600, 3000, 10000]
+    for n_facilities in facility_counts:
+        compare(n_facilities)
+    print('Joined change detection matches the original loop')
+    for n_facilities in facility_counts:
+        compare_classify(n_facilities)
+    print('Band table matches the original ladders')
+    for n_facilities in facility_counts:
+        check_dirty(n_facilities)
+    print('Only changed facilities are written')
+    for n_facilities in facility_counts:
+        compare_totals(n_facilities)
+    print('Daily totals match a scan of the written layer')
+    for n_facilities in facility_counts:
+        compare_events(n_facilities)
+    print('Metric spec matches the original step 6')
+    for n_facilities in facility_counts:
+        check_repeated_day(n_facilities)
+    print('Days written more than once are calculated and looked up as one row')
+    for n_facilities in facility_counts:
+        compare_cfr(n_facilities)
+    print('Day keyed case fatality rates match the original step 8')
+    for n_facilities in facility_counts:
+        compare_ingest(n_facilities * 10)
+    print('Vectorized sheet reading matches the original clean up')
+    for n_facilities in facility_counts:
+        compare_scan(n_facilities * 10)
+    print('Chunked sheet scans match whole ones and hold less')
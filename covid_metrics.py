@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Counts by day calculations for AGOL_updater.py: daily increases, recoveries
+and 7 day averages for every health district, and the stored tail used to
+calculate only today's numbers.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# Columns in the counts by day table that are calculated from the daily case counts
+derived_fields = ['COVID_Cases_Daily_Increase', 'COVID_Total_Recoveries',
+                  'COVID_New_Daily_Recoveries', 'COVID_Deaths_Daily_Increase',
+                  'COVID_New_Daily_Hosp', 'COVID_Cases_7_Day_Avg',
+                  'COVID_Hosp_7_Day_Avg', 'COVID_Deaths_7_Day_Avg']
+
+# Cases are considered recovered this many days after they are reported
+recovery_lag = 21
+# Window used for the rolling averages
+avg_window = 7
+# Days of history per district needed to calculate the next day's values
+tail_days = recovery_lag
+
+# Fields that feed the calculations, used to check a stored tail against the service
+tail_check_fields = ['COVID_Cases_Utah_Resident', 'COVID_Total_Deaths', 'Hospitalizations',
+                     'COVID_Cases_Daily_Increase', 'COVID_Deaths_Daily_Increase',
+                     'COVID_New_Daily_Hosp', 'COVID_Total_Recoveries']
+
+
+def calc_district_metrics(day_df):
+    """
+    Calculate the derived counts by day fields for every health district at once.
+    Expects one row per district per day.  Returns a new dataframe sorted by
+    DISTNAME and Day with a fresh index, the input is not modified.
+    """
+    df = day_df.sort_values(['DISTNAME', 'Day'], kind='mergesort').reset_index(drop=True)
+    grp = df.groupby('DISTNAME', sort=False, observed=True)
+    # Position of each row within its district, the first row of each district is 0
+    pos = grp.cumcount()
+    first = pos == 0
+
+    cases = pd.to_numeric(df['COVID_Cases_Utah_Resident'])
+    deaths = np.trunc(pd.to_numeric(df['COVID_Total_Deaths']))
+    hosp = np.trunc(pd.to_numeric(df['Hospitalizations']))
+
+    # Calculate daily case, death and hospitalization increases
+    # The first day of each district keeps whatever value was already in the table
+    df['COVID_Cases_Daily_Increase'] = cases.groupby(df['DISTNAME'], sort=False, observed=True).diff().where(~first, df['COVID_Cases_Daily_Increase'])
+    df['COVID_Deaths_Daily_Increase'] = deaths.groupby(df['DISTNAME'], sort=False, observed=True).diff().where(~first, df['COVID_Deaths_Daily_Increase'])
+    df['COVID_New_Daily_Hosp'] = hosp.groupby(df['DISTNAME'], sort=False, observed=True).diff().where(~first, df['COVID_New_Daily_Hosp'])
+
+    # Calculate total recoveries = total cases - total deaths - (total cases today - total cases 21 days ago)
+    # which simplifies to total cases 21 days ago - total deaths
+    lagged = np.trunc(cases).groupby(df['DISTNAME'], sort=False, observed=True).shift(recovery_lag)
+    df['COVID_Total_Recoveries'] = (lagged - deaths).where(pos >= recovery_lag, df['COVID_Total_Recoveries'])
+
+    # Calculate daily recovery increase from the updated total recoveries
+    recoveries = np.trunc(pd.to_numeric(df['COVID_Total_Recoveries']))
+    df['COVID_New_Daily_Recoveries'] = recoveries.groupby(df['DISTNAME'], sort=False, observed=True).diff().where(~first, df['COVID_New_Daily_Recoveries'])
+
+    # Calculate 7 day averages for new daily cases, hospitalizations and deaths in one rolling call
+    avg_map = {'COVID_Cases_Daily_Increase': 'COVID_Cases_7_Day_Avg',
+               'COVID_New_Daily_Hosp': 'COVID_Hosp_7_Day_Avg',
+               'COVID_Deaths_Daily_Increase': 'COVID_Deaths_7_Day_Avg'}
+    block = df[list(avg_map)].apply(pd.to_numeric)
+    avgs = block.groupby(df['DISTNAME'], sort=False, observed=True).rolling(window=avg_window).mean()
+    avgs = avgs.reset_index(level=0, drop=True).sort_index()
+    for source, target in avg_map.items():
+        df[target] = avgs[source]
+
+    return df
+
+
+def one_row_per_district_day(day_df):
+    """
+    Counts by day rows with one row per district per day.  A day the update ran
+    more than once on keeps the row written last (the latest Day timestamp).
+    """
+    day_df = day_df.sort_values('Day', kind='mergesort')
+    days = pd.to_datetime(day_df['Day']).dt.normalize()
+    return day_df[~pd.DataFrame({'DISTNAME': day_df['DISTNAME'], 'Day': days}).duplicated(keep='last')]
+
+
+def calc_district_metrics_loop(day_df):
+    """
+    Original row by row calculation from AGOL_updater.py, kept as the reference
+    that calc_district_metrics() is checked against.  Returns a dictionary of
+    dataframes keyed on DISTNAME.
+    """
+    day_df = day_df.sort_values('Day', kind='mergesort')
+    hd_dict = {}
+    for item in day_df.DISTNAME.unique():
+        temp = day_df[day_df.DISTNAME == item]
+        hd_dict[item] = temp.reset_index()
+
+    for key in hd_dict:
+        for i in np.arange(1, hd_dict[key].shape[0]):
+            hd_dict[key].at[i, 'COVID_Cases_Daily_Increase'] = hd_dict[key].iloc[i]['COVID_Cases_Utah_Resident'] - hd_dict[key].iloc[i-1]['COVID_Cases_Utah_Resident']
+            hd_dict[key].at[i, 'COVID_Deaths_Daily_Increase'] = int(hd_dict[key].iloc[i]['COVID_Total_Deaths']) - int(hd_dict[key].iloc[i-1]['COVID_Total_Deaths'])
+            if i > 20:
+                hd_dict[key].at[i, 'COVID_Total_Recoveries'] = int(hd_dict[key].iloc[i]['COVID_Cases_Utah_Resident']) - int(hd_dict[key].iloc[i]['COVID_Total_Deaths']) - ( int(hd_dict[key].iloc[i]['COVID_Cases_Utah_Resident']) - int(hd_dict[key].iloc[i-21]['COVID_Cases_Utah_Resident']) )
+            hd_dict[key].at[i, 'COVID_New_Daily_Recoveries'] = int(hd_dict[key].iloc[i]['COVID_Total_Recoveries']) - int(hd_dict[key].iloc[i-1]['COVID_Total_Recoveries'])
+            hd_dict[key].at[i, 'COVID_New_Daily_Hosp'] = int(hd_dict[key].iloc[i]['Hospitalizations']) - int(hd_dict[key].iloc[i-1]['Hospitalizations'])
+
+    for key in hd_dict:
+        hd_dict[key]['COVID_Cases_7_Day_Avg'] = hd_dict[key]['COVID_Cases_Daily_Increase'].rolling(window=7).mean()
+        hd_dict[key]['COVID_Hosp_7_Day_Avg'] = hd_dict[key]['COVID_New_Daily_Hosp'].rolling(window=7).mean()
+        hd_dict[key]['COVID_Deaths_7_Day_Avg'] = hd_dict[key]['COVID_Deaths_Daily_Increase'].rolling(window=7).mean()
+
+    return hd_dict
+
+
+def latest_by_district(metrics_df):
+    """Return the most recent row for each district, indexed on DISTNAME."""
+    return metrics_df.groupby('DISTNAME', sort=False, observed=True).tail(1).set_index('DISTNAME')
+
+
+def tail_of_history(metrics_df, days=tail_days):
+    """Return the last few days of each district, enough to calculate the next day."""
+    df = metrics_df.sort_values(['DISTNAME', 'Day'], kind='mergesort')
+    return df.groupby('DISTNAME', sort=False, observed=True).tail(days).reset_index(drop=True)
+
+
+def save_tail(metrics_df, path):
+    """Store the tail of the calculated history to a CSV for the next incremental run."""
+    tail_of_history(metrics_df).to_csv(path, index=False)
+
+
+def load_tail(path):
+    """Load a stored tail, returns None if there isn't one yet."""
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, parse_dates=['Day'])
+
+
+def tail_matches(tail_df, service_df):
+    """
+    Check that the stored tail has the same districts, days and values as the
+    rows pulled from the service for the same days.  Days are compared by date
+    because the Day timestamps are written a few seconds apart.
+    """
+    def keyed(df):
+        df = df.assign(Date=pd.to_datetime(df['Day']).to_numpy().astype('datetime64[D]'))
+        df = df.sort_values(['DISTNAME', 'Date'], kind='mergesort')
+        keys = list(zip(df['DISTNAME'].astype(str), df['Date']))
+        return keys, df[tail_check_fields].apply(pd.to_numeric).to_numpy(float)
+
+    tail_keys, tail_values = keyed(tail_df)
+    service_keys, service_values = keyed(service_df)
+    if tail_keys != service_keys:
+        return False
+    return bool(np.allclose(tail_values, service_values, equal_nan=True))
+
+
+def counts_to_day_rows(updates_by_name, tail_df, day):
+    """
+    Build the next day's by-day rows from the case counts CSV (indexed on the
+    canonical Jurisdiction name).  Population is carried forward from the tail.
+    """
+    population = tail_df.groupby('DISTNAME', sort=False, observed=True)['Population'].last()
+    today_df = pd.DataFrame({'DISTNAME': updates_by_name.index,
+                             'COVID_Cases_Utah_Resident': updates_by_name['Cases'].to_numpy(),
+                             'COVID_Cases_Non_Utah_Resident': 0,
+                             'COVID_Cases_Total': updates_by_name['Cases'].to_numpy(),
+                             'Day': day,
+                             'Hospitalizations': updates_by_name['Hospitalizations'].to_numpy(),
+                             'COVID_Total_Deaths': updates_by_name['Deaths'].to_numpy()})
+    today_df['Population'] = today_df['DISTNAME'].map(population)
+    today_df['Cases_per_100k'] = today_df['COVID_Cases_Total'] / today_df['Population'] * 100000.
+    return today_df.reindex(columns=tail_df.columns)
+
+
+def calc_incremental_metrics(tail_df, today_df):
+    """
+    Calculate the derived fields for today's rows from the stored tail only.
+    Gives the same values as calc_district_metrics() on the full history as
+    long as the tail holds the last tail_days rows of every district.
+    Returns today's rows indexed on DISTNAME and the new tail to store.
+    """
+    if set(tail_df['DISTNAME']) != set(today_df['DISTNAME']):
+        raise ValueError('Districts in the stored tail do not match the districts in the updates')
+    metrics_df = calc_district_metrics(pd.concat([tail_df, today_df], ignore_index=True))
+    today_metrics = latest_by_district(metrics_df)
+    # Keep the stored tail rows as they were, only today's rows are new
+    new_tail = pd.concat([tail_df, today_metrics.reset_index()[tail_df.columns]], ignore_index=True)
+    return today_metrics, tail_of_history(new_tail)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for hosted tables: day filtered where clauses and batched applyEdits
+updates and adds, optionally sent through an adaptive concurrency limit.
+"""
+
+import json
+import math
+import time
+import datetime as dt
+import numpy as np
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Maximum number of features sent in a single applyEdits request
+max_batch = 1000
+# (connect, read) seconds for applyEdits requests, a full batch can take a while to apply
+edit_timeout = (3.05, 120)
+# Seconds to wait before resending a batch, doubled for every retry, unless the service sends Retry-After
+retry_backoff = 1.
+max_retry_wait = 60.
+
+
+def day_where(date_field, day, pad_days=1):
+    """
+    Build a where clause that selects rows for a single day.  The range is padded
+    by a day on each side because the service stores dates in UTC, so the exact
+    date check still needs to happen on the (few) rows that come back.
+    """
+    start = dt.datetime.combine(day, dt.time()) - dt.timedelta(days=pad_days)
+    end = dt.datetime.combine(day, dt.time()) + dt.timedelta(days=1 + pad_days)
+    return (f"{date_field} >= timestamp '{start:%Y-%m-%d %H:%M:%S}' AND "
+            f"{date_field} < timestamp '{end:%Y-%m-%d %H:%M:%S}'")
+
+
+def _to_json_value(value):
+    """Convert numpy, pandas and datetime values to something applyEdits accepts."""
+    if value is None or value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dt.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=dt.timezone.utc)
+        return int(value.timestamp() * 1000)
+    if isinstance(value, dt.date):
+        return _to_json_value(dt.datetime.combine(value, dt.time()))
+    return value
+
+
+def build_updates(oid_field, edits):
+    """
+    Build the 'updates' part of an applyEdits payload from a dictionary of
+    {objectid: {field: value}}.
+    """
+    updates = []
+    for oid, values in edits.items():
+        attributes = {field: _to_json_value(value) for field, value in values.items()}
+        attributes[oid_field] = _to_json_value(oid)
+        updates.append({'attributes': attributes})
+    return updates
+
+
+def _error_code(status_code, response):
+    """The code of an ArcGIS JSON error, or the HTTP status code if there isn't one."""
+    code = response.get('error', {}).get('code', status_code) if isinstance(response, dict) else status_code
+    return code if isinstance(code, int) else status_code
+
+
+def _is_throttled(status_code, response):
+    """HTTP 429 or 5xx, or the same codes in an ArcGIS JSON error, mean the service is overloaded."""
+    code = _error_code(status_code, response)
+    return status_code == 429 or status_code >= 500 or code == 429 or code >= 500
+
+
+def _is_rejected(status_code, response):
+    """HTTP 429 (or 429 in an ArcGIS JSON error) means the request was turned away before any edit was applied."""
+    return status_code == 429 or _error_code(status_code, response) == 429
+
+
+def _retry_wait(attempt, r=None):
+    """Seconds to wait before retry number attempt (from 0): the Retry-After header if there is one, else backoff."""
+    if r is not None:
+        try:
+            return min(float(r.headers['Retry-After']), max_retry_wait)
+        except (KeyError, ValueError):
+            pass
+    return min(retry_backoff * 2 ** attempt, max_retry_wait)
+
+
+def build_adds(fields, rows):
+    """
+    Build the 'adds' part of an applyEdits payload from rows of values in the
+    order of fields.  A 'SHAPE@XY' field becomes the point geometry.
+    """
+    adds = []
+    for row in rows:
+        feature = {'attributes': {}}
+        for field, value in zip(fields, row):
+            if field == 'SHAPE@XY':
+                feature['geometry'] = {'x': _to_json_value(value[0]), 'y': _to_json_value(value[1])}
+            else:
+                feature['attributes'][field] = _to_json_value(value)
+        adds.append(feature)
+    return adds
+
+
+def _send_batches(service_url, kind, features, token, referer=None, batch_size=max_batch, limiter=None, retries=3,
+                  timeout=edit_timeout):
+    """
+    Send features as the 'kind' ('adds' or 'updates') of applyEdits requests, up
+    to batch_size features per request.  With a limiter (throttle.AdaptiveLimiter)
+    the batches are sent in parallel, as many at a time as the limiter allows.
+    Update batches the service throttled or that hit a connection error or
+    timeout (timeout is (connect, read) seconds) are sent again, up to 'retries'
+    times, after _retry_wait().  Adds are only sent again when they can't have
+    been applied: a 429 or a connect timeout.  After a 5xx, a read timeout or a
+    dropped connection the rows may have been added, so the batch fails rather
+    than adding them twice.  Returns (first feature index, batch, response) for
+    each batch, response is None if the request failed.
+    """
+    headers = {'referer': referer} if referer else {}
+
+    def send(start_index):
+        batch = features[start_index:start_index + batch_size]
+        r = None
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(_retry_wait(attempt - 1, r))
+            start = limiter.start() if limiter else None
+            throttled = True
+            retry = True
+            r = None
+            try:
+                r = requests.post(f'{service_url}/applyEdits', headers=headers,
+                                  data={'f': 'json', 'token': token,
+                                        kind: json.dumps(batch),
+                                        'rollbackOnFailure': 'false'},
+                                  timeout=timeout)
+                try:
+                    response = r.json()
+                except ValueError:
+                    response = {'error': {'code': r.status_code, 'message': r.text[:200]}}
+                throttled = _is_throttled(r.status_code, response)
+                retry = throttled if kind == 'updates' else _is_rejected(r.status_code, response)
+            except requests.RequestException as e:
+                response = {'error': {'message': f'{type(e).__name__}: {e}'}}
+                retry = kind == 'updates' or isinstance(e, requests.ConnectTimeout)
+            finally:
+                if limiter:
+                    limiter.finish(start, throttled)
+            if not retry:
+                break
+        if r is None or r.status_code != 200 or 'error' in response:
+            print(f"applyEdits request failed: {response['error'] if 'error' in response else r.status_code}")
+            response = None
+        return start_index, batch, response
+
+    starts = range(0, len(features), batch_size)
+    if limiter and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=limiter.maximum) as pool:
+            return list(pool.map(send, starts))
+    return [send(start_index) for start_index in starts]
+
+
+def apply_updates(service_url, oid_field, edits, token, referer=None, batch_size=max_batch, limiter=None, retries=3):
+    """
+    Send attribute updates to a hosted layer or table with applyEdits, up to
+    batch_size features per request (see _send_batches for the limiter).
+    Returns the object ids that failed.
+    """
+    updates = build_updates(oid_field, edits)
+    failed = []
+    for start_index, batch, response in _send_batches(service_url, 'updates', updates, token, referer,
+                                                      batch_size, limiter, retries):
+        if response is None:
+            failed.extend(item['attributes'][oid_field] for item in batch)
+        else:
+            failed.extend(result['objectId'] for result in response.get('updateResults', [])
+                          if not result.get('success'))
+    return failed
+
+
+def apply_adds(service_url, fields, rows, token, referer=None, batch_size=max_batch, limiter=None, retries=3):
+    """
+    Add rows (values in the order of fields) to a hosted layer or table with
+    applyEdits, up to batch_size features per request (see _send_batches for
+    the limiter).  Returns (row index, error) for the rows that failed.
+    """
+    adds = build_adds(fields, rows)
+    failed = []
+    for start_index, batch, response in _send_batches(service_url, 'adds', adds, token, referer,
+                                                      batch_size, limiter, retries):
+        if response is None:
+            failed.extend((start_index + i, 'applyEdits request failed') for i in range(len(batch)))
+            continue
+        results = response.get('addResults', [])
+        for i in range(len(batch)):
+            result = results[i] if i < len(results) else {'error': {'description': 'no result returned'}}
+            if not result.get('success'):
+                failed.append((start_index + i, result.get('error', {}).get('description', result.get('error'))))
+    return failed
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Backends for reading and editing the layers the update scripts work on: the
+hosted services through arcpy and applyEdits, or a local SQLite stand-in for
+running off the live portal.
+"""
+
+import re
+import sqlite3
+import threading
+import datetime as dt
+import numpy as np
+import pandas as pd
+import feature_service
+import throttle
+
+
+class ArcpyStore(object):
+    """Reads and edits layers and tables through arcpy (hosted services or local data)."""
+
+    def __init__(self, token_info=None, limiter=None):
+        import arcpy
+        self.arcpy = arcpy
+        # Edits to hosted services are sent with applyEdits when a sign-in token is available
+        self.token_info = token_info
+        # Shared by every applyEdits request, so parallel writers (e.g. backfill) back off together
+        self.limiter = limiter if limiter is not None else throttle.AdaptiveLimiter(initial=2, maximum=8)
+
+    @classmethod
+    def sign_in(cls, user, pw):
+        """Sign in to the active portal and return a store that can edit hosted services."""
+        import arcpy
+        portal_url = arcpy.GetActivePortalURL()
+        print(portal_url)
+        arcpy.SignInToPortal(portal_url, user, pw)
+        return cls(arcpy.GetSigninToken())
+
+    def username(self):
+        return self.arcpy.GetPortalDescription()['user']['username']
+
+    def edit_metrics(self):
+        """Concurrency and latency of the applyEdits requests sent so far (throttle.AdaptiveLimiter.metrics)."""
+        return self.limiter.metrics()
+
+    def list_fields(self, table):
+        return [f.name for f in self.arcpy.ListFields(table)]
+
+    def oid_field(self, table):
+        return self.arcpy.Describe(table).OIDFieldName
+
+    def read_table(self, table, fields, where='', null_value=None):
+        """Read the table into a dataframe (table --> numpy array --> dataframe)."""
+        arr = self.arcpy.da.TableToNumPyArray(table, fields, where, null_value=null_value)
+        return pd.DataFrame(data=arr)
+
+    def search(self, table, fields, where=''):
+        """Yield rows as tuples, like a SearchCursor."""
+        with self.arcpy.da.SearchCursor(table, fields, where) as cursor:
+            for row in cursor:
+                yield row
+
+    def update_rows(self, table, edits):
+        """
+        Write {objectid: {field: value}} edits.  Hosted services get one batched
+        applyEdits payload, anything else goes through a single UpdateCursor.
+        Returns the object ids that failed to update.
+        """
+        if not edits:
+            return []
+        oid_field = self.oid_field(table)
+        if self.token_info and table.startswith('http'):
+            return feature_service.apply_updates(table, oid_field, edits, self.token_info['token'],
+                                                 self.token_info.get('referer'), limiter=self.limiter)
+        fields = sorted({field for values in edits.values() for field in values})
+        where = f"{oid_field} IN ({','.join(str(int(oid)) for oid in edits)})"
+        updated = set()
+        with self.arcpy.da.UpdateCursor(table, ['OID@'] + fields, where) as ucursor:
+            for row in ucursor:
+                values = edits[row[0]]
+                row = [row[0]] + [values.get(field, row[i + 1]) for i, field in enumerate(fields)]
+                ucursor.updateRow(row)
+                updated.add(row[0])
+        return [oid for oid in edits if oid not in updated]
+
+    def insert_rows(self, table, fields, rows, chunk_size=feature_service.max_batch):
+        """
+        Insert rows (values in the order of fields).  Hosted services get batched
+        applyEdits adds of up to chunk_size rows, anything else goes through a
+        single InsertCursor.  Returns (row index, error) for rows that failed.
+        """
+        if self.token_info and table.startswith('http'):
+            return feature_service.apply_adds(table, fields, list(rows), self.token_info['token'],
+                                              self.token_info.get('referer'), batch_size=chunk_size,
+                                              limiter=self.limiter)
+        failed = []
+        with self.arcpy.da.InsertCursor(table, fields) as insert_cursor:
+            for i, row in enumerate(rows):
+                try:
+                    insert_cursor.insertRow(row)
+                except Exception as e:
+                    failed.append((i, e))
+        return failed
+
+    def append(self, source, target, field_map):
+        """Append every row of source to target, field_map is {source field: target field}."""
+        fms = self.arcpy.FieldMappings()
+        for key in field_map:
+            fm = self.arcpy.FieldMap()
+            fm.addInputField(source, key)
+            output = fm.outputField
+            output.name = field_map[key]
+            fm.outputField = output
+            fms.addFieldMap(fm)
+        self.arcpy.management.Append(source, target, "NO_TEST", field_mapping=fms)
+
+
+class SQLiteStore(object):
+    """
+    Local stand-in for the hosted layers, backed by a SQLite file.  Service URLs
+    are mapped to table names, so the scripts can run unchanged against it.
+    Every table has an OBJECTID primary key, dates are stored as ISO text and
+    'SHAPE@XY' is stored in SHAPE_X and SHAPE_Y columns.
+    """
+
+    date_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # The connection is shared by backfill worker threads, so edits take turns
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def table_name(table):
+        """Map a service URL (or plain name) to a table name, e.g. '.../LTCF_Data/FeatureServer/0' --> 'LTCF_Data'."""
+        match = re.search(r'/services/([^/]+)/FeatureServer', table)
+        name = match.group(1) if match else table
+        return re.sub(r'\W', '_', name)
+
+    def username(self):
+        return 'local'
+
+    def edit_metrics(self):
+        """Local edits aren't sent through a limiter, so there's nothing to report."""
+        return None
+
+    def list_fields(self, table):
+        info = self.conn.execute(f'PRAGMA table_info("{self.table_name(table)}")').fetchall()
+        return [col[1] for col in info]
+
+    def oid_field(self, table):
+        return 'OBJECTID'
+
+    def _date_fields(self, table):
+        info = self.conn.execute(f'PRAGMA table_info("{self.table_name(table)}")').fetchall()
+        return {col[1] for col in info if col[2] == 'TIMESTAMP'}
+
+    def _to_sql_value(self, value):
+        if value is None or value is pd.NA or value is pd.NaT:
+            return None
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and np.isnan(value):
+            return None
+        if isinstance(value, (dt.datetime, dt.date)):
+            return value.strftime(self.date_format)
+        return value
+
+    @staticmethod
+    def _columns(fields):
+        columns = []
+        for field in fields:
+            if field == 'OID@':
+                columns.append('OBJECTID')
+            elif field == 'SHAPE@XY':
+                columns.extend(['SHAPE_X', 'SHAPE_Y'])
+            else:
+                columns.append(field)
+        return columns
+
+    @staticmethod
+    def _quoted(columns):
+        return ', '.join(f'"{col}"' for col in columns)
+
+    @staticmethod
+    def _where(where):
+        # ArcGIS date literals (timestamp 'yyyy-mm-dd hh:mm:ss') compare as plain text here
+        return re.sub(r"\b(?:timestamp|date)\s+('[^']*')", r'\1', where or '', flags=re.IGNORECASE)
+
+    def load_table(self, table, df):
+        """Create (or replace) a table from a dataframe, columns with datetimes become date fields."""
+        name = self.table_name(table)
+        df = df.drop(columns=['OBJECTID'], errors='ignore')
+        defs = ['"OBJECTID" INTEGER PRIMARY KEY']
+        for col in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                sql_type = 'TIMESTAMP'
+            elif pd.api.types.is_integer_dtype(df[col]):
+                sql_type = 'INTEGER'
+            elif pd.api.types.is_float_dtype(df[col]):
+                sql_type = 'REAL'
+            else:
+                sql_type = 'TEXT'
+            defs.append(f'"{col}" {sql_type}')
+        with self.conn:
+            self.conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+            self.conn.execute(f'CREATE TABLE "{name}" ({", ".join(defs)})')
+        self.insert_rows(table, list(df.columns), df.itertuples(index=False, name=None))
+
+    def read_table(self, table, fields, where='', null_value=None):
+        columns = self._columns(fields)
+        sql = f'SELECT {self._quoted(columns)} FROM "{self.table_name(table)}"'
+        if where:
+            sql += f' WHERE {self._where(where)}'
+        df = pd.read_sql_query(sql, self.conn)
+        for col in self._date_fields(table) & set(df.columns):
+            df[col] = pd.to_datetime(df[col])
+        df.rename(columns={'OBJECTID': 'OID@'} if 'OID@' in fields else {}, inplace=True)
+        if null_value is not None:
+            df = df.fillna(null_value)
+        return df
+
+    def search(self, table, fields, where=''):
+        df = self.read_table(table, fields, where)
+        dates = self._date_fields(table)
+        for record in df.to_dict('records'):
+            row = []
+            for field in fields:
+                if field == 'SHAPE@XY':
+                    row.append((record['SHAPE_X'], record['SHAPE_Y']))
+                    continue
+                value = record[field]
+                if field in dates:
+                    value = None if pd.isna(value) else value.to_pydatetime()
+                elif isinstance(value, float) and np.isnan(value):
+                    value = None
+                elif isinstance(value, np.generic):
+                    value = value.item()
+                row.append(value)
+            yield tuple(row)
+
+    def update_rows(self, table, edits):
+        name = self.table_name(table)
+        failed = []
+        with self._lock, self.conn:
+            for oid, values in edits.items():
+                sets = ', '.join(f'"{field}" = ?' for field in values)
+                params = [self._to_sql_value(v) for v in values.values()] + [self._to_sql_value(oid)]
+                cur = self.conn.execute(f'UPDATE "{name}" SET {sets} WHERE OBJECTID = ?', params)
+                if cur.rowcount == 0:
+                    failed.append(oid)
+        return failed
+
+    def insert_rows(self, table, fields, rows, chunk_size=None):
+        """Insert rows in one transaction (chunk_size is only used by hosted services)."""
+        name = self.table_name(table)
+        columns = self._columns(fields)
+        sql = f'INSERT INTO "{name}" ({self._quoted(columns)}) VALUES ({", ".join("?" * len(columns))})'
+        failed = []
+        with self._lock, self.conn:
+            for i, row in enumerate(rows):
+                values = []
+                for field, value in zip(fields, row):
+                    values.extend(value if field == 'SHAPE@XY' else [value])
+                try:
+                    self.conn.execute(sql, [self._to_sql_value(v) for v in values])
+                except sqlite3.Error as e:
+                    failed.append((i, e))
+        return failed
+
+    def append(self, source, target, field_map):
+        df = self.read_table(source, list(field_map))
+        df.rename(columns=field_map, inplace=True)
+        self.insert_rows(target, list(df.columns), df.itertuples(index=False, name=None))
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""
+Geocoding of new LTCF facilities: the AGRC Geocoder with a pooled session and
+a persistent result cache, concurrent geocoding of rows, a chain of providers
+that falls back and hedges slow requests, and an offline geocoder over a
+local address point file.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+import requests
+import numpy as np
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import throttle
+
+
+def normalize_address(text):
+    """Upper case, drop punctuation and collapse whitespace so '123 n. Main St' == '123 N MAIN ST'."""
+    text = re.sub(r'[.,#]', ' ', str(text).upper())
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def normalize_zone(zone):
+    """Normalized city or ZIP code, ZIP codes read from the CSV as floats ('84057.0') are fixed.  Blank gives ''."""
+    if zone is None or (not isinstance(zone, str) and pd.isna(zone)):
+        return ''
+    zone = str(zone).strip()
+    if re.fullmatch(r'\d{5}(\.0+)?', zone):
+        zone = zone[:5]
+    return normalize_address(zone)
+
+
+def address_key(street, zone, **kwargs):
+    """Cache key for a geocoding request: normalized street and zone plus the request options (not the api key)."""
+    options = [f'{key}={value}' for key, value in sorted(kwargs.items()) if key != 'apiKey']
+    return '|'.join([normalize_address(street), normalize_address(zone)] + options)
+
+
+class GeocodeCache(object):
+    """
+    Geocoding results saved to a JSON file, keyed on address_key().  Addresses
+    that weren't found are kept for failure_ttl_hours, matches for ttl_days.
+    Holds up to max_entries, the least recently used entries are dropped first.
+    """
+
+    def __init__(self, path, max_entries=50000, ttl_days=180, failure_ttl_hours=24, save_every=25):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl_days * 86400
+        self.failure_ttl = failure_ttl_hours * 3600
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._entries = OrderedDict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._entries = OrderedDict(json.load(f))
+            print(f'Loaded {len(self._entries)} cached geocoding results from {path}')
+
+    def get(self, key):
+        """Return (True, result) for a cached result (result is None for a miss), or (False, None)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            ttl = self.ttl if entry['location'] is not None else self.failure_ttl
+            if time.time() - entry['time'] > ttl:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            if entry['location'] is None:
+                return True, None
+            return True, {'location': entry['location'], 'score': entry.get('score')}
+
+    def put(self, key, result):
+        """Store a {'location', 'score'} result, or None for an address that wasn't found."""
+        with self._lock:
+            location, score = (result['location'], result['score']) if result else (None, None)
+            self._entries[key] = {'location': location, 'score': score, 'time': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._unsaved += 1
+            # Save every few results so a failed run doesn't lose them
+            if self._unsaved >= self.save_every:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            if self._unsaved:
+                self._save()
+
+    def _save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(temp_path, self.path)
+        self._unsaved = 0
+
+
+def is_throttled(http_status, payload_status=200):
+    """
+    True if a response means the API is overloaded or failing: HTTP 429 or 5xx,
+    or an error status in the payload.  'Not found' (404) payloads are normal answers.
+    """
+    if http_status == 429 or http_status >= 500:
+        return True
+    return payload_status not in (200, 404)
+
+
+# Create Geocoder class -- from AGRC GitHub
+class Geocoder(object):
+
+    _api_key = None
+    _url_template = "http://api.mapserv.utah.gov/api/v1/geocode/{}/{}"
+
+    def __init__(self, api_key, referer='http://ltcf-covid-updates.com', cache=None,
+                 pool_size=10, timeout=(3.05, 15), url_template=None, limiter=None):
+        """
+        Create your api key at
+        https://developer.mapserv.utah.gov/secure/KeyManagement
+        Results are looked up in and saved to cache (a GeocodeCache), if there is one.
+        Create one Geocoder per run and share it, its session keeps up to pool_size
+        connections open for reuse.  timeout is (connect, read) seconds.
+        url_template points it at another server, e.g. a local stand-in for testing.
+        limiter (a throttle.AdaptiveLimiter) adjusts how many requests run at once,
+        backing off when the API throttles or errors.
+        """
+        self._api_key = api_key
+        self._referer = referer
+        self._cache = cache
+        self._timeout = timeout
+        self._limiter = limiter
+        if url_template is not None:
+            self._url_template = url_template
+        self._session = requests.Session()
+        self._session.headers.update({'referer': referer})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def locate(self, street, zone, **kwargs):
+        result = self.lookup(street, zone, **kwargs)
+        return result['location'] if result else None
+
+    def lookup(self, street, zone, **kwargs):
+        """Like locate(), but returns {'location': {'x', 'y'}, 'score': score} or None."""
+        if self._cache is not None:
+            key = address_key(street, zone, **kwargs)
+            hit, result = self._cache.get(key)
+            if hit:
+                return result
+
+        kwargs["apiKey"] = self._api_key
+        start = self._limiter.start() if self._limiter else None
+        throttled = True
+        try:
+            r = self._session.get(self._url_template.format(street, zone), params=kwargs, timeout=self._timeout)
+            try:
+                response = r.json()
+            except ValueError:
+                response = {"status": r.status_code, "message": r.text[:200]}
+            if not isinstance(response, dict):
+                response = {"message": r.text[:200]}
+            status = response.get("status")
+            throttled = is_throttled(r.status_code, status)
+        except requests.RequestException as e:
+            print("{} {} request failed. {}".format(street, zone, e))
+            return None
+        finally:
+            if self._limiter:
+                self._limiter.finish(start, throttled)
+
+        if r.status_code != 200 or status != 200 or "result" not in response:
+            print("{} {} was not found. {}".format(street, zone, response.get("message")))
+            # Only cache addresses that really weren't found, or answers without a status, for the
+            # cache's failure TTL.  Throttled or failed requests aren't cached.
+            if self._cache is not None and r.status_code == 200 and status in (404, None):
+                self._cache.put(key, None)
+            return None
+
+        result = response["result"]
+
+        print("match: {} score [{}]".format(result["score"], result["matchAddress"]))
+        result = {'location': result["location"], 'score': result["score"]}
+        if self._cache is not None:
+            self._cache.put(key, result)
+        return result
+
+
+def agrc_provider(geocoder, zone_field, **options):
+    """Geocoding provider for a ProviderChain: the AGRC API by Address and zone_field ('City' or 'ZIP_Code')."""
+    def lookup(row):
+        zone = normalize_zone(row[zone_field])
+        if not zone:
+            return None
+        return geocoder.lookup(row['Address'], zone, **options)
+    return lookup
+
+
+# Spelled out street words that address point files and facility addresses mix with their abbreviations
+street_abbreviations = {'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W', 'STREET': 'ST', 'AVENUE': 'AVE',
+                        'ROAD': 'RD', 'DRIVE': 'DR', 'LANE': 'LN', 'BOULEVARD': 'BLVD', 'CIRCLE': 'CIR',
+                        'COURT': 'CT', 'PLACE': 'PL', 'PARKWAY': 'PKWY', 'HIGHWAY': 'HWY', 'WAY': 'WAY'}
+
+
+def normalize_street(street):
+    """normalize_address() with street words abbreviated, so '123 North Main Street' == '123 N MAIN ST'."""
+    return ' '.join(street_abbreviations.get(word, word) for word in normalize_address(street).split())
+
+
+def normalize_streets(streets):
+    """normalize_street() for a whole series of streets at once."""
+    words = '|'.join(street_abbreviations)
+    streets = streets.astype(str).str.upper().str.replace(r'[.,#]', ' ', regex=True)
+    streets = streets.str.replace(r'\s+', ' ', regex=True).str.strip()
+    return streets.str.replace(rf'(?<!\S)({words})(?!\S)', lambda m: street_abbreviations[m.group(1)], regex=True)
+
+
+def read_address_points(path, columns=None):
+    """
+    Read an address point file (.csv or .parquet) with address, city, zip, x and
+    y columns (any case).  columns maps other column names to those, e.g.
+    {'FullAdd': 'address', 'City': 'city', 'ZipCode': 'zip'}.
+    """
+    if path.lower().endswith(('.parquet', '.pq')):
+        points = pd.read_parquet(path)
+    else:
+        points = pd.read_csv(path, dtype=str, keep_default_na=False)
+    points = points.rename(columns=columns or {})
+    points = points.rename(columns={col: col.lower() for col in points.columns})
+    missing = {'address', 'city', 'zip', 'x', 'y'} - set(points.columns)
+    if missing:
+        raise ValueError(f'Address point file {path} is missing columns: {sorted(missing)}')
+    return points
+
+
+class AddressIndex(object):
+    """
+    Offline geocoder over address points (a dataframe or a file for
+    read_address_points, x/y in the spatial reference the layers use).
+    Addresses are matched exactly on the normalized street and city or ZIP code
+    (score 100).  Otherwise the street names (the address without its house
+    number) in that city or ZIP code are looked up by the 2-letter pieces
+    (n-grams) they share with the address, so a typo in the street name or the
+    house number still finds the street.  The top_streets most similar streets
+    are scored on the n-grams they share with the address, house number
+    included (score 0-100).  The best one wins, at the point with that house
+    number, or else at the nearest house number and number_penalty points
+    lower.  lookup() returns {'location': {'x', 'y'}, 'score'} like
+    Geocoder.lookup, so it can be a provider in a ProviderChain.
+    """
+
+    def __init__(self, points, columns=None, ngram=2, top_streets=5, number_penalty=10.):
+        if isinstance(points, str):
+            points = read_address_points(points, columns)
+        start = time.perf_counter()
+        self.ngram = ngram
+        self.top_streets = top_streets
+        self.number_penalty = number_penalty
+        self.x = pd.to_numeric(points['x']).to_numpy(float)
+        self.y = pd.to_numeric(points['y']).to_numpy(float)
+        streets = normalize_streets(points['address'])
+        self.streets = streets.to_numpy()
+        split = streets.str.split(' ', n=1)
+        self.numbers = split.str[0].to_numpy()
+        self.house_numbers = pd.to_numeric(split.str[0], errors='coerce').to_numpy(float)
+        names = split.str[1].fillna('').to_numpy()
+        # Few distinct cities and ZIP codes, so each is only normalized once
+        cities = points['city'].map({zone: normalize_zone(zone) for zone in points['city'].unique()})
+        zips = points['zip'].map({zone: normalize_zone(zone) for zone in points['zip'].unique()})
+        ids = np.arange(len(points))
+        # Exact matches: 'street|zone' --> first point with that address
+        self._exact = {}
+        # Fuzzy matches: zone --> its street names, their n-gram counts, the
+        # streets each n-gram is in and the points on each street
+        self._zones = {}
+        for zone in (zips, cities):
+            zone = zone.to_numpy()
+            keys = self.streets + '|' + zone
+            self._exact.update(zip(keys[::-1], ids[::-1]))
+            # Points without a city or ZIP code are only found by the other one
+            named = ids[zone != '']
+            streets_by_zone = pd.Series(named).groupby([zone[named], names[named]]).indices
+            for (zone_name, name), positions in streets_by_zone.items():
+                self._zones.setdefault(zone_name, []).append((name, named[positions]))
+        self._zones = {zone: self._street_index(streets) for zone, streets in self._zones.items()}
+        print(f'Indexed {len(points)} address points in {len(self._zones)} cities and ZIP codes '
+              f'({time.perf_counter() - start:.2f}s)')
+
+    def __len__(self):
+        return len(self.x)
+
+    def _grams(self, street):
+        padded = f' {street} '
+        return {padded[i:i + self.ngram] for i in range(len(padded) - self.ngram + 1)}
+
+    def _street_index(self, streets):
+        """
+        For one zone: the street names, their n-gram counts, n-gram --> streets
+        with it and the points on each street sorted by house number, with their
+        house numbers.
+        """
+        postings = {}
+        counts = np.empty(len(streets))
+        for i, (name, _) in enumerate(streets):
+            grams = self._grams(name)
+            counts[i] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        postings = {gram: np.array(street_ids, dtype=np.int32) for gram, street_ids in postings.items()}
+        street_points = [street_points[np.argsort(self.house_numbers[street_points], kind='stable')]
+                         for _, street_points in streets]
+        street_numbers = [self.house_numbers[points] for points in street_points]
+        return [name for name, _ in streets], counts, postings, street_points, street_numbers
+
+    def _result(self, i, score):
+        return {'location': {'x': float(self.x[i]), 'y': float(self.y[i])}, 'score': score}
+
+    @staticmethod
+    def _closest_number(street_points, numbers, number):
+        """The point on a street (sorted by house numbers) with the nearest house number, or the first one."""
+        try:
+            number = float(number)
+        except ValueError:
+            return street_points[0]
+        i = np.searchsorted(numbers, number)
+        # Look at the house numbers on both sides, the NaNs sort last
+        nearby = [j for j in (i - 1, i) if 0 <= j < len(numbers) and not np.isnan(numbers[j])]
+        if not nearby:
+            return street_points[0]
+        return street_points[min(nearby, key=lambda j: abs(numbers[j] - number))]
+
+    def lookup(self, street, zone, min_score=0):
+        """Return {'location': {'x', 'y'}, 'score': score} for the best match scoring at least min_score, or None."""
+        street, zone = normalize_street(street), normalize_zone(zone)
+        if not street or not zone:
+            return None
+        exact = self._exact.get(f'{street}|{zone}')
+        if exact is not None:
+            return self._result(exact, 100.)
+        if zone not in self._zones:
+            return None
+        names, counts, postings, street_points, street_numbers = self._zones[zone]
+        number, _, name = street.partition(' ')
+        name_grams = self._grams(name)
+        hits = [postings[gram] for gram in name_grams if gram in postings]
+        if not hits:
+            return None
+        # Most similar street names (Dice similarity of their n-grams)
+        shared = np.bincount(np.concatenate(hits), minlength=len(counts))
+        similarity = shared / (len(name_grams) + counts)
+        top = np.flatnonzero(shared)
+        if len(top) > self.top_streets:
+            top = top[np.argpartition(-similarity[top], self.top_streets)[:self.top_streets]]
+        # Dice similarity of the whole addresses' n-grams, with the house number
+        # on each street, less number_penalty when no point on it has that number
+        grams = self._grams(street)
+        candidates = []
+        for j in top:
+            street_grams = self._grams(f'{number} {names[j]}')
+            score = 200. * len(grams & street_grams) / (len(grams) + len(street_grams))
+            i = self._exact.get(f'{number} {names[j]}|{zone}')
+            if i is None:
+                score -= self.number_penalty
+                i = self._closest_number(street_points[j], street_numbers[j], number)
+            candidates.append((score, i))
+        score, best = max(candidates)
+        if score < min_score:
+            return None
+        return self._result(best, round(score, 2))
+
+    def locate(self, street, zone, min_score=0):
+        result = self.lookup(street, zone, min_score)
+        return result['location'] if result else None
+
+
+def index_provider(index, zone_fields=('City', 'ZIP_Code')):
+    """Geocoding provider for a ProviderChain: the offline AddressIndex by Address and each of zone_fields, best score wins."""
+    def lookup(row):
+        results = [index.lookup(row['Address'], row[field]) for field in zone_fields]
+        results = [result for result in results if result is not None]
+        return max(results, key=lambda result: result['score']) if results else None
+    return lookup
+
+
+class ProviderChain(object):
+    """
+    Tries geocoding providers in order until one returns a score of at least
+    min_score.  providers is a list of (name, lookup) where lookup(row) returns
+    {'location', 'score'} or None.  A provider that misses falls back to the
+    next one right away.  A provider that takes longer than its hedge_percentile
+    latency (hedge_after seconds until there are enough samples) is hedged: the
+    next provider starts too and the first acceptable answer wins.
+    """
+
+    def __init__(self, providers, min_score=70, hedge_percentile=90, hedge_after=1., min_samples=20, max_workers=16):
+        self.providers = providers
+        self.min_score = min_score
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self._latencies = {name: deque(maxlen=200) for name, _ in providers}
+        self._wins = {name: 0 for name, _ in providers}
+        self._hedges = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _hedge_delay(self, name):
+        with self._lock:
+            latencies = list(self._latencies[name])
+        if len(latencies) < self.min_samples:
+            return self.hedge_after
+        return float(np.percentile(latencies, self.hedge_percentile))
+
+    def _timed(self, name, lookup, row):
+        start = time.perf_counter()
+        try:
+            return lookup(row)
+        finally:
+            with self._lock:
+                self._latencies[name].append(time.perf_counter() - start)
+
+    def lookup(self, row):
+        """Return {'location', 'score', 'provider'} from the first acceptable provider, or None."""
+        if len(self.providers) == 1:
+            # Nothing to fall back or hedge to, so no need for another thread
+            name, lookup = self.providers[0]
+            result = self._timed(name, lookup, row)
+            if result is None or (result['score'] or 0) < self.min_score:
+                return None
+            with self._lock:
+                self._wins[name] += 1
+            return dict(result, provider=name)
+        remaining = list(self.providers)
+        pending = {}
+
+        def start_next():
+            name, lookup = remaining.pop(0)
+            pending[self._pool.submit(self._timed, name, lookup, row)] = name
+
+        start_next()
+        while pending:
+            # Wait for an answer, or until the newest request is slow enough to hedge
+            newest = list(pending.values())[-1]
+            timeout = self._hedge_delay(newest) if remaining else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                with self._lock:
+                    self._hedges += 1
+                start_next()
+                continue
+            for future in done:
+                name = pending.pop(future)
+                result = future.result()
+                if result is not None and (result['score'] or 0) >= self.min_score:
+                    with self._lock:
+                        self._wins[name] += 1
+                    return dict(result, provider=name)
+            # A miss falls back to the next provider right away
+            if remaining:
+                start_next()
+        return None
+
+    def metrics(self):
+        """Answers won by each provider, hedged requests and each provider's latency percentiles."""
+        with self._lock:
+            metrics = {'wins': dict(self._wins), 'hedges': self._hedges}
+            latencies = {name: list(values) for name, values in self._latencies.items()}
+        metrics['latency'] = {name: throttle.latency_summary(values) for name, values in latencies.items()}
+        return metrics
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+def geocode_rows(df, geocode, max_in_flight=8, rate=10., key=None):
+    """
+    Run geocode(row) on every row of df with up to max_in_flight requests at a
+    time, limited to 'rate' requests per second overall (None for no limit,
+    e.g. offline geocoding).  If key(row) is given,
+    rows with the same key are only geocoded once and share the result.
+    Returns the geocoded rows in the same order as df and a dictionary of
+    throughput and latency stats.
+    """
+    if key is not None and not df.empty:
+        keys = df.apply(key, axis=1)
+        first = ~keys.duplicated()
+        if not first.all():
+            print(f'Geocoding {first.sum()} distinct addresses for {df.shape[0]} rows ...')
+            geocoded, stats = geocode_rows(df[first], geocode, max_in_flight, rate)
+            # Copy each address's results to the rows that share it
+            new_cols = [col for col in geocoded.columns if col not in df.columns]
+            results = geocoded[new_cols].set_axis(keys[first]).loc[keys]
+            return df.join(results.set_axis(df.index)), stats
+
+    bucket = throttle.TokenBucket(rate, capacity=max_in_flight) if rate else None
+    latencies = [None] * df.shape[0]
+
+    def run(i, row):
+        if bucket is not None:
+            bucket.acquire()
+        start = time.perf_counter()
+        try:
+            return geocode(row)
+        finally:
+            latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        # map() returns results in the order the rows were submitted
+        results = list(pool.map(run, range(df.shape[0]), [row.copy() for _, row in df.iterrows()]))
+    elapsed = time.perf_counter() - start
+
+    geocoded = pd.DataFrame(results) if results else df.copy()
+    stats = {'rows': df.shape[0], 'seconds': elapsed,
+             'rows_per_s': df.shape[0] / elapsed if elapsed > 0 else None,
+             **throttle.latency_summary(latencies)}
+    if results:
+        print(f"Geocoded {stats['rows']} rows in {elapsed:.2f}s ({stats['rows_per_s']:.1f} rows/s)    "
+              f"latency p50: {stats['p50']:.3f}s  p90: {stats['p90']:.3f}s  p99: {stats['p99']:.3f}s")
+    return geocoded, stats
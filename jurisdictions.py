@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+One place to clean up jurisdiction and health district names.
+"""
+
+import re
+from functools import lru_cache
+
+
+# Names that show up in different forms between the CSV and the hosted layers
+# Any name containing the key (after title casing) is replaced with the value
+name_aliases = {'San Juan': 'San Juan'}
+
+# Excel sometimes saves the CSV as UTF-7, which turns '-' into '+AC0-'
+encoding_fixes = {'+AC0': ''}
+
+
+@lru_cache(maxsize=None)
+def normalize_name(name):
+    """Return the canonical form of a single jurisdiction or district name."""
+    for bad, good in encoding_fixes.items():
+        name = name.replace(bad, good)
+    name = re.sub(r'\s+', ' ', name).strip()
+    for alias, canonical in name_aliases.items():
+        if alias in name.title():
+            return canonical
+    return name
+
+
+def normalize_names(names):
+    """
+    Return a series of canonical names.  Each distinct name is only normalized
+    once, so this stays cheap on long tables with a few repeated names.
+    """
+    unique_names = names.dropna().unique()
+    return names.map({name: normalize_name(name) for name in unique_names})
+
+
+def index_by_name(df, name_field):
+    """
+    Normalize the names in name_field and return the dataframe indexed on them,
+    so each cursor row can be matched with a single .loc lookup.
+    """
+    df = df.copy()
+    df[name_field] = normalize_names(df[name_field])
+    indexed = df.set_index(name_field)
+    if not indexed.index.is_unique:
+        dupes = list(indexed.index[indexed.index.duplicated()].unique())
+        raise ValueError(f'Duplicate {name_field} values after normalizing names: {dupes}')
+    return indexed
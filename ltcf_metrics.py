@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+"""
+LTCF calculations for the LTCF scripts: reading the Google Sheet export,
+change detection against the layer, dashboard descriptions and categories,
+daily totals, the events by day metrics and the case fatality rates.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+import schemas
+
+
+# Google Sheet export (COVID_LTCF_Data_latest.csv) columns that aren't needed,
+# Facility_Type is dropped and recreated from 'Dashboard Facility Type'
+sheet_drop = ['Facility_Type', 'Notes']
+# Sheet columns renamed to match the service
+sheet_renames = {'ID': 'OID',
+                 'Dashboard Facility Type': 'Facility_Type',
+                 'Positive Patients': 'Positive_Patients',
+                 'Deceased Patients': 'Deceased_Patients',
+                 'Positive HCWs': 'Positive_HCWs',
+                 'Positive Patient Description': 'Positive_Patients_Desc',
+                 'Last Positive Resident': 'LastPos_Resident'}
+# Types of the (renamed) sheet columns for comparisons, other columns are text.  Integer
+# columns are nullable (schemas.ltcf_schema), missing ids and counts are <NA>
+sheet_int_fields = ['OID', 'UniqueID', 'Positive_Patients', 'Deceased_Patients', 'Positive_HCWs']
+sheet_float_fields = ['Longitude', 'Latitude']
+sheet_str_fields = ['Positive_Patients_Desc']
+sheet_date_fields = ['Notification_Date', 'LastPos_Resident']
+# Google Sheets exports dates as month/day/year, other shapes seen in the export are tried after it
+sheet_date_format = '%m/%d/%Y'
+sheet_other_date_formats = ['%Y-%m-%d', '%m/%d/%y', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M']
+# Types read_csv parses the columns to, keyed on the sheet's own column names.  ZIP_Code is kept as text,
+# ids and counts are parsed as floats (the parser's fast path, blanks are NaN) and cast to Int32 after
+_sheet_names = {field: name for name, field in sheet_renames.items()}
+sheet_dtypes = {_sheet_names.get(field, field): 'float64' for field in sheet_int_fields + sheet_float_fields}
+sheet_dtypes['ZIP_Code'] = str
+
+# Fields copied from the sheet to the LTCF layer, in the order their changes are printed
+change_fields = ['Resolved_Y_N', 'Date_Resolved', 'Positive_Patients', 'Deceased_Patients',
+                 'Positive_HCWs', 'LastPos_Resident']
+count_fields = ['Positive_Patients', 'Deceased_Patients', 'Positive_HCWs']
+# Sheet fields scan_sheet() keeps for every facility, change detection and classify_facilities() read them
+sheet_match_fields = ['OID', 'UniqueID', 'Facility_Type'] + change_fields
+# Values written to the layer for missing values in the sheet, missing values in any other field are
+# written as null (see to_service)
+service_fill = {field: 0 for field in count_fields}
+
+# Dashboard bands for Postive_Patients_Desc and Dashboard_Display_Cat (used to sort the list of facilities
+# with active outbreaks), the first band a facility falls in wins.  Bands are on cumulative resident cases
+# (Positive_Patients) and positive HCWs, (low, high) is inclusive, None is open ended or any value.
+# Category 9999 sorts facilities with zero cases last, it isn't a missing value.
+#                  description        category  Positive_Patients  Positive_HCWs
+dashboard_bands = [('Zero cases',          9999,  (0, 0),            (0, 0)),
+                   ('More than 20',           1,  (21, None),        None),
+                   ('11 to 20',               2,  (11, 20),          None),
+                   ('5 to 10',                3,  (5, 10),           None),
+                   ('1 to 4',                 4,  (1, 4),            None),
+                   ('No Resident Cases',      5,  (0, 0),            (1, None))]
+# Facility types shown on the dashboard when they have unresolved cases
+dashboard_facility_types = ['Assisted Living', 'Nursing Home', 'Intermed Care/Intel Disabled', 'COVID-unit', 'COVID-only']
+
+# Facility types counted in the daily totals (LTCF events by day table), and the query for them on the layer
+totals_facility_types = ['Nursing Home', 'Assisted Living', 'Intermed Care/Intel Disabled']
+totals_query = '"Facility_Type" IN ({})'.format(', '.join(f"'{ftype}'" for ftype in totals_facility_types))
+# Layer fields the daily totals are counted from, in the order daily_totals_loop() takes them
+totals_fields = ['Facility_Type', 'Resolved_Y_N', 'Positive_Patients', 'Deceased_Patients', 'Positive_HCWs',
+                 'Postive_Patients_Desc', 'Dashboard_Display_Cat']
+# Daily totals in the order they are written to the LTCF events by day table
+total_names = ['investigations', 'outbreaks', 'resolved', 'positive_patients', 'deceased_patients', 'positive_hcws',
+               'active', 'more_than_20', 'eleven_to_20', 'five_to_ten', 'one_to_four', 'no_resident_cases']
+# Unresolved facilities in these bands (Postive_Patients_Desc) have active cases
+active_bands = {'More than 20': 'more_than_20',
+                '11 to 20': 'eleven_to_20',
+                '5 to 10': 'five_to_ten',
+                '1 to 4': 'one_to_four',
+                'No Resident Cases': 'no_resident_cases'}
+
+# Fields of the LTCF events by day table calculated in step 6, in the order they are calculated (a metric
+# can use fields calculated before it) and written in step 7.  Each metric is
+#   (output field, source field, operation, window, clamp)
+# where 'diff' is the change since 'window' days before and 'mean' the mean of the last 'window' days.
+# Results are clipped to clamp (lower, upper), None is no bound.  Daily increases are clipped at 0, since
+# false positives or double-counting can make a total drop.
+#                   output field                       source field                    op     window  clamp
+events_metrics = [('Today_Positive_Residents',        'Total_Positive_Residents',      'diff', 1,      (0, None)),
+                  ('Today_Deceased_Residents',        'Total_Deceased_Residents',      'diff', 1,      (0, None)),
+                  ('Today_Positive_HCWs',             'Total_Positive_HCWs',           'diff', 1,      (0, None)),
+                  ('Today_Outbreaks',                 'Total_Outbreaks',               'diff', 1,      (0, None)),
+                  ('Today_Outbreaks_Resolved',        'Total_Outbreaks_Resolved',      'diff', 1,      (0, None)),
+                  ('Today_Investigations',            'Total_Investigations',          'diff', 1,      (0, None)),
+                  ('Today_Fac_Active_Cases_7_Day_Av', 'Today_Facilities_Active_Cases', 'mean', 7,      None),
+                  ('Today_Outbreaks_7_Day_Avg',       'Today_Outbreaks',               'mean', 7,      None),
+                  ('Today_Outbreaks_Res_7_Day_Avg',   'Today_Outbreaks_Resolved',      'mean', 7,      None),
+                  ('Total_Positive_Res_7_Day_Avg',    'Total_Positive_Residents',      'mean', 7,      None),
+                  ('Total_Deceased_Res_7_Day_Avg',    'Total_Deceased_Residents',      'mean', 7,      None),
+                  ('Total_Positive_HCWs_7_Day_Avg',   'Total_Positive_HCWs',           'mean', 7,      None),
+                  ('Today_Positive_Res_7_Day_Avg',    'Today_Positive_Residents',      'mean', 7,      None),
+                  ('Today_Deceased_Res_7_Day_Avg',    'Today_Deceased_Residents',      'mean', 7,      None),
+                  ('Today_Positive_HCWs_7_Day_Avg',   'Today_Positive_HCWs',           'mean', 7,      None),
+                  ('Fac_More_than_20_7_Day_Avg',      'Today_Count_More_than_20',      'mean', 7,      None),
+                  ('Fac_11_to_20_7_Day_Avg',          'Today_Count_11_to_20',          'mean', 7,      None),
+                  ('Fac_5_to_10_7_Day_Avg',           'Today_Count_5_to_10',           'mean', 7,      None),
+                  ('Fac_1_to_4_7_Day_Avg',            'Today_Count_1_to_4',            'mean', 7,      None),
+                  ('Fac_No_Res_Cases_7_Day_Avg',      'Today_Count_No_Res_Cases',      'mean', 7,      None)]
+# Fields written to the LTCF events by day table in step 7
+events_metric_fields = [metric[0] for metric in events_metrics]
+# Fields a backfill (step 7b) rewrites: only the 7 day averages.  The hosted daily increases are kept,
+# they may have been corrected by hand and the first day's increase can't be calculated (it would be null)
+events_backfill_fields = [metric[0] for metric in events_metrics if metric[2] == 'mean']
+
+# Operations a metric can use, on a block of source columns
+metric_operations = {'diff': lambda block, window: block.diff(window),
+                     'mean': lambda block, window: block.rolling(window=window).mean()}
+
+
+def parse_sheet_dates(values, name='date'):
+    """
+    Parse a column of sheet dates (sheet_date_format).  Cells in another shape
+    are parsed with sheet_other_date_formats, then one at a time (11/3/2020,
+    2020-11-03 14:00, ...).  Cells that aren't dates at all are left empty and
+    reported.
+    """
+    dates = pd.to_datetime(values, format=sheet_date_format, errors='coerce')
+    for date_format in sheet_other_date_formats + ['mixed']:
+        other = dates.isna() & values.notna()
+        if not other.any():
+            break
+        dates[other] = pd.to_datetime(values[other], format=date_format, errors='coerce')
+    bad = dates.isna() & values.notna()
+    if bad.any():
+        print(f'{name}: {int(bad.sum())} cells are not dates and are left empty: {list(values[bad].unique()[:10])}')
+    return dates.astype('datetime64[ns]')
+
+
+def clean_sheet(updates):
+    """
+    Clean up the sheet export as read by read_sheet(): rename columns, strip
+    whitespace from text cells and make empty ones null, fill missing
+    Resolved_Y_N with 'N' and parse the dates (parse_sheet_dates()).
+    """
+    updates = updates.rename(columns=sheet_renames)
+    # Numbers are already parsed by read_csv (sheet_dtypes), only text columns need stripping
+    for col in updates.columns:
+        if pd.api.types.is_string_dtype(updates[col]):
+            updates[col] = updates[col].str.strip().replace('', np.nan)
+    for col in sheet_int_fields:
+        updates[col] = updates[col].astype(schemas.ltcf_schema[col])
+    updates['Resolved_Y_N'] = updates['Resolved_Y_N'].fillna('N')
+    updates[sheet_str_fields] = updates[sheet_str_fields].astype(str)
+    for col in sheet_date_fields:
+        updates[col] = parse_sheet_dates(updates[col], col)
+    return updates
+
+
+def read_sheet(path):
+    """
+    Read and clean up the Google Sheet export (clean_sheet()), sorted by OID
+    (the sheet's ID).  Ids, counts and coordinates are parsed by read_csv
+    (sheet_dtypes, missing ids and counts are <NA>).  Prints the rows per second.
+    """
+    start = time.perf_counter()
+    # Leading spaces are skipped by the parser, so number cells with stray spaces still parse
+    updates = pd.read_csv(path, dtype=sheet_dtypes, usecols=lambda col: col not in sheet_drop,
+                          skipinitialspace=True)
+    updates = clean_sheet(updates).sort_values('OID', kind='mergesort')
+    elapsed = time.perf_counter() - start
+    print(f'Read {updates.shape[0]} sheet rows in {elapsed:.2f}s ({updates.shape[0] / max(elapsed, 1e-9):.0f} rows/s)')
+    return updates
+
+
+def iter_sheet(path, chunksize, columns=None):
+    """
+    Read the Google Sheet export chunksize rows at a time, yielding each chunk
+    cleaned up (clean_sheet()) and cut down to columns, in file order.  Only
+    one chunk of the file is parsed and cleaned at a time.
+    """
+    with pd.read_csv(path, dtype=sheet_dtypes, usecols=lambda col: col not in sheet_drop,
+                     skipinitialspace=True, chunksize=chunksize) as reader:
+        for chunk in reader:
+            chunk = clean_sheet(chunk)
+            yield chunk[columns] if columns is not None else chunk
+
+
+def scan_sheet(chunks, layer_ids, fields=sheet_match_fields):
+    """
+    Reduce cleaned chunks of the sheet export (iter_sheet(), or [read_sheet()])
+    one at a time to what the LTCF scripts use.  Returns (no_id, new, facilities),
+    all sorted by OID:
+        no_id:       OIDs of the rows without a UniqueID
+        new:         rows (every column) with a UniqueID not in layer_ids, to be added to the layer
+        facilities:  the first row (lowest OID) of each UniqueID, only fields
+    Every chunk is cut down before the next one is read, so only one chunk is held whole.
+    """
+    start = time.perf_counter()
+    layer_ids = pd.Index(layer_ids)
+    no_id, new, facilities, n_rows = [], [], [], 0
+    for chunk in chunks:
+        n_rows += chunk.shape[0]
+        has_id = chunk['UniqueID'].notna()
+        no_id.append(chunk.loc[~has_id, 'OID'])
+        new.append(chunk[has_id & ~chunk['UniqueID'].isin(layer_ids)])
+        facilities.append(chunk.loc[has_id, fields].sort_values('OID', kind='mergesort').drop_duplicates('UniqueID'))
+    no_id = pd.concat(no_id).sort_values().tolist()
+    new = pd.concat(new).sort_values('OID', kind='mergesort')
+    # Rows of one facility in different chunks are deduplicated once they are all together
+    facilities = pd.concat(facilities).sort_values('OID', kind='mergesort').drop_duplicates('UniqueID')
+    elapsed = time.perf_counter() - start
+    print(f'Scanned {n_rows} sheet rows in {elapsed:.2f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s): '
+          f'{facilities.shape[0]} facilities, {new.shape[0]} new rows')
+    return no_id, new, facilities
+
+
+def read_sheet_loop(path):
+    """
+    Original clean up from step 1 of the LTCF scripts, one Python call per
+    cell, kept as the reference that read_sheet() is checked against.  Missing
+    ids and counts are 9999, like the original.
+    """
+    updates = pd.read_csv(path)
+    updates.sort_values('ID', inplace=True)
+    updates.drop(columns=sheet_drop, inplace=True)
+    updates.rename(sheet_renames, axis='columns', inplace=True)
+    # DataFrame.applymap was renamed to map in pandas 2.1
+    cell_map = updates.map if hasattr(updates, 'map') else updates.applymap
+    updates = cell_map(lambda x: x.strip() if type(x) == str else x)
+    cell_map = updates.map if hasattr(updates, 'map') else updates.applymap
+    updates = cell_map(lambda x: np.nan if isinstance(x, str) and not x else x)
+    updates[sheet_int_fields] = updates[sheet_int_fields].fillna(9999)
+    updates['Resolved_Y_N'] = updates['Resolved_Y_N'].fillna('N')
+    updates[sheet_int_fields] = updates[sheet_int_fields].astype(int)
+    updates[sheet_str_fields] = updates[sheet_str_fields].astype(str)
+    updates[sheet_date_fields] = updates[sheet_date_fields].astype('datetime64[ns]')
+    return updates
+
+
+def to_service(frame):
+    """Sheet rows with missing values filled as they are written to the layer (service_fill)."""
+    return frame.fillna({field: value for field, value in service_fill.items() if field in frame.columns})
+
+
+def sheet_values(updates, fields=change_fields):
+    """
+    Values the sheet sets in the LTCF layer (to_service()), indexed on UniqueID
+    (the first row wins for repeated ids).  Resolved_Y_N is upper case.
+    """
+    new = to_service(updates.drop_duplicates('UniqueID').set_index('UniqueID')[fields])
+    if 'Resolved_Y_N' in fields:
+        new['Resolved_Y_N'] = new['Resolved_Y_N'].str.upper()
+    return new
+
+
+def differs(old, new):
+    """Element-wise old != new for two aligned series, where two missing values are equal."""
+    old_na, new_na = old.isna(), new.isna()
+    same = old.astype(object).where(~old_na, None) == new.astype(object).where(~new_na, None)
+    return (old_na != new_na) | (~old_na & ~new_na & ~same)
+
+
+def detect_changes(service_df, updates, fields=change_fields):
+    """
+    Join the LTCF layer's rows (service_df, with an 'OID@' column) to the sheet
+    on UniqueID once and compare 'fields'.  Layer rows without a UniqueID in the
+    sheet are left out.  Returns (before, after, changed), all indexed on the
+    object id: the layer's rows, the same rows with the sheet's values in
+    'fields', and a boolean frame of the fields that changed.
+    """
+    before = service_df.set_index('OID@')
+    new = sheet_values(updates, fields)
+    before = before[before['UniqueID'].isin(new.index)]
+    incoming = new.reindex(before['UniqueID']).set_axis(before.index)
+    changed = pd.DataFrame({field: differs(before[field], incoming[field]) for field in fields},
+                           index=before.index)
+    after = before.astype({field: object for field in fields})
+    for field in fields:
+        after[field] = after[field].where(~changed[field], incoming[field].astype(object))
+    return before, after, changed
+
+
+def detect_changes_loop(service_df, updates, fields=change_fields):
+    """
+    Original row by row comparison from step 4 of the LTCF scripts, kept as the
+    reference that detect_changes() is checked against.  Takes the sheet with
+    missing counts as 9999, like the original.  Returns the changed fields as
+    {object id: [field, ...]}.
+    """
+    changes = {}
+    for row in service_df[['OID@', 'UniqueID'] + change_fields].itertuples(index=False, name=None):
+        oid, row = row[0], [None if pd.isna(value) else value for value in row[1:]]
+        temp_df = updates.loc[updates['UniqueID'] == row[0]]
+        if temp_df.empty:
+            continue
+        changed = []
+        if row[1] != temp_df.iloc[0]['Resolved_Y_N'].upper():
+            changed.append('Resolved_Y_N')
+        if row[2] != str(temp_df.iloc[0]['Date_Resolved']):
+            if not (row[2] is None and str(temp_df.iloc[0]['Date_Resolved']) == 'nan'):
+                changed.append('Date_Resolved')
+        for i, field in enumerate(count_fields, start=3):
+            if row[i] != temp_df.iloc[0][field]:
+                if not (row[i] == 0 and temp_df.iloc[0][field] == 9999):
+                    changed.append(field)
+        if row[6] != temp_df.iloc[0]['LastPos_Resident']:
+            if not (row[6] is None and str(temp_df.iloc[0]['LastPos_Resident']) == 'NaT'):
+                changed.append('LastPos_Resident')
+        changes[oid] = [field for field in fields if field in changed]
+    return changes
+
+
+def merge_derived(before, after, changed, derived):
+    """
+    Add calculated fields (derived, a frame with the same index) to after and
+    flag the ones that differ from the layer's values in before.  Returns the
+    new (after, changed), so edit_set() covers every field that would be written.
+    """
+    after = after.assign(**{field: derived[field].astype(object) for field in derived.columns})
+    flags = pd.DataFrame({field: differs(before[field], after[field]) for field in derived.columns},
+                         index=before.index)
+    return after, pd.concat([changed, flags], axis=1)
+
+
+def edit_set(after, changed):
+    """
+    Build {object id: {field: value}} edits for only the rows and fields that
+    changed (missing values are sent as None).
+    """
+    edits = {}
+    cells = changed.stack()
+    for oid, field in cells[cells].index:
+        value = after.at[oid, field]
+        edits.setdefault(oid, {})[field] = None if pd.isna(value) else value
+    return edits
+
+
+def changed_ids(after, changed):
+    """UniqueIDs of the facilities that changed in each field, for printing."""
+    return {field: list(after.loc[changed[field], 'UniqueID']) for field in changed.columns}
+
+
+def _in_band(values, band):
+    if band is None:
+        return np.ones(len(values), dtype=bool)
+    low, high = band
+    inside = np.ones(len(values), dtype=bool) if low is None else values >= low
+    return inside if high is None else inside & (values <= high)
+
+
+def dashboard_band(facilities):
+    """
+    Position in dashboard_bands of each facility (from the sheet's Positive_Patients
+    and Positive_HCWs, as written to the layer), -1 for facilities outside every band.
+    """
+    counts = to_service(facilities[['Positive_Patients', 'Positive_HCWs']])
+    positive, hcws = counts['Positive_Patients'].to_numpy(int), counts['Positive_HCWs'].to_numpy(int)
+    conditions = [_in_band(positive, pos_band) & _in_band(hcws, hcw_band)
+                  for _, _, pos_band, hcw_band in dashboard_bands]
+    return np.select(conditions, range(len(dashboard_bands)), -1)
+
+
+def classify_facilities(facilities, current=None):
+    """
+    Calculate Postive_Patients_Desc, Dashboard_Display and Dashboard_Display_Cat
+    for every facility at once from the sheet's Positive_Patients,
+    Positive_HCWs, Facility_Type and Resolved_Y_N.  Facilities outside every
+    band keep their values in current (a frame with the same index), or get
+    None.  Returns a frame with the same index.
+    """
+    band = dashboard_band(facilities)
+    # The last entry is picked by band -1
+    desc = np.array([b[0] for b in dashboard_bands] + [None], dtype=object)[band]
+    cat = np.array([b[1] for b in dashboard_bands] + [None], dtype=object)[band]
+    if current is not None:
+        desc = np.where(band < 0, current['Postive_Patients_Desc'].astype(object).to_numpy(), desc)
+        cat = np.where(band < 0, current['Dashboard_Display_Cat'].astype(object).to_numpy(), cat)
+    counts = to_service(facilities[['Positive_Patients', 'Positive_HCWs']])
+    active = (counts != 0).any(axis=1).to_numpy()
+    shown = (facilities['Facility_Type'].isin(dashboard_facility_types).to_numpy() & active
+             & (facilities['Resolved_Y_N'].astype(str).str.upper() == 'N').to_numpy())
+    return pd.DataFrame({'Postive_Patients_Desc': desc,
+                         'Dashboard_Display': np.where(shown, 'Y', 'N'),
+                         'Dashboard_Display_Cat': cat}, index=facilities.index)
+
+
+def classify_facilities_loop(facilities):
+    """
+    Original if/elif ladders from step 4 of the LTCF scripts, kept as the
+    reference that classify_facilities() is checked against.  Takes missing
+    counts as 9999, like the original.  Unlike classify_facilities(), a lower
+    case 'n' in Resolved_Y_N isn't displayed.
+    """
+    derived = {}
+    for i, facility in facilities.iterrows():
+        desc = cat = None
+        if (facility['Positive_Patients'] in (0, 9999) and facility['Positive_HCWs'] in (0, 9999)):
+            desc, cat = 'Zero cases', 9999
+        elif facility['Positive_Patients'] >= 21 and facility['Positive_Patients'] < 9999:
+            desc, cat = 'More than 20', 1
+        elif facility['Positive_Patients'] >= 11 and facility['Positive_Patients'] <= 20:
+            desc, cat = '11 to 20', 2
+        elif facility['Positive_Patients'] >= 5 and facility['Positive_Patients'] <= 10:
+            desc, cat = '5 to 10', 3
+        elif facility['Positive_Patients'] >= 1 and facility['Positive_Patients'] < 5:
+            desc, cat = '1 to 4', 4
+        elif facility['Positive_Patients'] in (0, 9999) and facility['Positive_HCWs'] not in (0, 9999):
+            desc, cat = 'No Resident Cases', 5
+        display = 'N'
+        if facility['Facility_Type'] in dashboard_facility_types:
+            if (facility['Positive_Patients'] not in (0, 9999) or facility['Positive_HCWs'] not in (0, 9999)) and facility['Resolved_Y_N'] == 'N':
+                display = 'Y'
+        derived[i] = {'Postive_Patients_Desc': desc, 'Dashboard_Display': display, 'Dashboard_Display_Cat': cat}
+    return pd.DataFrame.from_dict(derived, orient='index', columns=['Postive_Patients_Desc', 'Dashboard_Display', 'Dashboard_Display_Cat'])
+
+
+def written_layer(layer_rows, after, failed=()):
+    """
+    The LTCF layer's rows (layer_rows, with an 'OID@' column) as they are once
+    step 4's edits are written: rows in after (from detect_changes() and
+    merge_derived()) replace the layer's, except the object ids in failed.
+    Indexed on the object id.
+    """
+    layer = layer_rows.set_index('OID@')
+    written = after.drop(index=list(failed), errors='ignore')
+    return pd.concat([layer.drop(index=written.index), written[layer.columns]]).sort_index()
+
+
+def daily_totals(facilities):
+    """
+    Dashboard totals for the LTCF events by day table, counted from the facility
+    rows (totals_fields) at once.  Only facilities of totals_facility_types are
+    counted and missing counts add nothing.  Returns {name: total} in the order
+    of total_names.
+    """
+    facilities = facilities[facilities['Facility_Type'].isin(totals_facility_types)]
+    # Any category but 'Zero cases' (including none) is an outbreak
+    outbreak = facilities['Dashboard_Display_Cat'] != 9999
+    resolved = facilities['Resolved_Y_N'].astype(object).eq('Y')
+    unresolved = facilities['Resolved_Y_N'].astype(object).eq('N')
+    bands = facilities.loc[unresolved, 'Postive_Patients_Desc'].value_counts()
+    counts = facilities[count_fields].apply(pd.to_numeric).sum()
+    totals = {'investigations': facilities.shape[0],
+              'outbreaks': int(outbreak.sum()),
+              'resolved': int((outbreak & resolved).sum()),
+              'positive_patients': int(counts['Positive_Patients']),
+              'deceased_patients': int(counts['Deceased_Patients']),
+              'positive_hcws': int(counts['Positive_HCWs'])}
+    totals.update({name: int(bands.get(desc, 0)) for desc, name in active_bands.items()})
+    totals['active'] = sum(totals[name] for name in active_bands.values())
+    return {name: totals[name] for name in total_names}
+
+
+def daily_totals_loop(rows):
+    """
+    Original find_daily_values() from the LTCF scripts, counting rows of
+    totals_fields from the layer (searched with totals_query) one at a time.
+    Kept as the reference that daily_totals() is checked against and for
+    verifying the totals against the layer.  Returns {name: total} like
+    daily_totals().
+    """
+    investigations = 0
+    outbreaks = 0
+    positive_patients = 0
+    deceased_patients = 0
+    positive_hcws = 0
+    more_than_20 = 0
+    eleven_to_20 = 0
+    five_to_ten = 0
+    one_to_four = 0
+    no_resident_cases = 0
+    resolved = 0
+    for row in rows:
+        if row[0] in totals_facility_types:
+            investigations += 1
+        if row[6] != 9999:
+            outbreaks += 1
+        if row[1] == 'Y' and row[6] != 9999:
+            resolved += 1
+        positive_patients += row[2]
+        deceased_patients += row[3]
+        positive_hcws += row[4]
+        if row[1] == 'N' and row[5] == 'More than 20':
+            more_than_20 += 1
+        elif row[1] == 'N' and row[5] == '11 to 20':
+            eleven_to_20 += 1
+        elif row[1] == 'N' and row[5] == '5 to 10':
+            five_to_ten += 1
+        elif row[1] == 'N' and row[5] == '1 to 4':
+            one_to_four += 1
+        elif row[1] == 'N' and row[5] == 'No Resident Cases':
+            no_resident_cases += 1
+    facilities_with_active_cases = more_than_20 + eleven_to_20 + five_to_ten + one_to_four + no_resident_cases
+    return dict(zip(total_names, [investigations, outbreaks, resolved, positive_patients, deceased_patients,
+                                  positive_hcws, facilities_with_active_cases, more_than_20, eleven_to_20,
+                                  five_to_ten, one_to_four, no_resident_cases]))
+
+
+def one_row_per_day(day_df, date_field='Date'):
+    """
+    LTCF events by day rows sorted by date, with the date normalized to the day
+    and one row per day.  A day with several rows (the script ran more than once
+    that day) keeps the one written last.
+    """
+    day_df = day_df.sort_values(date_field, kind='mergesort')
+    day_df[date_field] = pd.to_datetime(day_df[date_field]).dt.normalize()
+    return day_df.drop_duplicates(date_field, keep='last')
+
+
+def _metric_passes(metrics):
+    """
+    Split metrics into passes of consecutive metrics with the same operation and
+    window, a metric whose source is calculated in the current pass starts a new one.
+    """
+    passes = []
+    for metric in metrics:
+        current = passes[-1] if passes else None
+        if (current is None or current[0][2:4] != metric[2:4]
+                or metric[1] in [output for output, *_ in current]):
+            passes.append([])
+        passes[-1].append(metric)
+    return passes
+
+
+def calc_events_metrics(day_df, metrics=events_metrics):
+    """
+    Calculate the metrics (events_metrics) for the LTCF events by day rows in
+    day_df, which must be sorted by date.  Each pass of metrics with the same
+    operation and window is one call over the block of their source columns.
+    Returns a new dataframe, the input is not modified.
+    """
+    results = {}
+    for metrics_pass in _metric_passes(metrics):
+        outputs, sources, operations, windows, clamps = zip(*metrics_pass)
+        # Sources calculated in an earlier pass are taken from its results
+        block = np.column_stack([results[source] if source in results else pd.to_numeric(day_df[source]).to_numpy(float)
+                                 for source in sources])
+        block = metric_operations[operations[0]](pd.DataFrame(block, index=day_df.index), windows[0]).to_numpy()
+        lower = [-np.inf if not clamp or clamp[0] is None else clamp[0] for clamp in clamps]
+        upper = [np.inf if not clamp or clamp[1] is None else clamp[1] for clamp in clamps]
+        block = np.clip(block, lower, upper)
+        results.update({output: block[:, i] for i, output in enumerate(outputs)})
+    return day_df.assign(**results)
+
+
+def calc_events_metrics_loop(day_df):
+    """
+    Original step 6 calculations from the LTCF scripts, one statement per field,
+    kept as the reference that calc_events_metrics() is checked against.
+    """
+    day_df = day_df.copy()
+    day_df['Today_Positive_Residents'] = day_df['Total_Positive_Residents'].diff().apply(lambda x: 0 if x < 0 else x)
+    day_df['Today_Deceased_Residents'] = day_df['Total_Deceased_Residents'].diff().apply(lambda x: 0 if x < 0 else x)
+    day_df['Today_Positive_HCWs'] = day_df['Total_Positive_HCWs'].diff().apply(lambda x: 0 if x < 0 else x)
+    day_df['Today_Outbreaks'] = day_df['Total_Outbreaks'].diff().apply(lambda x: 0 if x < 0 else x)
+    day_df['Today_Outbreaks_Resolved'] = day_df['Total_Outbreaks_Resolved'].diff().apply(lambda x: 0 if x < 0 else x)
+    day_df['Today_Investigations'] = day_df['Total_Investigations'].diff().apply(lambda x: 0 if x < 0 else x)
+    day_df['Today_Fac_Active_Cases_7_Day_Av'] = day_df['Today_Facilities_Active_Cases'].rolling(window=7).mean()
+    day_df['Today_Outbreaks_7_Day_Avg'] = day_df['Today_Outbreaks'].rolling(window=7).mean()
+    day_df['Today_Outbreaks_Res_7_Day_Avg'] = day_df['Today_Outbreaks_Resolved'].rolling(window=7).mean()
+    day_df['Total_Positive_Res_7_Day_Avg'] = day_df['Total_Positive_Residents'].rolling(window=7).mean()
+    day_df['Total_Deceased_Res_7_Day_Avg'] = day_df['Total_Deceased_Residents'].rolling(window=7).mean()
+    day_df['Total_Positive_HCWs_7_Day_Avg'] = day_df['Total_Positive_HCWs'].rolling(window=7).mean()
+    day_df['Today_Positive_Res_7_Day_Avg'] = day_df['Today_Positive_Residents'].rolling(window=7).mean()
+    day_df['Today_Deceased_Res_7_Day_Avg'] = day_df['Today_Deceased_Residents'].rolling(window=7).mean()
+    day_df['Today_Positive_HCWs_7_Day_Avg'] = day_df['Today_Positive_HCWs'].rolling(window=7).mean()
+    day_df['Fac_More_than_20_7_Day_Avg'] = day_df['Today_Count_More_than_20'].rolling(window=7).mean()
+    day_df['Fac_11_to_20_7_Day_Avg'] = day_df['Today_Count_11_to_20'].rolling(window=7).mean()
+    day_df['Fac_5_to_10_7_Day_Avg'] = day_df['Today_Count_5_to_10'].rolling(window=7).mean()
+    day_df['Fac_1_to_4_7_Day_Avg'] = day_df['Today_Count_1_to_4'].rolling(window=7).mean()
+    day_df['Fac_No_Res_Cases_7_Day_Avg'] = day_df['Today_Count_No_Res_Cases'].rolling(window=7).mean()
+    return day_df
+
+
+def cfr_day_key(dates):
+    """Day key (the date at midnight) that the case fatality rate sheets and the events by day table are matched on."""
+    return pd.to_datetime(pd.Series(dates)).dt.normalize().to_numpy()
+
+
+def combine_cfr(utah_cases, ltcf_cases):
+    """
+    Join the case fatality rate sheet's 'Utah' tab (statewide cases and deaths
+    for every day) and 'Resident' tab (only days LTCF residents died) on the
+    day.  Cumulative resident deaths are carried forward to the days between
+    and daily resident deaths are 0 on them.  Returns the statewide rows
+    indexed by day key (cfr_day_key()), the first row wins for repeated days.
+    """
+    ltcf_cases = ltcf_cases.set_axis(['date', 'LTCF_Daily_Deaths', 'LTCF_Cumulative_Deaths'], axis=1)
+    # Drop the blank first row and the 'Grand Total' row at the end
+    ltcf_cases = ltcf_cases[ltcf_cases['date'].notna() & (ltcf_cases['date'] != 'Grand Total')]
+    deaths = ltcf_cases.set_index(pd.Index(cfr_day_key(ltcf_cases['date']), name='Day'))
+    utah = utah_cases.set_index(pd.Index(cfr_day_key(utah_cases['date']), name='Day'))
+    deaths, utah = deaths[~deaths.index.duplicated()], utah[~utah.index.duplicated()]
+    deaths = deaths[['LTCF_Daily_Deaths', 'LTCF_Cumulative_Deaths']].reindex(utah.index)
+    deaths['LTCF_Cumulative_Deaths'] = deaths['LTCF_Cumulative_Deaths'].ffill()
+    deaths['LTCF_Daily_Deaths'] = deaths['LTCF_Daily_Deaths'].fillna(0)
+    return utah.join(deaths)
+
+
+def combine_cfr_loop(utah_cases, ltcf_cases):
+    """
+    Original join of the case fatality rate sheets from step 8 of the LTCF
+    scripts (a merge on the date and forward fill), kept as the reference that
+    combine_cfr() is checked against.  Rows are matched to the events by day
+    table by comparing 'date_x' for every row.
+    """
+    ltcf_cases = ltcf_cases.copy()
+    ltcf_cases.columns = ['date', 'LTCF_Daily_Deaths', 'LTCF_Cumulative_Deaths']
+    ltcf_cases.dropna(subset=['date'], inplace=True)
+    ltcf_cases = ltcf_cases[ltcf_cases.date != 'Grand Total'].copy()
+    # Series.astype('datetime64') without a unit isn't supported since pandas 2.0
+    ltcf_cases['join_date'] = pd.to_datetime(ltcf_cases['date'])
+    combined = pd.merge(utah_cases, ltcf_cases, left_on='date', right_on='join_date', how='left')
+    combined['LTCF_Cumulative_Deaths'] = combined['LTCF_Cumulative_Deaths'].ffill()
+    combined['LTCF_Daily_Deaths'] = combined['LTCF_Daily_Deaths'].fillna(0)
+    return combined
+
+
+def match_cfr_days(day_df, combined, date_field='Date'):
+    """
+    Rows of the events by day table (day_df) joined to their day in combined
+    (from combine_cfr()) at once, rows for days not in combined are left out.
+    """
+    day_df = day_df.assign(Day=cfr_day_key(day_df[date_field]))
+    return day_df.join(combined, on='Day', how='inner')
+
+
+def cfr_ratio(numerator, denominator):
+    """numerator / denominator * 100, missing where the denominator is 0 or missing."""
+    return (pd.to_numeric(numerator) / pd.to_numeric(denominator).where(denominator != 0) * 100).astype(float)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Declared column types for the tables loaded into pandas.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Counts by day table (Utah_COVID19_Case_Counts_by_LHD_by_Day)
+by_day_schema = {'DISTNAME': 'category',
+                 'COVID_Cases_Utah_Resident': 'Int32',
+                 'COVID_Cases_Non_Utah_Resident': 'Int32',
+                 'COVID_Cases_Total': 'Int32',
+                 'Day': 'datetime64[ns]',
+                 'Hospitalizations': 'Int32',
+                 'Population': 'Int32',
+                 'Cases_per_100k': 'float64',
+                 'COVID_Cases_Daily_Increase': 'Int32',
+                 'COVID_Total_Recoveries': 'Int32',
+                 'COVID_New_Daily_Recoveries': 'Int32',
+                 'COVID_Total_Deaths': 'Int32',
+                 'COVID_Deaths_Daily_Increase': 'Int32',
+                 'COVID_Cases_7_Day_Avg': 'float64',
+                 'COVID_Hosp_7_Day_Avg': 'float64',
+                 'COVID_Deaths_7_Day_Avg': 'float64',
+                 'COVID_New_Daily_Hosp': 'Int32'}
+
+# LTCF facility layer (LTCF_Data)
+ltcf_schema = {'OID': 'Int32',
+               'UniqueID': 'Int32',
+               'Facility_Name': 'string',
+               'Address': 'string',
+               'City': 'category',
+               'ZIP_Code': 'string',
+               'Facility_Type': 'category',
+               'LHD': 'category',
+               'Resolved_Y_N': 'category',
+               'Date_Resolved': 'string',
+               'Longitude': 'float64',
+               'Latitude': 'float64',
+               'Notification_Date': 'datetime64[ns]',
+               'Positive_Patients': 'Int32',
+               'Deceased_Patients': 'Int32',
+               'Positive_HCWs': 'Int32',
+               'Positive_Patients_Desc': 'category',
+               'LastPos_Resident': 'datetime64[ns]'}
+
+# LTCF events by day table (LTCF_Events_by_Day), loaded with nulls as 0 so plain ints are enough
+# The 'Today_' fields are recalculated from daily differences, so they are floats
+ltcf_events_by_day_schema = {'Date': 'datetime64[ns]',
+                             'Total_Investigations': 'int32',
+                             'Total_Positive_Residents': 'int32',
+                             'Total_Deceased_Residents': 'int32',
+                             'Total_Positive_HCWs': 'int32',
+                             'Total_Outbreaks': 'int32',
+                             'Total_Outbreaks_Resolved': 'int32',
+                             'Today_Facilities_Active_Cases': 'int32',
+                             'Today_Count_More_than_20': 'int32',
+                             'Today_Count_11_to_20': 'int32',
+                             'Today_Count_5_to_10': 'int32',
+                             'Today_Count_1_to_4': 'int32',
+                             'Today_Count_No_Res_Cases': 'int32',
+                             'Today_Positive_Residents': 'float64',
+                             'Today_Deceased_Residents': 'float64',
+                             'Today_Positive_HCWs': 'float64',
+                             'Today_Outbreaks': 'float64',
+                             'Today_Outbreaks_Resolved': 'float64'}
+
+
+def apply_schema(df, schema, none_value=0):
+    """
+    Cast the columns of df to the types in schema, in place, and return df.
+    Text columns are stripped of whitespace.  Numeric columns that came back as
+    text have 'None' entries replaced with none_value before they are cast.
+    Fractional values cast to integer types are truncated, like int() did.
+    Columns that aren't in the schema are left alone.
+    """
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if dtype in ('category', 'string'):
+            values = values.astype('string').str.strip()
+            df[col] = values.astype(dtype)
+        elif dtype.startswith('datetime'):
+            df[col] = pd.to_datetime(values).astype(dtype)
+        else:
+            if values.dtype == object or pd.api.types.is_string_dtype(values):
+                values = pd.to_numeric(values.replace('None', none_value))
+            if pd.api.types.is_integer_dtype(pd.api.types.pandas_dtype(dtype)) and pd.api.types.is_float_dtype(values):
+                values = np.trunc(values)
+            df[col] = values.astype(dtype)
+    return df
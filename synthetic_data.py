@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic counts by day history, case counts CSVs, LTCF layers, sheet exports
+and events by day tables, shared by the check scripts and benchmark_pipeline.py.
+"""
+
+import numpy as np
+import pandas as pd
+import datetime as dt
+import schemas
+import ltcf_metrics
+import covid_metrics
+
+
+# The real health districts, benchmarks add made up counties after them (district_names)
+districts = ['Bear River', 'Central Utah', 'Davis County', 'Salt Lake County', 'San Juan',
+             'Southeast Utah', 'Southwest Utah', 'Summit County', 'Tooele County',
+             'TriCounty', 'Utah County', 'Wasatch County', 'Weber-Morgan']
+facility_types = ['Nursing Home', 'Assisted Living', 'Intermed Care/Intel Disabled', 'Hospital', 'Other']
+
+
+def make_history(n_days, seed=0, names=districts):
+    """Build a synthetic counts by day table with one row per district (in names) per day."""
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(dt.datetime(2020, 3, 15, 13), periods=n_days, freq='D')
+    frames = []
+    for name in names:
+        cases = np.cumsum(rng.poisson(20, n_days))
+        deaths = np.cumsum(rng.poisson(0.3, n_days))
+        hosp = np.cumsum(rng.poisson(1.5, n_days))
+        frames.append(pd.DataFrame({'DISTNAME': name,
+                                    'COVID_Cases_Utah_Resident': cases,
+                                    'COVID_Cases_Non_Utah_Resident': 0,
+                                    'COVID_Cases_Total': cases,
+                                    'Day': days,
+                                    'Hospitalizations': hosp,
+                                    'Population': 100000,
+                                    'Cases_per_100k': cases * 1.,
+                                    'COVID_Cases_Daily_Increase': 0,
+                                    'COVID_Total_Recoveries': 0,
+                                    'COVID_New_Daily_Recoveries': 0,
+                                    'COVID_Total_Deaths': deaths,
+                                    'COVID_Deaths_Daily_Increase': 0,
+                                    'COVID_Cases_7_Day_Avg': np.nan,
+                                    'COVID_Hosp_7_Day_Avg': np.nan,
+                                    'COVID_Deaths_7_Day_Avg': np.nan,
+                                    'COVID_New_Daily_Hosp': 0}))
+    # Shuffle rows like the hosted table returns them
+    history = pd.concat(frames, ignore_index=True)
+    return history.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def district_names(n_districts):
+    """The real health districts first, then made up counties."""
+    names = list(districts[:n_districts])
+    names += [f'County {i:04d}' for i in range(n_districts - len(names))]
+    return names
+
+
+def make_case_counts(history, seed=0):
+    """Build a COVID_Case_Counts CSV frame with the next day's numbers for every district in history."""
+    rng = np.random.default_rng(seed)
+    latest = covid_metrics.latest_by_district(history)
+    n = latest.shape[0]
+    return pd.DataFrame({'Jurisdiction': latest.index,
+                         'Cases': latest['COVID_Cases_Utah_Resident'].to_numpy() + rng.poisson(20, n),
+                         'Hospitalizations': latest['Hospitalizations'].to_numpy() + rng.poisson(1.5, n),
+                         'Deaths': latest['COVID_Total_Deaths'].to_numpy() + rng.poisson(0.3, n)})
+
+
+def _maybe_missing(rng, values, frac=0.2):
+    """Blank out a fraction of the values, like empty cells in the Google Sheet."""
+    values = pd.array(values, dtype='Int64')
+    values[rng.random(len(values)) < frac] = pd.NA
+    return values
+
+
+def make_ltcf_service(n_facilities, seed=0):
+    """Build the LTCF_Data layer with the hosted field names (including the 'Postive' typo)."""
+    rng = np.random.default_rng(seed)
+    n = n_facilities
+    ids = np.arange(1, n + 1)
+    return pd.DataFrame({'UniqueID': ids,
+                         'Facility_Name': [f'Facility {i}' for i in ids],
+                         'Address': [f'{100 + i} N Main St' for i in ids],
+                         'City': rng.choice(['Salt Lake City', 'Provo', 'Ogden', 'Logan', 'St George'], n),
+                         'ZIP_Code': rng.integers(84001, 84791, n).astype(str),
+                         'Facility_Type': rng.choice(facility_types, n),
+                         'LHD': rng.choice(districts, n),
+                         'Resolved_Y_N': rng.choice(['Y', 'N'], n),
+                         'Date_Resolved': rng.choice(['2020-09-01', None], n),
+                         'Longitude': -111.9 + rng.random(n),
+                         'Latitude': 40.0 + rng.random(n),
+                         'Notification_Date': pd.Timestamp('2020-04-01') + pd.to_timedelta(rng.integers(0, 365, n), 'D'),
+                         'Positive_Patients': rng.integers(0, 40, n),
+                         'Deceased_Patients': rng.integers(0, 5, n),
+                         'Positive_HCWs': rng.integers(0, 10, n),
+                         'Postive_Patients_Desc': 'Zero cases',
+                         'Dashboard_Display': 'N',
+                         'Dashboard_Display_Cat': 9999,
+                         'LastPos_Resident': pd.Timestamp('2020-10-01') + pd.to_timedelta(rng.integers(0, 90, n), 'D')})
+
+
+def make_ltcf_sheet(service_df, seed=0):
+    """Build the COVID_LTCF_Data CSV export of the Google Sheet, with about a third of the rows changed."""
+    rng = np.random.default_rng(seed + 1)
+    n = service_df.shape[0]
+    changed = rng.random(n) < 0.3
+
+    def bump(field, lam):
+        return _maybe_missing(rng, service_df[field].to_numpy() + changed * rng.poisson(lam, n))
+
+    return pd.DataFrame({'ID': service_df['UniqueID'],
+                         'UniqueID': service_df['UniqueID'],
+                         'Facility_Name': ' ' + service_df['Facility_Name'] + ' ',
+                         'Address': service_df['Address'],
+                         'City': service_df['City'],
+                         'ZIP_Code': service_df['ZIP_Code'],
+                         'Facility_Type': 'Long Term Care',
+                         'Dashboard Facility Type': service_df['Facility_Type'],
+                         'LHD': service_df['LHD'],
+                         'Resolved_Y_N': np.where(changed, rng.choice(['Y', 'N', 'n', ''], n), service_df['Resolved_Y_N']),
+                         'Date_Resolved': service_df['Date_Resolved'].fillna(''),
+                         'Longitude': service_df['Longitude'],
+                         'Latitude': service_df['Latitude'],
+                         'Notification_Date': service_df['Notification_Date'].dt.strftime('%m/%d/%Y'),
+                         'Positive Patients': bump('Positive_Patients', 2),
+                         'Deceased Patients': bump('Deceased_Patients', 0.3),
+                         'Positive HCWs': bump('Positive_HCWs', 1),
+                         'Positive Patient Description': '',
+                         'Last Positive Resident': service_df['LastPos_Resident'].dt.strftime('%m/%d/%Y'),
+                         'Notes': ''})
+
+
+def make_events_by_day(n_days, seed=0):
+    """Build the LTCF events by day table, one row per day with running totals."""
+    rng = np.random.default_rng(seed)
+    events = pd.DataFrame({'Date': pd.date_range(dt.datetime(2020, 4, 1, 13), periods=n_days, freq='D')})
+    for field in schemas.ltcf_events_by_day_schema:
+        if field.startswith('Total_'):
+            events[field] = np.cumsum(rng.poisson(5, n_days))
+        elif field.startswith('Today_Count') or field == 'Today_Facilities_Active_Cases':
+            events[field] = rng.poisson(10, n_days)
+    for field in ltcf_metrics.events_metric_fields:
+        events[field] = np.nan
+    return events
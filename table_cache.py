@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Local snapshot cache for hosted tables, only rows newer than the cached ones
+(and the last few cached days, which are checked again) are downloaded.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def load_snapshot(path):
+    """Load a cached table from a .npz file, returns None if there isn't one yet."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        return pd.DataFrame({col: data[col] for col in data.files})
+
+
+def save_snapshot(df, path):
+    """
+    Save a dataframe to a .npz file with one array per column.  Text columns are
+    stored as fixed width strings so the file can be loaded without pickle.
+    """
+    arrays = {}
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(values):
+            arrays[col] = values.astype(str).to_numpy(dtype=str)
+        elif pd.api.types.is_extension_array_dtype(values):
+            # Nullable numbers are stored as floats with NaN for missing values
+            arrays[col] = values.to_numpy(dtype='float64', na_value=np.nan)
+        else:
+            arrays[col] = values.to_numpy()
+    # Write to a temp file first so a failed run doesn't leave a half written cache
+    temp_path = path + '.tmp.npz'
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, path)
+
+
+def watermark(df, date_field):
+    """Return the most recent date in the cached table, or None if it's empty."""
+    if df is None or df.empty:
+        return None
+    return pd.to_datetime(df[date_field]).max()
+
+
+def revalidate_start(df, date_field, revalidate_days):
+    """
+    Start of the cached rows that are downloaded again: midnight revalidate_days
+    before the watermark.  Returns None if the cache is empty.
+    """
+    mark = watermark(df, date_field)
+    if mark is None:
+        return None
+    return mark.normalize() - pd.Timedelta(days=revalidate_days)
+
+
+def watermark_where(df, date_field, revalidate_days=None):
+    """
+    Build a where clause that selects only rows newer than the cached watermark.
+    With revalidate_days, the last revalidate_days of cached rows are selected
+    too (from revalidate_start()), so corrections made to them on the service
+    are picked up.
+    """
+    if revalidate_days is not None:
+        start = revalidate_start(df, date_field, revalidate_days)
+        return '' if start is None else f"{date_field} >= timestamp '{start:%Y-%m-%d %H:%M:%S}'"
+    mark = watermark(df, date_field)
+    if mark is None:
+        return ''
+    return f"{date_field} > timestamp '{mark:%Y-%m-%d %H:%M:%S}'"
+
+
+def merge_delta(cached_df, delta_df, key_fields, date_field, since=None):
+    """
+    Merge newly fetched rows into the cached table.  Rows with the same key
+    fields are replaced by the new version.  With since (revalidate_start()),
+    cached rows from since on are dropped first, delta_df has the service's
+    current version of them (so rows deleted on the service go too).  Returns
+    the table sorted by date.
+    """
+    if cached_df is None:
+        merged = delta_df
+    else:
+        if since is not None:
+            cached_df = cached_df[pd.to_datetime(cached_df[date_field]) < since]
+        merged = pd.concat([cached_df, delta_df[cached_df.columns]], ignore_index=True)
+        merged = merged.drop_duplicates(subset=key_fields, keep='last')
+    merged[date_field] = pd.to_datetime(merged[date_field])
+    return merged.sort_values(date_field, kind='mergesort').reset_index(drop=True)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting and an adaptive (AIMD) concurrency limit for calls to web APIs
+shared by worker threads.
+"""
+
+import time
+import threading
+import numpy as np
+from collections import deque
+
+
+class TokenBucket(object):
+    """
+    Limits calls to 'rate' per second on average across all threads, with bursts
+    of up to 'capacity' calls.  Call acquire() before each request.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1., self.rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits how many calls run at once and adjusts the limit as calls finish
+    (additive increase, multiplicative decrease).  Each healthy call raises the
+    limit by increase / limit, so about +1 per round of calls.  A throttled or
+    failed call multiplies it by 'decrease'.  Calls slower than latency_target
+    (seconds, optional) hold the limit where it is.
+
+    Use:  start = limiter.start()  ...  limiter.finish(start, throttled)
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=16, increase=1., decrease=0.5, latency_target=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._last_backoff = 0.
+        self._calls = 0
+        self._backoffs = 0
+        self._latencies = deque(maxlen=500)
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return max(self.minimum, int(self._limit))
+
+    def start(self):
+        """Block until a call is allowed, returns its start time for finish()."""
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+        return time.monotonic()
+
+    def finish(self, start, throttled=False):
+        """Record how the call that started at 'start' went and let the next call in."""
+        now = time.monotonic()
+        latency = now - start
+        with self._cond:
+            self._in_flight -= 1
+            self._calls += 1
+            self._latencies.append(latency)
+            if throttled:
+                # Calls already in flight when the limit was cut don't cut it again
+                if start > self._last_backoff:
+                    self._limit = max(self.minimum, self._limit * self.decrease)
+                    self._last_backoff = now
+                    self._backoffs += 1
+            elif self.latency_target is None or latency <= self.latency_target:
+                self._limit = min(self.maximum, self._limit + self.increase / self._limit)
+            self._cond.notify_all()
+
+    def metrics(self):
+        """Current limit, calls in flight, call and back off counts, and recent latency percentiles."""
+        with self._cond:
+            latencies = list(self._latencies)
+            metrics = {'limit': self.limit, 'in_flight': self._in_flight,
+                       'calls': self._calls, 'backoffs': self._backoffs}
+        metrics.update(latency_summary(latencies))
+        return metrics
+
+
+def latency_summary(latencies):
+    """Return the 50th, 90th and 99th percentile of a list of latencies (in seconds)."""
+    if not len(latencies):
+        return {'p50': None, 'p90': None, 'p99': None}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'p50': p50, 'p90': p90, 'p99': p99}